@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Compare two benchmark results.
+
+    $ python benchmarks/compare.py before.json after.json
+"""
+import json
+
+import click
+
+
+METRICS = (
+    ('tasks_per_second', ('tasks_per_second',)),
+    ('peak starts/s', ('peak_starts_per_second',)),
+    ('latency mean', ('pickup_latency', 'mean')),
+    ('latency p50', ('pickup_latency', 'p50')),
+    ('latency p90', ('pickup_latency', 'p90')),
+    ('latency p99', ('pickup_latency', 'p99')),
+    ('latency max', ('pickup_latency', 'max')),
+    ('redis ops/task', ('redis', 'ops_per_task')),
+    ('dispatcher cpu s', ('dispatcher_cpu', 'seconds')),
+    ('dispatcher cpu %', ('dispatcher_cpu', 'percent')),
+)
+
+
+def lookup(results, path):
+    for key in path:
+        if results is None:
+            return None
+        results = results.get(key)
+    return results
+
+
+def format_value(value):
+    return '-' if value is None else '%.4g' % value
+
+
+@click.command()
+@click.argument('before', type=click.File('r'))
+@click.argument('after', type=click.File('r'))
+def main(before, after):
+    before, after = json.load(before), json.load(after)
+    if before['options'] != after['options']:
+        click.echo('Warning: the runs used different options', err=True)
+    click.echo('%-18s %12s %12s %9s' % ('', 'before', 'after', 'change'))
+    for name, path in METRICS:
+        old, new = lookup(before, path), lookup(after, path)
+        change = '-'
+        if old and new is not None:
+            change = '%+.1f%%' % (100. * (new - old) / old)
+        click.echo('%-18s %12s %12s %9s' % (name, format_value(old), format_value(new), change))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,540 @@
+"""
+Minimal in-process Redis server for the benchmarks.
+
+It speaks RESP over TCP and keeps the data in memory, with only the commands
+huey, the dispatcher and the benchmark stubs use. Lua scripts can't run here,
+so the known ones (huey's schedule pop and the dispatcher scripts) are
+implemented in Python and matched by their source. Commands are counted by
+client name (CLIENT SETNAME), unnamed connections count as 'dispatcher'.
+
+Keyspace notifications are not supported: CONFIG SET fails, so the watchers
+fall back to polling.
+"""
+import collections
+import fnmatch
+import hashlib
+import socketserver
+import threading
+import time
+
+from huey.storage import SCHEDULE_POP_LUA
+
+from huey_multitenant.application import NEXT_SCHEDULED_LUA, POP_REPORTS_LUA
+from huey_multitenant.periodic import ENQUEUE_PERIODIC_LUA, FINISH_PERIODIC_LUA, START_PERIODIC_LUA
+
+
+class RedisError(Exception):
+    pass
+
+
+WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+
+
+def _float(value):
+    value = value.decode() if isinstance(value, bytes) else str(value)
+    if value in ('-inf', '+inf', 'inf'):
+        return float(value)
+    if value.startswith('('):
+        raise RedisError('exclusive ranges are not supported')
+    return float(value)
+
+
+def _format_score(score):
+    if score == int(score):
+        return str(int(score)).encode()
+    return repr(score).encode()
+
+
+class Store(object):
+    """
+    Keys and the implementation of the commands.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.scripts = {}
+        self.lock = threading.Lock()
+        self.commands = collections.Counter()
+        self.script_impl = {
+            self.sha(SCHEDULE_POP_LUA): self._script_schedule_pop,
+            self.sha(NEXT_SCHEDULED_LUA): self._script_next_scheduled,
+            self.sha(POP_REPORTS_LUA): self._script_pop_reports,
+            self.sha(ENQUEUE_PERIODIC_LUA): self._script_enqueue_periodic,
+            self.sha(START_PERIODIC_LUA): self._script_start_periodic,
+            self.sha(FINISH_PERIODIC_LUA): self._script_finish_periodic,
+        }
+
+    @staticmethod
+    def sha(script):
+        if isinstance(script, str):
+            script = script.encode('utf-8')
+        return hashlib.sha1(script).hexdigest()
+
+    def _get(self, key, kind):
+        expire = self.expires.get(key)
+        if expire is not None and expire <= time.time():
+            self.data.pop(key, None)
+            del self.expires[key]
+        value = self.data.get(key)
+        if value is not None and not isinstance(value, kind):
+            raise RedisError(WRONGTYPE)
+        return value
+
+    def _list(self, key, create=False):
+        value = self._get(key, collections.deque)
+        if value is None and create:
+            value = self.data[key] = collections.deque()
+        return value
+
+    def _zset(self, key, create=False):
+        value = self._get(key, ZSetValue)
+        if value is None and create:
+            value = self.data[key] = ZSetValue()
+        return value
+
+    def _hash(self, key, create=False):
+        value = self._get(key, HashValue)
+        if value is None and create:
+            value = self.data[key] = HashValue()
+        return value
+
+    def _cleanup(self, key):
+        value = self.data.get(key)
+        if value is not None and not isinstance(value, bytes) and not value:
+            del self.data[key]
+            self.expires.pop(key, None)
+
+    def execute(self, client, args):
+        name = args[0].decode().upper()
+        if name in ('CLIENT', 'CONFIG', 'SCRIPT') and len(args) > 1:
+            name = '%s %s' % (name, args[1].decode().upper())
+            args = [name.encode()] + list(args[2:])
+        method = getattr(self, 'cmd_' + name.replace(' ', '_').lower(), None)
+        if method is None:
+            raise RedisError("unknown command '%s'" % name)
+        with self.lock:
+            self.commands[client.name] += 1
+            return method(client, *args[1:])
+
+    # Connection
+
+    def cmd_ping(self, client, *args):
+        return SimpleString('PONG')
+
+    def cmd_select(self, client, db):
+        if int(db) != 0:
+            raise RedisError('only db 0 is supported')
+        return SimpleString('OK')
+
+    def cmd_client_setname(self, client, name):
+        client.name = name.decode()
+        return SimpleString('OK')
+
+    def cmd_config_get(self, client, *args):
+        return []
+
+    def cmd_config_set(self, client, *args):
+        raise RedisError('CONFIG SET is not supported')
+
+    def cmd_info(self, client, *args):
+        return b'# Stats\r\ntotal_commands_processed:%d\r\n' % sum(self.commands.values())
+
+    def cmd_publish(self, client, channel, message):
+        return 0
+
+    # Keys
+
+    def cmd_del(self, client, *keys):
+        removed = 0
+        for key in keys:
+            if self._get(key, object) is not None:
+                del self.data[key]
+                removed += 1
+            self.expires.pop(key, None)
+        return removed
+
+    def cmd_exists(self, client, *keys):
+        return sum(1 for key in keys if self._get(key, object) is not None)
+
+    def cmd_expire(self, client, key, seconds):
+        if self._get(key, object) is None:
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def cmd_keys(self, client, pattern):
+        pattern = pattern.decode()
+        return [key for key in list(self.data) if self._get(key, object) is not None and
+                fnmatch.fnmatchcase(key.decode(), pattern)]
+
+    def cmd_flushall(self, client, *args):
+        self.data.clear()
+        self.expires.clear()
+        return SimpleString('OK')
+
+    # Strings
+
+    def cmd_get(self, client, key):
+        return self._get(key, bytes)
+
+    def cmd_set(self, client, key, value, *options):
+        options = [option.decode().upper() for option in options]
+        if 'NX' in options and self._get(key, object) is not None:
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if 'PX' in options:
+            self.expires[key] = time.time() + int(options[options.index('PX') + 1]) / 1000.
+        elif 'EX' in options:
+            self.expires[key] = time.time() + int(options[options.index('EX') + 1])
+        return SimpleString('OK')
+
+    def cmd_incr(self, client, key):
+        value = int(self._get(key, bytes) or 0) + 1
+        self.data[key] = str(value).encode()
+        return value
+
+    # Lists. The head of a Redis list is the left.
+
+    def cmd_lpush(self, client, key, *values):
+        items = self._list(key, create=True)
+        items.extendleft(values)
+        return len(items)
+
+    def cmd_rpush(self, client, key, *values):
+        items = self._list(key, create=True)
+        items.extend(values)
+        return len(items)
+
+    def _pop(self, key, right):
+        items = self._list(key)
+        if not items:
+            return None
+        value = items.pop() if right else items.popleft()
+        self._cleanup(key)
+        return value
+
+    def cmd_rpop(self, client, key):
+        return self._pop(key, right=True)
+
+    def cmd_lpop(self, client, key):
+        return self._pop(key, right=False)
+
+    def cmd_llen(self, client, key):
+        return len(self._list(key) or ())
+
+    @staticmethod
+    def _range(length, start, stop):
+        start, stop = int(start), int(stop)
+        if start < 0:
+            start = max(length + start, 0)
+        if stop < 0:
+            stop = length + stop
+        return start, min(stop, length - 1)
+
+    def cmd_lrange(self, client, key, start, stop):
+        items = self._list(key) or ()
+        start, stop = self._range(len(items), start, stop)
+        if start > stop:
+            return []
+        if start > len(items) // 2:
+            # Read from the tail, where the dispatcher looks.
+            tail = []
+            for index, item in enumerate(reversed(items)):
+                position = len(items) - 1 - index
+                if position < start:
+                    break
+                if position <= stop:
+                    tail.append(item)
+            tail.reverse()
+            return tail
+        return [item for index, item in enumerate(items) if start <= index <= stop]
+
+    def cmd_ltrim(self, client, key, start, stop):
+        items = self._list(key)
+        if items is None:
+            return SimpleString('OK')
+        start, stop = self._range(len(items), start, stop)
+        kept = [item for index, item in enumerate(items) if start <= index <= stop]
+        items.clear()
+        items.extend(kept)
+        self._cleanup(key)
+        return SimpleString('OK')
+
+    def cmd_lrem(self, client, key, count, value):
+        items = self._list(key)
+        if items is None:
+            return 0
+        count = int(count)
+        kept = []
+        removed = 0
+        for item in items:
+            if item == value and (not count or removed < abs(count)):
+                removed += 1
+            else:
+                kept.append(item)
+        items.clear()
+        items.extend(kept)
+        self._cleanup(key)
+        return removed
+
+    # Sorted sets
+
+    def cmd_zadd(self, client, key, *args):
+        zset = self._zset(key, create=True)
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            if member not in zset:
+                added += 1
+            zset[member] = _float(score)
+        return added
+
+    def cmd_zcard(self, client, key):
+        return len(self._zset(key) or ())
+
+    def _sorted(self, key):
+        return sorted((self._zset(key) or {}).items(), key=lambda item: (item[1], item[0]))
+
+    def cmd_zrange(self, client, key, start, stop, *options):
+        items = self._sorted(key)
+        start, stop = self._range(len(items), start, stop)
+        result = []
+        for member, score in items[start:stop + 1]:
+            result.append(member)
+            if options and options[0].upper() == b'WITHSCORES':
+                result.append(_format_score(score))
+        return result
+
+    def cmd_zrangebyscore(self, client, key, low, high, *options):
+        low, high = _float(low), _float(high)
+        return [member for member, score in self._sorted(key) if low <= score <= high]
+
+    def cmd_zremrangebyscore(self, client, key, low, high):
+        zset = self._zset(key)
+        if zset is None:
+            return 0
+        low, high = _float(low), _float(high)
+        members = [member for member, score in zset.items() if low <= score <= high]
+        for member in members:
+            del zset[member]
+        self._cleanup(key)
+        return len(members)
+
+    def cmd_zrem(self, client, key, *members):
+        zset = self._zset(key) or {}
+        removed = sum(1 for member in members if zset.pop(member, None) is not None)
+        self._cleanup(key)
+        return removed
+
+    # Hashes
+
+    def cmd_hset(self, client, key, field, value):
+        values = self._hash(key, create=True)
+        created = field not in values
+        values[field] = value
+        return int(created)
+
+    def cmd_hsetnx(self, client, key, field, value):
+        values = self._hash(key, create=True)
+        if field in values:
+            return 0
+        values[field] = value
+        return 1
+
+    def cmd_hget(self, client, key, field):
+        return (self._hash(key) or {}).get(field)
+
+    def cmd_hexists(self, client, key, field):
+        return int(field in (self._hash(key) or {}))
+
+    def cmd_hdel(self, client, key, *fields):
+        values = self._hash(key) or {}
+        removed = sum(1 for field in fields if values.pop(field, None) is not None)
+        self._cleanup(key)
+        return removed
+
+    def cmd_hlen(self, client, key):
+        return len(self._hash(key) or ())
+
+    def cmd_hgetall(self, client, key):
+        result = []
+        for field, value in (self._hash(key) or {}).items():
+            result.extend((field, value))
+        return result
+
+    # Scripts
+
+    def cmd_script_load(self, client, script):
+        sha = self.sha(script)
+        self.scripts[sha] = script
+        return sha.encode()
+
+    def cmd_script_exists(self, client, *shas):
+        return [int(sha.decode() in self.scripts) for sha in shas]
+
+    def cmd_eval(self, client, script, numkeys, *args):
+        sha = self.sha(script)
+        self.scripts[sha] = script
+        return self._run_script(sha, numkeys, args)
+
+    def cmd_evalsha(self, client, sha, numkeys, *args):
+        sha = sha.decode()
+        if sha not in self.scripts:
+            raise RedisError('NOSCRIPT No matching script. Please use EVAL.')
+        return self._run_script(sha, numkeys, args)
+
+    def _run_script(self, sha, numkeys, args):
+        impl = self.script_impl.get(sha)
+        if impl is None:
+            raise RedisError('script %s is not implemented by the fake server' % sha)
+        numkeys = int(numkeys)
+        return impl(list(args[:numkeys]), list(args[numkeys:]))
+
+    def _script_schedule_pop(self, keys, args):
+        members = self.cmd_zrangebyscore(None, keys[0], b'-inf', args[0])
+        self.cmd_zremrangebyscore(None, keys[0], b'-inf', args[0])
+        return members or None
+
+    def _script_next_scheduled(self, keys, args):
+        items = self.cmd_zrange(None, keys[0], 0, 0, b'WITHSCORES')
+        return items[1] if items else None
+
+    def _script_pop_reports(self, keys, args):
+        reports = self.cmd_lrange(None, keys[0], 0, -1)
+        self.cmd_del(None, keys[0])
+        return reports
+
+    def _script_enqueue_periodic(self, keys, args):
+        klass, policy, task_id, now, message, queued_ttl, running_ttl = args
+        state = self.cmd_hget(None, keys[0], klass)
+        if state is not None:
+            kind, _, at = state.split(b' ')
+            ttl = queued_ttl if kind == b'queued' else running_ttl
+            if _float(now) - _float(at) < _float(ttl) and (kind == b'queued' or policy == b'skip'):
+                return 0
+        self.cmd_hset(None, keys[0], klass, b'queued ' + task_id + b' ' + now)
+        self.cmd_lpush(None, keys[1], message)
+        return 1
+
+    def _script_start_periodic(self, keys, args):
+        klass, task_id, now = args
+        state = self.cmd_hget(None, keys[0], klass)
+        if state is not None and state.split(b' ')[:2] == [b'queued', task_id]:
+            self.cmd_hset(None, keys[0], klass, b'running ' + task_id + b' ' + now)
+            return 1
+        return 0
+
+    def _script_finish_periodic(self, keys, args):
+        klass, task_id = args
+        state = self.cmd_hget(None, keys[0], klass)
+        if state is not None and state.split(b' ')[1] == task_id:
+            return self.cmd_hdel(None, keys[0], klass)
+        return 0
+
+
+class HashValue(dict):
+    pass
+
+
+class ZSetValue(dict):
+    pass
+
+
+class SimpleString(str):
+    pass
+
+
+def encode(value):
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, SimpleString):
+        return b'+' + value.encode() + b'\r\n'
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    if isinstance(value, RedisError):
+        message = str(value)
+        if not message.split(' ')[0].isupper():
+            message = 'ERR ' + message
+        return b'-' + message.encode() + b'\r\n'
+    return b'*%d\r\n' % len(value) + b''.join(encode(item) for item in value)
+
+
+class Handler(socketserver.StreamRequestHandler):
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        self.name = 'dispatcher'
+        store = self.server.store
+        transaction = None
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            if not args:
+                continue
+            command = args[0].upper()
+            if command == b'MULTI':
+                transaction = []
+                reply = SimpleString('OK')
+            elif command == b'EXEC':
+                replies = []
+                for queued in transaction or ():
+                    try:
+                        replies.append(store.execute(self, queued))
+                    except RedisError as exc:
+                        replies.append(exc)
+                transaction = None
+                reply = replies
+            elif command == b'DISCARD':
+                transaction = None
+                reply = SimpleString('OK')
+            elif transaction is not None:
+                transaction.append(args)
+                reply = SimpleString('QUEUED')
+            else:
+                try:
+                    reply = store.execute(self, args)
+                except RedisError as exc:
+                    reply = exc
+            self.wfile.write(encode(reply))
+
+
+class FakeRedisServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        socketserver.TCPServer.__init__(self, (host, port), Handler)
+        self.store = Store()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='FakeRedis')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def command_counts(self):
+        with self.store.lock:
+            return dict(self.store.commands)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""
+Dispatcher benchmark.
+
+Generates N tenants pointing at stub manage.py scripts (see stub_manage.py),
+runs a dispatcher on them against a local redis-server or an in-process fake,
+drives a load pattern and prints the results as JSON.
+
+    $ python benchmarks/run.py --tenants 20 --tasks 2000 --pattern skewed --output skewed.json
+"""
+import json
+import os
+import pickle
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import click
+import redis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_redis import FakeRedisServer  # noqa: E402
+from stub_manage import RESULTS_KEY  # noqa: E402
+from huey_multitenant.scheduler import MAX_JITTER, periodic_offset  # noqa: E402
+
+PATTERNS = ('steady', 'bursty', 'skewed', 'periodic')
+
+DISPATCHER = """
+import sys
+from huey_multitenant.aio import AsyncDispatcher
+from huey_multitenant.core import Dispatcher
+conf_path, consumers, periodic, wake_on_work, engine, jitter = sys.argv[1:]
+dispatcher_class = AsyncDispatcher if engine == 'asyncio' else Dispatcher
+dispatcher_class(conf_path, int(consumers), periodic == '1', False, wake_on_work=wake_on_work == '1',
+                 periodic_jitter=float(jitter), configure_notifications=True)
+"""
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(round(p / 100. * (len(values) - 1))), len(values) - 1)]
+
+
+def cpu_seconds(pid):
+    """
+    User plus system CPU time of a process, from /proc.
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.workdir = options['workdir'] or tempfile.mkdtemp(prefix='huey-bench-')
+        self.run_id = uuid.uuid4().hex[:6]
+        self.server = None
+        self.dispatcher = None
+        # Commands sent by the benchmark itself, not counted as Redis ops.
+        self.own_ops = 0
+        self.tenants = ['bench%st%d' % (self.run_id, i) for i in range(options['tenants'])]
+
+    def log(self, message, *args):
+        click.echo(message % args, err=True)
+
+    def start_redis(self):
+        if self.options['redis_port']:
+            self.port = self.options['redis_port']
+        else:
+            self.server = FakeRedisServer().start()
+            self.port = self.server.port
+        self.conn = redis.Redis(host='127.0.0.1', port=self.port)
+        self.conn.client_setname('bench')
+        self.conn.delete(RESULTS_KEY)
+
+    def redis_ops(self):
+        if self.server is not None:
+            return self.server.command_counts()
+        self.own_ops += 1
+        return {'total': int(self.conn.info('stats')['total_commands_processed'])}
+
+    def write_tenants(self):
+        options = self.options
+        conf_path = os.path.join(self.workdir, 'conf')
+        os.makedirs(conf_path)
+        for i, tenant in enumerate(self.tenants):
+            path = os.path.join(self.workdir, tenant)
+            os.makedirs(path)
+            shutil.copy(os.path.join(ROOT, 'benchmarks', 'stub_manage.py'), os.path.join(path, 'manage.py'))
+            settings = 'prefix=%s,port=%d,startup=%s,duration=%s,periodic=%d,idle=%s' % (
+                tenant, self.port, options['startup'], options['duration'],
+                options['periodic_tasks'] if options['pattern'] == 'periodic' else 0, options['idle'])
+            with open(os.path.join(conf_path, '%s.conf' % tenant), 'w') as f:
+                f.write('[%s]\n' % tenant)
+                f.write('python=%s\n' % sys.executable)
+                f.write('script=%s\n' % os.path.join(path, 'manage.py'))
+                f.write('settings=%s\n' % settings)
+                f.write('redis_prefix=%s\n' % tenant)
+                f.write('redis_host=127.0.0.1\n')
+                f.write('redis_port=%d\n' % self.port)
+                f.write('workers=%d\n' % options['workers'])
+        return conf_path
+
+    def start_dispatcher(self, conf_path):
+        options = self.options
+        env = dict(os.environ)
+        env['PYTHONPATH'] = ROOT + os.pathsep + env.get('PYTHONPATH', '')
+        self.dispatcher_log = os.path.join(self.workdir, 'dispatcher.log')
+        with open(self.dispatcher_log, 'w') as log:
+            self.dispatcher = subprocess.Popen(
+                [sys.executable, '-c', DISPATCHER, conf_path, str(options['consumers']),
+                 '1' if options['pattern'] == 'periodic' else '0',
+                 '1' if options['wake_on_work'] else '0', options['engine'], str(options['periodic_jitter'])],
+                stdout=log, stderr=subprocess.STDOUT, env=env, cwd=self.workdir)
+
+        deadline = time.time() + options['timeout']
+        while time.time() < deadline:
+            with open(self.dispatcher_log) as log:
+                if 'Start Dispatcher' in log.read():
+                    return
+            if self.dispatcher.poll() is not None:
+                raise click.ClickException('Dispatcher exited, see %s' % self.dispatcher_log)
+            time.sleep(0.1)
+        raise click.ClickException('Dispatcher did not start, see %s' % self.dispatcher_log)
+
+    def stop_dispatcher(self):
+        if self.dispatcher is not None and self.dispatcher.poll() is None:
+            self.dispatcher.send_signal(signal.SIGINT)
+            try:
+                self.dispatcher.wait(10)
+            except subprocess.TimeoutExpired:
+                self.dispatcher.kill()
+
+    def enqueue(self, tenant):
+        message = pickle.dumps(
+            (str(uuid.uuid4()), 'queuecmd_bench', None, 0, 0, ((time.time(),), {}), None), protocol=2)
+        self.conn.lpush('huey.redis.%s' % tenant, message)
+        self.own_ops += 1
+
+    def pick_tenant(self, i):
+        if self.options['pattern'] == 'skewed':
+            return random.choices(self.tenants, weights=self.weights)[0]
+        if self.options['pattern'] == 'bursty':
+            return random.choice(self.tenants)
+        return self.tenants[i % len(self.tenants)]
+
+    def generate_load(self):
+        """
+        :return: number of tasks expected to run.
+        """
+        options = self.options
+        if options['pattern'] == 'periodic':
+            # Wait for the periodic tasks of the next `minutes` minutes.
+            return len(self.tenants) * options['periodic_tasks'] * options['minutes']
+
+        self.weights = [1. / (rank + 1) ** options['skew'] for rank in range(len(self.tenants))]
+        start = time.time()
+        for i in range(options['tasks']):
+            if options['pattern'] == 'bursty':
+                due = start + (i // options['burst']) * options['burst_interval']
+            else:
+                due = start + i / float(options['rate'])
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.enqueue(self.pick_tenant(i))
+        return options['tasks']
+
+    def wait_results(self, expected):
+        deadline = time.time() + self.options['timeout']
+        while time.time() < deadline:
+            self.own_ops += 1
+            if self.conn.llen(RESULTS_KEY) >= expected:
+                return True
+            time.sleep(0.1)
+        return False
+
+    def report(self, expected, completed_in_time, ops_before, ops_after, cpu_before, cpu_after, elapsed):
+        results = [json.loads(item.decode('utf-8')) for item in self.conn.lrange(RESULTS_KEY, 0, -1)]
+        latencies = []
+        starts = {}
+        for result in results:
+            # Periodic tasks are due at their offset into the minute.
+            enqueued = result['enqueued'] or int(result['started'] // 60) * 60 + periodic_offset(
+                result['tenant'], result['klass'], min(self.options['periodic_jitter'], MAX_JITTER))
+            latencies.append(result['started'] - enqueued)
+            starts[int(result['started'])] = starts.get(int(result['started']), 0) + 1
+
+        first = min([r['enqueued'] or r['started'] for r in results] or [0])
+        last = max([r['finished'] for r in results] or [0])
+        ops = dict((key, ops_after.get(key, 0) - ops_before.get(key, 0)) for key in ops_after)
+        # Leave out the commands of the benchmark, including recording results.
+        total_ops = sum(ops.values()) - self.own_ops - len(results)
+        cpu = None if cpu_before is None or cpu_after is None else cpu_after - cpu_before
+
+        return {
+            'options': self.options,
+            'revision': self.revision(),
+            'expected': expected,
+            'completed': len(results),
+            'timed_out': not completed_in_time,
+            'elapsed': elapsed,
+            'tasks_per_second': len(results) / (last - first) if results and last > first else None,
+            'peak_starts_per_second': max(starts.values()) if starts else None,
+            'pickup_latency': {
+                'mean': sum(latencies) / len(latencies) if latencies else None,
+                'p50': percentile(latencies, 50),
+                'p90': percentile(latencies, 90),
+                'p99': percentile(latencies, 99),
+                'max': max(latencies) if latencies else None,
+            },
+            'redis': {
+                'server': 'fake' if self.server is not None else 'redis-server',
+                'ops': total_ops,
+                'ops_per_task': total_ops / float(len(results)) if results else None,
+                'by_client': ops if self.server is not None else None,
+            },
+            'dispatcher_cpu': {
+                'seconds': cpu,
+                'percent': 100. * cpu / elapsed if cpu is not None and elapsed else None,
+            },
+        }
+
+    def revision(self):
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def cleanup(self):
+        keys = [RESULTS_KEY]
+        for tenant in self.tenants:
+            keys.extend(['huey.redis.%s' % tenant, 'huey.schedule.%s' % tenant,
+                         'huey.results.%s' % tenant, 'huey.multitenant.report.%s' % tenant])
+        self.conn.delete(*keys)
+        if not self.options['workdir'] and not self.options['keep']:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def run(self):
+        self.start_redis()
+        try:
+            conf_path = self.write_tenants()
+            self.log('Starting dispatcher with %d tenants in %s', len(self.tenants), self.workdir)
+            self.start_dispatcher(conf_path)
+
+            ops_before = self.redis_ops()
+            cpu_before = cpu_seconds(self.dispatcher.pid)
+            start = time.time()
+            self.log('Running %s load', self.options['pattern'])
+            expected = self.generate_load()
+            completed = self.wait_results(expected)
+            elapsed = time.time() - start
+            cpu_after = cpu_seconds(self.dispatcher.pid)
+            ops_after = self.redis_ops()
+            return self.report(expected, completed, ops_before, ops_after, cpu_before, cpu_after, elapsed)
+        finally:
+            self.stop_dispatcher()
+            self.cleanup()
+
+
+@click.command()
+@click.option('--pattern', type=click.Choice(PATTERNS), default='steady', help='Load pattern.')
+@click.option('--tenants', default=10, help='Number of tenants.')
+@click.option('--tasks', default=1000, help='Tasks to enqueue (not used by the periodic pattern).')
+@click.option('--rate', default=100., help='Tasks per second of the steady and skewed patterns.')
+@click.option('--burst', default=200, help='Tasks per burst of the bursty pattern.')
+@click.option('--burst-interval', default=5., help='Seconds between bursts.')
+@click.option('--skew', default=1.2, help='Zipf exponent of the tenant popularity in the skewed pattern.')
+@click.option('--periodic-tasks', default=5, help='Periodic tasks per tenant, every minute.')
+@click.option('--minutes', default=1, help='Minutes of periodic tasks to wait for.')
+@click.option('--periodic-jitter', default=0., help='Run the dispatcher with --periodic-jitter.')
+@click.option('--startup', default=0.2, help='Seconds a stub manage.py takes to start.')
+@click.option('--duration', default=0.01, help='Seconds a task takes.')
+@click.option('--idle', default=1., help='Seconds a stub consumer waits for work before stopping.')
+@click.option('--workers', default=4, help='Workers setting of every tenant.')
+@click.option('--consumers', default=8, help='Dispatcher consumers.')
+@click.option('--wake-on-work', is_flag=True, help='Run the dispatcher with --wake-on-work.')
+@click.option('--engine', type=click.Choice(['sync', 'asyncio']), default='sync', help='Dispatcher engine.')
+@click.option('--redis-port', default=0, help='Port of a local redis-server, by default an in-process fake.')
+@click.option('--timeout', default=300., help='Seconds to wait for the dispatcher and the tasks.')
+@click.option('--seed', default=0, help='Random seed.')
+@click.option('--workdir', default=None, help='Where to write the tenants (default a temporary directory).')
+@click.option('--keep', is_flag=True, help='Keep the temporary directory.')
+@click.option('--output', default=None, help='Write the JSON results to this file instead of stdout.')
+@click.option('--max-latency', default=0.,
+              help='Fail when the median pickup latency is above this many seconds (0 = no check).')
+def main(**options):
+    random.seed(options['seed'])
+    results = Benchmark(options).run()
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options['output']:
+        with open(options['output'], 'w') as f:
+            f.write(output + '\n')
+    else:
+        click.echo(output)
+    p50 = results['pickup_latency']['p50']
+    if options['max_latency'] and (p50 is None or p50 > options['max_latency']):
+        raise click.ClickException('Median pickup latency %s is above %gs' % (
+            'unknown' if p50 is None else '%.2fs' % p50, options['max_latency']))
+
+
+if __name__ == '__main__':
+    main()
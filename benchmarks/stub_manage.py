@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Stand-in for a tenant's manage.py, without Django. It understands the
+commands the dispatcher runs:
+
+- makeschedule: writes schedule.info with `periodic` tasks that run every
+  minute.
+- execute_task: drains the tenant queue with -w worker threads, each task
+  takes `duration` seconds, and stops after `idle` seconds without work. Every
+  task is recorded in the `bench.results` list.
+
+Parameters come in the --settings value, as key=value pairs separated by
+commas: prefix, host, port, startup (seconds before doing anything),
+duration, periodic and idle.
+"""
+import json
+import os
+import pickle
+import re
+import sys
+import threading
+import time
+
+import redis
+
+
+RESULTS_KEY = 'bench.results'
+REPORT_KEY = 'huey.multitenant.report.%s'
+
+
+def parse_args(argv):
+    command = argv[1] if len(argv) > 1 else None
+    options = {'workers': 1, 'settings': ''}
+    args = iter(argv[2:])
+    for arg in args:
+        if arg == '--settings':
+            options['settings'] = next(args)
+        elif arg in ('-w', '--workers'):
+            options['workers'] = int(next(args))
+    settings = {'prefix': 'bench', 'host': '127.0.0.1', 'port': '6379', 'startup': '0',
+                'duration': '0', 'periodic': '0', 'idle': '1'}
+    settings.update(pair.split('=', 1) for pair in options['settings'].split(',') if '=' in pair)
+    return command, int(options['workers']), settings
+
+
+def make_schedule(settings, settings_value):
+    script = os.path.abspath(sys.argv[0])
+    info_file = os.path.join(os.path.dirname(script), 'schedule.info')
+    with open(info_file + '.tmp', 'w') as f:
+        f.write('# Benchmark schedule\n')
+        f.write('#! settings %s\n' % settings_value)
+        f.write('#! source %r %s\n' % (os.stat(script).st_mtime, script))
+        for i in range(int(settings['periodic'])):
+            f.write('* * * * * bench.tasks.periodic_%d\n' % i)
+    os.rename(info_file + '.tmp', info_file)
+
+
+def execute_task(settings, workers):
+    conn = redis.Redis(host=settings['host'], port=int(settings['port']))
+    conn.client_setname('consumer')
+    name = re.sub('[^a-z0-9]', '', settings['prefix'])
+    queue_key = 'huey.redis.%s' % name
+    duration = float(settings['duration'])
+    idle = float(settings['idle'])
+    started_at = time.time()
+    state = {'working': 0, 'tasks': 0, 'busy': 0., 'last': time.time()}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def work():
+        while not stop.is_set():
+            message = conn.rpop(queue_key)
+            if message is None:
+                stop.wait(0.05)
+                continue
+            with lock:
+                state['working'] += 1
+            started = time.time()
+            task_id, klass, _, _, _, data, _ = pickle.loads(message)
+            args = data[0] if data else ()
+            if duration:
+                time.sleep(duration)
+            finished = time.time()
+            conn.rpush(RESULTS_KEY, json.dumps({
+                'tenant': name,
+                'task_id': task_id,
+                'klass': klass,
+                'enqueued': args[0] if args else None,
+                'started': started,
+                'finished': finished}))
+            with lock:
+                state['working'] -= 1
+                state['tasks'] += 1
+                state['busy'] += finished - started
+                state['last'] = finished
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    while True:
+        time.sleep(0.05)
+        with lock:
+            if not state['working'] and time.time() - state['last'] > idle:
+                break
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    conn.lpush(REPORT_KEY % name, json.dumps({
+        'tasks': state['tasks'], 'busy': state['busy'], 'seconds': time.time() - started_at, 'workers': workers}))
+
+
+def main():
+    command, workers, settings = parse_args(sys.argv)
+    time.sleep(float(settings['startup']))
+    if command == 'makeschedule':
+        make_schedule(settings, sys.argv[sys.argv.index('--settings') + 1])
+    elif command == 'execute_task':
+        execute_task(settings, workers)
+    else:
+        sys.stderr.write('Unsupported command: %s\n' % command)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+import logging
+import os
+import time
+
+from huey_multitenant.metrics import ADMISSION_DEFERRED, CONSUMER_MEMORY
+
+
+# How often the memory and CPU of the consumers are read.
+SAMPLE_INTERVAL = 1.
+
+# Weight of the last consumer in the footprint of its instance.
+FOOTPRINT_SMOOTHING = 0.3
+
+# The load average is a 1 minute average: the CPU of the consumers started
+# more recently is added to it.
+LOAD_WINDOW = 60.
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+
+
+def read_private_memory(pid):
+    """
+    Resident memory of a process not shared with others (as the pages of a
+    fork server), in bytes. None when the process is gone.
+    """
+    try:
+        with open('/proc/%d/statm' % pid) as f:
+            fields = f.read().split()
+    except (IOError, OSError):
+        return None
+    return (int(fields[1]) - int(fields[2])) * PAGE_SIZE
+
+
+def read_cpu_seconds(pid):
+    """
+    User plus system CPU time of a process. None when the process is gone.
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, OSError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def read_children(pid):
+    children = []
+    try:
+        tasks = os.listdir('/proc/%d/task' % pid)
+    except OSError:
+        return children
+    for task in tasks:
+        try:
+            with open('/proc/%d/task/%s/children' % (pid, task)) as f:
+                children.extend(int(child) for child in f.read().split())
+        except (IOError, OSError):
+            pass
+    return children
+
+
+def read_usage(pid):
+    """
+    Memory and CPU seconds of a process and its descendants (the workers of
+    a consumer with process workers).
+
+    :return: (bytes, seconds) or None when the process is gone.
+    """
+    memory = cpu = 0
+    found = False
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        process_memory, process_cpu = read_private_memory(pid), read_cpu_seconds(pid)
+        if process_memory is None or process_cpu is None:
+            continue
+        found = True
+        memory += process_memory
+        cpu += process_cpu
+        pids.extend(read_children(pid))
+    return (memory, cpu) if found else None
+
+
+def read_available_memory():
+    """
+    Memory available for new processes without swapping, in bytes.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _smooth(previous, value):
+    if previous is None:
+        return value
+    return FOOTPRINT_SMOOTHING * value + (1 - FOOTPRINT_SMOOTHING) * previous
+
+
+class Usage(object):
+    """
+    Memory and CPU of a running consumer.
+    """
+
+    def __init__(self):
+        self.memory = 0
+        self.peak = 0
+        self.cpu = 0.
+
+
+class AdmissionControl(object):
+    """
+    Admit new consumers only while the host has room for them.
+
+    The memory and CPU of every consumer are read from /proc, and the
+    footprint of the consumers of every instance is learned from the ones
+    that finished. A consumer is admitted if the available memory, minus what
+    the running consumers are still expected to grow and the footprint of the
+    new one, stays above min_free_memory; and if the load average, plus the
+    CPU of the consumers started in the last minute and of the new one, stays
+    under max_load.
+    """
+
+    def __init__(self, min_free_memory=0, max_load=0):
+        self._logger = logging.getLogger()
+        self.min_free_memory = min_free_memory
+        self.max_load = max_load
+        self.deferring = False
+        self._usage = {}
+        self._memory = {}
+        self._cpu = {}
+        self._sample_at = 0
+
+    @property
+    def enabled(self):
+        return bool(self.min_free_memory or self.max_load)
+
+    def sample(self, consumers):
+        """
+        Read the usage of the running consumers, at most every
+        SAMPLE_INTERVAL seconds.
+        """
+        now = time.time()
+        if not self.enabled or now < self._sample_at:
+            return
+        self._sample_at = now + SAMPLE_INTERVAL
+        for consumer in consumers:
+            if consumer.process.pid is None:
+                continue
+            usage = read_usage(consumer.process.pid)
+            if usage is None:
+                continue
+            state = self._usage.setdefault(consumer, Usage())
+            state.memory = usage[0]
+            state.peak = max(state.peak, usage[0])
+            state.cpu = max(state.cpu, usage[1])
+
+    def finished(self, consumer):
+        """
+        Learn the footprint of a consumer that exited.
+        """
+        usage = self._usage.pop(consumer, None)
+        if usage is None:
+            return
+        name = consumer.app.name
+        lifetime = max(time.time() - consumer.started, SAMPLE_INTERVAL)
+        self._memory[name] = _smooth(self._memory.get(name), usage.peak)
+        self._cpu[name] = _smooth(self._cpu.get(name), usage.cpu / lifetime)
+        CONSUMER_MEMORY.labels(name).set(self._memory[name])
+
+    def forget(self, instance):
+        self._memory.pop(instance.name, None)
+        self._cpu.pop(instance.name, None)
+
+    def footprint(self, name):
+        """
+        Expected peak memory (bytes) and CPU (cores) of a consumer of an
+        instance. Instances without finished consumers get the mean of the
+        others, or what their running consumers use so far.
+        """
+        memory = self._memory.get(name)
+        if memory is None:
+            memory = sum(self._memory.values()) / len(self._memory) if self._memory else 0
+        cpu = self._cpu.get(name)
+        if cpu is None:
+            cpu = sum(self._cpu.values()) / len(self._cpu) if self._cpu else 0
+        for consumer, usage in self._usage.items():
+            if consumer.app.name == name:
+                memory = max(memory, usage.peak)
+        return memory, cpu
+
+    def admit(self, instance, consumers):
+        """
+        :return: True if a new consumer of the instance fits.
+        """
+        if not self.enabled:
+            return True
+        footprints = {}
+
+        def footprint(name):
+            if name not in footprints:
+                footprints[name] = self.footprint(name)
+            return footprints[name]
+
+        memory, cpu = footprint(instance.name)
+        reason = None
+        if self.min_free_memory:
+            available = read_available_memory()
+            if available is not None:
+                growth = 0
+                for consumer in consumers:
+                    usage = self._usage.get(consumer)
+                    growth += max(footprint(consumer.app.name)[0] - (usage.memory if usage else 0), 0)
+                free = available - growth - memory
+                if free < self.min_free_memory:
+                    reason = 'free memory would be %d MB' % (free // 2 ** 20)
+        if reason is None and self.max_load:
+            now = time.time()
+            load = os.getloadavg()[0] + cpu + sum(
+                footprint(consumer.app.name)[1] for consumer in consumers if now - consumer.started < LOAD_WINDOW)
+            if load > self.max_load:
+                reason = 'load would be %.2f' % load
+
+        if reason is not None:
+            ADMISSION_DEFERRED.labels(instance.name).inc()
+            if not self.deferring:
+                self._logger.info('[%s] Consumer deferred, %s', instance.name, reason)
+            self.deferring = True
+            return False
+        if self.deferring:
+            self._logger.info('Consumers admitted again')
+            self.deferring = False
+        return True
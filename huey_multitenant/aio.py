@@ -0,0 +1,324 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+
+from redis.exceptions import RedisError
+
+from huey_multitenant.admission import SAMPLE_INTERVAL
+from huey_multitenant.application import MAX_SECONDS_RUNNING, HueyConsumer
+from huey_multitenant.cluster import HEARTBEAT_INTERVAL
+from huey_multitenant.connections import group_by_server
+from huey_multitenant.core import RELOAD_INTERVAL, WAKE_TIMEOUT, Dispatcher
+from huey_multitenant.metrics import CONSUMER_KILLS
+from huey_multitenant.supervisor import open_pidfd
+
+
+# Threads running the Redis calls of every server: the dispatcher and the
+# scheduler don't wait for each other.
+SERVER_THREADS = 2
+
+# Servers that take longer to read the queues are left for the next round.
+PROBE_TIMEOUT = 0.5
+
+# How often a consumer is polled when its exit can't be waited on.
+POLL_INTERVAL = 0.1
+
+
+async def _call(function, *args):
+    return function(*args)
+
+
+class LoopWaker(object):
+    """
+    Waker (see wakeup.Waker) of a coroutine in an asyncio loop. It may be
+    used from any thread; file descriptors are registered by the loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self._woken = False
+        self._waiter = None
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        self._woken = True
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _in_loop(self, function, *args):
+        """
+        Call function in the loop thread and wait for it, so a descriptor is
+        unregistered before the caller closes it.
+        """
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop or not self.loop.is_running():
+            return function(*args)
+        return asyncio.run_coroutine_threadsafe(_call(function, *args), self.loop).result()
+
+    def register(self, fd, callback):
+        def on_readable():
+            callback()
+            self._wake()
+        self._in_loop(self.loop.add_reader, fd, on_readable)
+
+    def unregister(self, fd):
+        self._in_loop(self.loop.remove_reader, fd)
+
+    async def wait(self, timeout):
+        """
+        :return: True if woken up by an event.
+        """
+        if not self._woken:
+            self._waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self._waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiter = None
+        woken, self._woken = self._woken, False
+        return woken
+
+
+async def wait_process(loop, process):
+    """
+    Wait for a consumer process (Popen or ForkedProcess) to exit, on a pidfd
+    when possible.
+    """
+    # A consumer asked to a fork server has no PID until it is forked.
+    while process.pid is None and process.poll() is None:
+        await asyncio.sleep(POLL_INTERVAL)
+    try:
+        fd = open_pidfd(process.pid) if process.returncode is None else None
+    except ProcessLookupError:
+        fd = None
+    if fd is not None:
+        exited = loop.create_future()
+        loop.add_reader(fd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(fd)
+            os.close(fd)
+    # A forked consumer is done once its fork server reports the exit.
+    while process.poll() is None:
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+class AsyncDispatcher(Dispatcher):
+    """
+    Dispatcher running on an asyncio loop.
+
+    redis-py has no asyncio client, so the Redis calls of every server run in
+    a small thread pool of their own: the servers are read at the same time,
+    and a slow one only delays its own instances. Every consumer is waited on
+    by a task of the loop, which releases its slot as soon as it exits and
+    kills it when it runs for too long. The scheduler is a coroutine of the
+    same loop, sharing the instances with the dispatcher. Reloads change the
+    instances on the loop too, only reading files, makeschedule and stopping
+    fork servers run in a thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self._executors = {}
+        self._probes = {}
+        super(AsyncDispatcher, self).__init__(*args, **kwargs)
+
+    def setup_scheduler(self):
+        self._scheduler = self._create_scheduler()
+
+    def setup_waker(self):
+        self.waker = LoopWaker(self.loop)
+        self.watch_queues(self.instances)
+
+    def executor(self, instance):
+        """
+        Thread pool of the Redis server of an instance.
+        """
+        key = id(instance.storage.pool)
+        executor = self._executors.get(key)
+        if executor is None:
+            executor = self._executors[key] = ThreadPoolExecutor(SERVER_THREADS)
+        return executor
+
+    async def by_server(self, function, instances):
+        """
+        Call function(group) for the instances of every Redis server, in the
+        thread pools of the servers at the same time.
+        """
+        groups = group_by_server(instances)
+        if groups:
+            await asyncio.gather(*[
+                self.loop.run_in_executor(self.executor(group[0]), function, group) for group in groups])
+
+    async def probe_queues(self):
+        """
+        See Dispatcher.probe_queues. The answers of the servers that take
+        longer than PROBE_TIMEOUT are used by the next call.
+        """
+        free = self._total_consumers - len(self.consumers)
+        for instances in group_by_server(self.owned_instances()):
+            key = id(instances[0].storage.pool)
+            if key not in self._probes:
+                pipe, reporting, heads = self.queue_probe(instances, free)
+                future = self.loop.run_in_executor(self.executor(instances[0]), pipe.execute)
+                self._probes[key] = (instances, reporting, heads, future)
+        if not self._probes:
+            return {}
+
+        await asyncio.wait([future for _, _, _, future in self._probes.values()], timeout=PROBE_TIMEOUT)
+        queues = {}
+        for key, (instances, reporting, heads, future) in list(self._probes.items()):
+            if not future.done():
+                continue
+            del self._probes[key]
+            try:
+                results = future.result()
+            except RedisError:
+                self._logger.exception('Error reading queues of %s', ', '.join(i.name for i in instances))
+                self._finished.update(instance.name for instance in reporting)
+                continue
+            self.read_queue_probe(instances, reporting, heads, results, queues)
+        return queues
+
+    async def consume_tasks(self):
+        self.start_consumers(await self.probe_queues())
+
+    def consume_task(self, instance, tasks, workers=None):
+        task_id = self.pick_task(instance, tasks, workers)
+        if task_id is None:
+            return False
+        start = time.time()
+        consumer = HueyConsumer(instance, task_id, workers)
+        self.add_consumer(consumer, start)
+        self.loop.create_task(self.supervise(consumer))
+        return True
+
+    async def supervise(self, consumer):
+        """
+        Wait for a consumer to exit and release it. It is killed every
+        MAX_SECONDS_RUNNING it keeps running.
+        """
+        exited = self.loop.create_task(wait_process(self.loop, consumer.process))
+        try:
+            while True:
+                done, _ = await asyncio.wait([exited], timeout=MAX_SECONDS_RUNNING)
+                if done:
+                    break
+                CONSUMER_KILLS.labels(consumer.app.name).inc()
+                consumer.kill_consumer()
+        finally:
+            self.release_consumer(consumer)
+            self.waker.wake()
+
+    async def run_heartbeat(self):
+        while True:
+            await self.loop.run_in_executor(None, self.heartbeat)
+            self.waker.wake()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    async def run_scheduler(self):
+        scheduler = self._scheduler
+        scheduler.waker = LoopWaker(self.loop)
+        scheduler.watch(scheduler.instances)
+        try:
+            while True:
+                scheduler.apply_update()
+                if not await self.loop.run_in_executor(None, scheduler.lead):
+                    scheduler.pop_periodic_tasks()
+                    await scheduler.waker.wait(scheduler.get_timeout())
+                    continue
+
+                await self.by_server(scheduler.refresh_group, scheduler.pop_stale())
+
+                now = scheduler.get_now()
+                await self.by_server(functools.partial(scheduler.read_group, now), scheduler.get_due(now))
+
+                tasks = scheduler.pop_periodic_tasks()
+                apps = list(set(app for app, _ in tasks))
+                await self.by_server(
+                    lambda group: scheduler.enqueue_periodic_tasks([t for t in tasks if t[0] in group]), apps)
+
+                await scheduler.waker.wait(scheduler.get_timeout())
+        except Exception:
+            self._logger.exception('Process %s died!', 'Scheduler')
+
+    async def reload_if_due(self):
+        if self.reload_due():
+            self._reload_at = time.time() + RELOAD_INTERVAL
+            try:
+                await self.reload_config()
+            except Exception:
+                self._logger.exception('Error reloading config.')
+
+    async def reload_config(self):
+        """
+        Reload the configuration (see Dispatcher.reload_config) while the loop
+        keeps releasing consumers and scheduling: the instances are changed by
+        the loop, only the blocking steps run in a thread.
+        """
+        changes = await self.loop.run_in_executor(None, self.read_changes)
+        if changes is None:
+            return
+        created, retired, reread = self.apply_changes(*changes)
+        if not created and not retired and not reread:
+            return
+        schedules = await self.loop.run_in_executor(None, self.load_instances, created, reread)
+        self.switch_instances(created, retired, schedules)
+        # The instances retired are not used anymore, the loop only waits for
+        # their last consumers.
+        await self.loop.run_in_executor(None, self.stop_instances, retired)
+
+    async def run(self):
+        if self.cluster is not None:
+            self.loop.create_task(self.run_heartbeat())
+        if self._scheduler is not None:
+            self.loop.create_task(self.run_scheduler())
+
+        timeout = 0.5
+        if self.wake_on_work:
+            timeout = WAKE_TIMEOUT
+        if self.admission.enabled:
+            timeout = min(timeout, SAMPLE_INTERVAL)
+        while True:
+            await self.waker.wait(timeout)
+            await self.reload_if_due()
+            self.admission.sample(self.consumers)
+
+            if len(self.consumers) < self._total_consumers:
+                await self.consume_tasks()
+            elif self.metrics_due():
+                await self.probe_queues()
+
+            self.update_metrics()
+            self.history.save_if_due()
+
+    def start(self):
+        self._logger.info('Start Dispatcher (asyncio)')
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.run())
+        except KeyboardInterrupt:
+            self._logger.info('Received SIGINT')
+        except Exception:
+            self._logger.exception('Error in consumer.')
+        self.stop()
+
+    def stop(self):
+        super(AsyncDispatcher, self).stop()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
+        self.loop.close()
@@ -1,4 +1,3 @@
-import datetime
 import subprocess
 import logging
 import os
@@ -7,10 +6,34 @@ import threading
 import time
 
 from huey.storage import RedisStorage
-from huey import crontab
+
+from huey_multitenant.connections import get_connection_pool
+from huey_multitenant.cron import CronEntry
+from huey_multitenant.message import encode_message, message_protocol
+from huey_multitenant.periodic import COALESCE_NONE, COALESCE_POLICIES, ENQUEUE_PERIODIC_LUA, PERIODIC_KEY, \
+    QUEUED_TTL, RUNNING_TTL
+from huey_multitenant.sources import get_mtime
+from huey_multitenant.supervisor import wait_process
+from huey_multitenant.zygote import ForkedProcess, Zygote
 
 
 MAX_SECONDS_RUNNING = 15 * 60   # 15 minutes
+MAKESCHEDULE_TIMEOUT = 5 * 60
+
+# Score of the earliest scheduled task, without transferring the task itself.
+NEXT_SCHEDULED_LUA = """
+local item = redis.call('zrange', KEYS[1], 0, 0, 'WITHSCORES')
+return item[2]
+"""
+
+# Take every consumer report of an instance (see ExecuteConsumer.send_report).
+POP_REPORTS_LUA = """
+local reports = redis.call('lrange', KEYS[1], 0, -1)
+redis.call('del', KEYS[1])
+return reports
+"""
+REPORT_KEY = 'huey.multitenant.report.%s'
+LIMITS_KEY = 'huey.multitenant.limits.%s'
 
 
 class HueyApplication(object):
@@ -28,46 +51,149 @@ class HueyApplication(object):
                  redis_host,
                  redis_port,
                  redis_prefix,
-                 use_python3=False):
+                 use_python3=False,
+                 pickle_protocol=0,
+                 compress_threshold=0,
+                 fork_server=False,
+                 redis_db=0,
+                 redis_socket=None,
+                 weight=1,
+                 min_consumers=0,
+                 max_consumers=0,
+                 priority=0,
+                 task_priorities=None):
         self._logger = logging.getLogger()
         self._logger.info('\nRegister App: %s\nWorker Type: %s\nWorkers: %s', name, worker_type, workers)
 
         self.storage = RedisStorage(
             name=redis_prefix,
-            host=redis_host,
-            port=redis_port)
+            connection_pool=get_connection_pool(redis_host, redis_port, redis_db, redis_socket))
+        self._next_scheduled = self.storage.conn.register_script(NEXT_SCHEDULED_LUA)
+        self._pop_reports = self.storage.conn.register_script(POP_REPORTS_LUA)
+        self._enqueue_periodic = self.storage.conn.register_script(ENQUEUE_PERIODIC_LUA)
+        self.periodic_key = PERIODIC_KEY % self.storage.name
+        self.report_key = REPORT_KEY % self.storage.name
+        self.limits_key = LIMITS_KEY % self.storage.name
         self.name = name
-        self.workers = workers
+        self.workers = int(workers)
         if worker_type in ['process', 'greenlet']:
             self.worker_type = worker_type
         else:
             self.worker_type = 'thread'
+        if weight <= 0:
+            raise ValueError('weight must be greater than 0')
+        self.weight = float(weight)
+        self.min_consumers = min_consumers
+        self.max_consumers = max_consumers
+        self.priority = priority
+        self.task_priorities = task_priorities or {}
         self.settings = settings
         self.python_path = python_path
         self.script_path = script_path
 
         self.periodic_tasks = []
         self.use_python3 = use_python3
-        self.load_periodic_tasks()
+        self.pickle_protocol = message_protocol(use_python3, pickle_protocol)
+        self.compress_threshold = compress_threshold
+        self.zygote = Zygote(self) if fork_server else None
+
+    def encode_message(self, task_data):
+        return encode_message(task_data, self.pickle_protocol, self.compress_threshold)
+
+    def task_priority(self, klass):
+        """
+        Priority of a task class: its own, or the one of the instance.
+        """
+        return self.task_priorities.get(klass, self.priority)
+
+    @property
+    def schedule_file(self):
+        return os.path.join(os.path.dirname(self.script_path), 'schedule.info')
+
+    def schedule_is_fresh(self):
+        """
+        Check if schedule.info was made with the same settings and none of
+        the sources it was made from (manage.py, settings and tasks modules)
+        changed since, so it can be reused without running makeschedule.
+        """
+        try:
+            with open(self.schedule_file, 'r') as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            return False
+
+        settings = None
+        sources = {}
+        for ln in lines:
+            if not ln.startswith('#! '):
+                continue
+            info = ln[3:].rstrip('\n').split(' ', 2)
+            if info[0] == 'settings' and len(info) > 1:
+                settings = info[1]
+            elif info[0] == 'source' and len(info) == 3:
+                try:
+                    sources[info[2]] = int(info[1])
+                except ValueError:
+                    # Made by an older makeschedule, with float mtimes.
+                    return False
+
+        if not sources:
+            # Made by an older makeschedule, without fingerprint.
+            return False
+        if self.settings is not None and settings != self.settings:
+            return False
+        for filename, mtime in sources.items():
+            try:
+                if get_mtime(filename) != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def make_schedule(self):
+        """
+        Run makeschedule and wait until it finishes.
+        """
+        process = self.execute_command('makeschedule')
+        try:
+            wait_process(process, MAKESCHEDULE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self._logger.error('[{}] makeschedule did not finish in {}s'.format(self.name, MAKESCHEDULE_TIMEOUT))
+            self.kill_process(process)
+            process.wait()
 
     def load_periodic_tasks(self):
         """
         This method read schedule.info file from the instance. At the same folder level that manage.py file.
+        The file is only made again when it is not fresh (see schedule_is_fresh).
 
-        :return:
+        :return: True if schedule.info was reused.
         """
-        schedule_process = self.execute_command('makeschedule')
-        while self.is_running(schedule_process):
-            time.sleep(0.5)
-
-        if os.path.isfile(os.path.join(os.path.dirname(self.script_path), 'schedule.info')):
+        start = time.time()
+        cached = self.schedule_is_fresh()
+        if not cached:
+            self.make_schedule()
+        self.read_schedule()
+        self._logger.info('[{}] {} periodic tasks loaded in {:.2f}s ({})'.format(
+            self.name, len(self.periodic_tasks), time.time() - start,
+            'cached' if cached else 'makeschedule'))
+        return cached
+
+    def read_schedule(self):
+        self.periodic_tasks = self.parse_schedule()
+
+    def parse_schedule(self):
+        """
+        :return: the periodic tasks of schedule.info.
+        """
+        periodic_tasks = []
+        if os.path.isfile(self.schedule_file):
             self._logger.debug('Schedule info created')
         else:
             self._logger.debug('Schedule info not found')
-            return
+            return periodic_tasks
 
-        info_file = os.path.join(os.path.dirname(self.script_path), 'schedule.info')
-        with open(info_file, 'r') as f:
+        with open(self.schedule_file, 'r') as f:
             lines = f.readlines()
 
         for ln in lines:
@@ -76,11 +202,12 @@ class HueyApplication(object):
                 continue
 
             info = ln.split()
-            if len(info) == 6:
+            if len(info) == 6 or (len(info) == 7 and info[6] in COALESCE_POLICIES):
                 self._logger.info('Added periodic method: %s', ln)
-                self.periodic_tasks.append({
+                periodic_tasks.append({
                     'method': info[5],
-                    'validate_datetime': crontab(
+                    'coalesce': info[6] if len(info) == 7 else COALESCE_NONE,
+                    'validate_datetime': CronEntry(
                         minute=info[0],
                         hour=info[1],
                         day_of_week=info[2],
@@ -90,14 +217,18 @@ class HueyApplication(object):
             elif len(info) > 1:
                 self._logger.info('Invalid cron line.')
 
-        if len(self.periodic_tasks) == 0:
+        if len(periodic_tasks) == 0:
             self._logger.info('No periodic task found')
+        return periodic_tasks
 
-    def get_pending_tasks(self):
+    def get_pending_tasks(self, limit):
         """
-        Returns list of pending tasks.
+        Returns the next `limit` pending tasks, in the order they will be
+        dequeued. Only the head of the queue is transferred.
         """
-        return self.storage.enqueued_items()
+        tasks = self.storage.conn.lrange(self.storage.queue_key, -limit, -1)
+        tasks.reverse()
+        return tasks
 
     def get_periodic_tasks(self, now):
         """
@@ -105,8 +236,55 @@ class HueyApplication(object):
         """
         return [task for task in self.periodic_tasks if task['validate_datetime'](now)]
 
-    def get_schedule(self, ts):
-        return self.storage.read_schedule(ts)
+    def get_schedule(self, ts, pipe=None):
+        """
+        Pop the scheduled tasks that are due at ts. With a pipeline the read is
+        only queued, its result comes from pipe.execute().
+        """
+        if pipe is None:
+            return self.storage.read_schedule(ts)
+        self.storage._pop(
+            keys=[self.storage.schedule_key],
+            args=[self.storage.convert_ts(ts)],
+            client=pipe)
+
+    def get_next_scheduled(self, pipe=None):
+        """
+        Returns the score (see RedisStorage.convert_ts) of the earliest
+        scheduled task, or None when the schedule is empty. With a pipeline the
+        read is only queued.
+        """
+        score = self._next_scheduled(keys=[self.storage.schedule_key], client=pipe)
+        if pipe is None and score is not None:
+            return float(score)
+        return score
+
+    def enqueue_periodic(self, klass, coalesce, task_id, message):
+        """
+        Enqueue a run of a coalesced periodic task, unless its previous run
+        is still pending (see huey_multitenant.periodic).
+
+        :return: True if it was enqueued.
+        """
+        return bool(self._enqueue_periodic(
+            keys=[self.periodic_key, self.storage.queue_key],
+            args=[klass, coalesce, task_id, time.time(), message, QUEUED_TTL, RUNNING_TTL]))
+
+    def pop_reports(self, pipe=None):
+        """
+        Take the reports of the consumers that finished since the last call.
+        With a pipeline the read is only queued.
+        """
+        return self._pop_reports(keys=[self.report_key], client=pipe)
+
+    def set_runtime_limits(self, limits, pipe):
+        """
+        Publish the runtime limit of every task class, read by the next
+        consumers (see ExecuteConsumer.read_limits).
+        """
+        pipe.delete(self.limits_key)
+        if limits:
+            pipe.hmset(self.limits_key, limits)
 
     def is_running(self, process):
         try:
@@ -120,15 +298,41 @@ class HueyApplication(object):
         return False
 
     def kill_process(self, process):
+        if process.pid is None:
+            # Not forked yet, it fails if the fork server does not answer.
+            return
         self._logger.error('[{}] kill_huey PID: {}'.format(self.name, process.pid))
         os.kill(process.pid, signal.SIGKILL)
 
-    def execute_command(self, command):
+    def stop(self):
+        if self.zygote is not None:
+            self.zygote.stop()
+
+    def run_consumer(self, workers=None):
         """
-        Execute manage.py command.
+        Start an execute_task consumer, forked from the fork server when it is
+        enabled and ready.
+
+        :param workers: workers of the consumer, by default the configured ones
+        :return: process running the consumer
+        """
+        workers = workers or self.workers
+        if self.zygote is not None:
+            process = self.zygote.fork(workers)
+            if process is not None:
+                return process
+
+        return self.execute_command(self.consumer_command(workers))
+
+    def consumer_command(self, workers):
+        return 'execute_task --no-periodic -k %s -w %s' % (self.worker_type, workers)
+
+    def build_command(self, command):
+        """
+        Build the manage.py command line.
 
         :param command: (str) command to be executed
-        :return: process id
+        :return: list of arguments
         """
         cmd = [self.python_path, self.script_path]
         if command:
@@ -136,6 +340,16 @@ class HueyApplication(object):
 
         if self.settings is not None:
             cmd.extend(['--settings', self.settings])
+        return cmd
+
+    def execute_command(self, command):
+        """
+        Execute manage.py command.
+
+        :param command: (str) command to be executed
+        :return: process id
+        """
+        cmd = self.build_command(command)
 
         self._logger.debug('[{}] Execute: {}'.format(self.name, cmd))
 
@@ -152,29 +366,26 @@ class HueyApplication(object):
 
 
 class HueyConsumer:
-    def __init__(self, instance, task_id):
+    def __init__(self, instance, task_id, workers=None):
         self.app = instance
         self.task_id = task_id
+        self.workers = workers or instance.workers
         self.process = None
-        self.start_at = datetime.datetime.now()
+        self.started = time.time()
         self.consume()
 
-    def is_running(self):
-        running = self.app.is_running(self.process)
-        if running:
-            if (datetime.datetime.now() - self.start_at).seconds > MAX_SECONDS_RUNNING:
-                self.start_at = datetime.datetime.now()
-                self.kill_consumer()
+    @property
+    def is_forked(self):
+        return isinstance(self.process, ForkedProcess)
 
-        return running
+    def is_running(self):
+        return self.app.is_running(self.process)
 
     def kill_consumer(self):
         self.app.kill_process(self.process)
 
     def consume(self):
-        run_cmd = 'execute_task --no-periodic -k %s -w %s' % (self.app.worker_type, self.app.workers)
-
-        self.process = self.app.execute_command(run_cmd)
+        self.process = self.app.run_consumer(self.workers)
 
         # Wait 10 seconds until send the sigint signal.
         # In that time the workers can handle more tasks
@@ -3,6 +3,8 @@
 import click
 import os
 
+from huey_multitenant.aio import AsyncDispatcher
+from huey_multitenant.cluster import Cluster
 from huey_multitenant.core import Dispatcher
 
 
@@ -11,10 +13,42 @@ from huey_multitenant.core import Dispatcher
 @click.option('--periodic', is_flag=True, help='Do you want to run periodic tasks ?')
 @click.option('--verbose', is_flag=True, help='Verbose logging (includes DEBUG statements)')
 @click.option('--logfile', default="", help='Redirect logs to file')
-def dispatcher_main(consumers, periodic, verbose, logfile):
+@click.option('--wake-on-work', is_flag=True, help='Wake up on queue and consumer events instead of polling')
+@click.option('--configure-notifications', is_flag=True,
+              help='Enable the keyspace notifications needed by --wake-on-work and --periodic on the Redis servers')
+@click.option('--reload', is_flag=True, help='Apply changes of the conf and schedule.info files without restarting')
+@click.option('--metrics-port', default=0, help='Serve Prometheus metrics on this local port (0 = disabled)')
+@click.option('--engine', type=click.Choice(['sync', 'asyncio']), default='sync',
+              help='Run the dispatcher and the scheduler on an asyncio loop')
+@click.option('--cluster-redis', default='', help='Share the tenants with other dispatchers (redis://host:port/db)')
+@click.option('--node-id', default='', help='Name of this dispatcher in the cluster (default host:pid)')
+@click.option('--min-free-memory', default=0,
+              help='Defer consumers that would leave less free memory than this, in MB (0 = disabled)')
+@click.option('--max-load', default=0.,
+              help='Defer consumers that would raise the load average above this (0 = disabled)')
+@click.option('--history-file', default='',
+              help='Keep the runtime history of the task classes in this file across restarts (default not kept)')
+@click.option('--dispatch-policy', type=click.Choice(['fair', 'sejf']), default='fair',
+              help='Weighted fair share, or shortest expected job first')
+@click.option('--reserved-slots', default=0, help='Consumers kept for tasks expected to take less than 1 second')
+@click.option('--runtime-limit-factor', default=0.,
+              help='Stop consumers running a task this many times longer than the 99th percentile of its class '
+                   '(0 = disabled)')
+@click.option('--periodic-jitter', default=0.,
+              help='Spread periodic tasks over this many seconds after the minute starts (0 = disabled, at most 55)')
+def dispatcher_main(consumers, periodic, verbose, logfile, wake_on_work, configure_notifications, reload, metrics_port,
+                    engine, cluster_redis, node_id, min_free_memory, max_load, history_file, dispatch_policy,
+                    reserved_slots, runtime_limit_factor, periodic_jitter):
 
-    conf_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf')
-    Dispatcher(conf_path, consumers, periodic, verbose, logfile)
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    conf_path = os.path.join(base_path, 'conf')
+    cluster = Cluster.from_url(cluster_redis, node_id or None) if cluster_redis else None
+    dispatcher_class = AsyncDispatcher if engine == 'asyncio' else Dispatcher
+    dispatcher_class(conf_path, consumers, periodic, verbose, logfile, wake_on_work=wake_on_work, reload=reload,
+                     metrics_port=metrics_port, cluster=cluster, min_free_memory=min_free_memory, max_load=max_load,
+                     history_file=os.path.abspath(history_file) if history_file else None,
+                     policy=dispatch_policy, reserved_slots=reserved_slots, runtime_limit_factor=runtime_limit_factor,
+                     periodic_jitter=periodic_jitter, configure_notifications=configure_notifications)
 
 
 if __name__ == '__main__':
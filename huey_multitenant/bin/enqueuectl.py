@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import sys
+import time
+
+import click
+
+from huey_multitenant.enqueue import BATCH_SIZE, BulkEnqueuer, load_tenants
+
+
+@click.command()
+@click.argument('tasks', type=click.File('r'), default='-')
+@click.option('--tenant', default='', help='Tenant of the tasks that do not name one')
+@click.option('--conf-path', default='', help='Folder of the tenant conf files (default conf, next to this file)')
+@click.option('--batch-size', default=BATCH_SIZE, help='Tasks sent to Redis in one round trip')
+def enqueue_main(tasks, tenant, conf_path, batch_size):
+    """
+    Enqueue the tasks of a file (or stdin), one JSON object per line:
+
+    \b
+        {"tenant": "django1", "task": "send_mail", "args": [1], "kwargs": {}, "delay": 60}
+
+    Optional keys: tenant, args, kwargs, eta (Unix time) or delay (seconds),
+    retries, retry_delay and id.
+    """
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
+    logger = logging.getLogger()
+
+    if not conf_path:
+        conf_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'conf')
+    start = time.time()
+    errors = 0
+    with BulkEnqueuer(load_tenants(conf_path), batch_size) as enqueuer:
+        for number, line in enumerate(tasks, 1):
+            if not line.strip():
+                continue
+            try:
+                task = json.loads(line)
+                enqueuer.add(task.get('tenant') or tenant, task['task'], task.get('args', ()), task.get('kwargs'),
+                             task.get('eta'), task.get('delay'), task.get('retries', 0), task.get('retry_delay', 0),
+                             task.get('id'))
+            except KeyError as e:
+                errors += 1
+                logger.error('Line %d: missing %s', number, e)
+            except (ValueError, TypeError, AttributeError) as e:
+                errors += 1
+                logger.error('Line %d: %s', number, e)
+
+    logger.info('%d tasks enqueued and %d scheduled in %.2fs, %d errors',
+                enqueuer.enqueued, enqueuer.scheduled, time.time() - start, errors)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    enqueue_main()
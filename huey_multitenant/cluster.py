@@ -0,0 +1,193 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import time
+
+import redis
+
+
+# Seconds between heartbeats, and between renewals of the leases.
+HEARTBEAT_INTERVAL = 2
+
+# Seconds a lease lasts without renewal. A node that stops sending heartbeats
+# for this long is considered dead and its tenants are taken over.
+LEASE_TTL = 10
+
+# Points of every node in the hash ring.
+RING_REPLICAS = 64
+
+NODES_KEY = 'huey.multitenant.cluster.nodes'
+LEASE_KEY = 'huey.multitenant.cluster.lease.%s'
+SCHEDULER_KEY = 'huey.multitenant.cluster.scheduler'
+
+# Extend a lease only while we still hold it.
+RENEW_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Take or renew the scheduler lease, only while the heartbeats of the node are
+# fresh: the scheduler may outlive its dispatcher when it runs in a process.
+LEAD_LUA = """
+local beat = redis.call('zscore', KEYS[2], ARGV[1])
+if not beat or tonumber(beat) < tonumber(ARGV[3]) then
+    return 0
+end
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+if redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2], 'NX') then
+    return 1
+end
+return 0
+"""
+
+# Give a lease back only while we still hold it.
+RELEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hashing of tenants over nodes: when a node joins or leaves,
+    only the tenants of that node move.
+    """
+
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self._ring = sorted((_hash('%s#%d' % (node, i)), node) for node in nodes for i in range(replicas))
+        self._hashes = [point for point, _ in self._ring]
+
+    def get(self, key):
+        if not self._ring:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class Cluster(object):
+    """
+    Dispatchers of several hosts sharing the same tenants.
+
+    Every node sends heartbeats to a coordination Redis. Tenants are spread
+    over the live nodes by consistent hashing, and a node only starts
+    consumers for the tenants it holds the lease of. Leases expire when not
+    renewed, so the tenants of a dead node are taken over by the others.
+    Periodic and delayed tasks are only scheduled by the node holding the
+    scheduler lease. Leadership is only checked once per heartbeat, so two
+    nodes may both schedule while the lease changes hands: periodic tasks
+    are enqueued at least once.
+    """
+
+    def __init__(self, conn, node_id=None, lease_ttl=LEASE_TTL):
+        self._logger = logging.getLogger()
+        self.conn = conn
+        self.node_id = node_id or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.lease_ttl = lease_ttl
+        self.nodes = []
+        self.leader = False
+        self._owned = set()
+        self._renewed_at = 0
+        self._lead_at = 0
+        self._renew = conn.register_script(RENEW_LUA)
+        self._release = conn.register_script(RELEASE_LUA)
+        self._lead = conn.register_script(LEAD_LUA)
+
+    @classmethod
+    def from_url(cls, url, node_id=None):
+        return cls(redis.StrictRedis.from_url(url), node_id)
+
+    def owned(self):
+        """
+        Names of the tenants this node holds the lease of, none when the
+        leases could not be renewed in time, as others may have taken them.
+        """
+        if time.time() - self._renewed_at > self.lease_ttl:
+            return set()
+        return self._owned
+
+    def heartbeat(self, tenants):
+        """
+        Register this node, renew its leases, take the leases of the tenants
+        that hash to it and give back the others.
+
+        :param tenants: names of every tenant.
+        :return: True if the owned tenants changed.
+        """
+        now = time.time()
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.zadd(NODES_KEY, now, self.node_id)
+        pipe.zremrangebyscore(NODES_KEY, '-inf', now - self.lease_ttl)
+        pipe.zrange(NODES_KEY, 0, -1)
+        nodes = sorted(node.decode('utf-8') for node in pipe.execute()[2])
+        if nodes != self.nodes:
+            self._logger.info('Cluster nodes: %s', ', '.join(nodes))
+            self.nodes = nodes
+
+        ring = HashRing(nodes)
+        wanted = set(tenant for tenant in tenants if ring.get(tenant) == self.node_id)
+        ttl = int(self.lease_ttl * 1000)
+        held = sorted(self._owned)
+        taken = sorted(wanted - self._owned)
+        pipe = self.conn.pipeline(transaction=False)
+        for tenant in held:
+            if tenant in wanted:
+                self._renew(keys=[LEASE_KEY % tenant], args=[self.node_id, ttl], client=pipe)
+            else:
+                self._release(keys=[LEASE_KEY % tenant], args=[self.node_id], client=pipe)
+        for tenant in taken:
+            pipe.set(LEASE_KEY % tenant, self.node_id, px=ttl, nx=True)
+        results = pipe.execute()
+
+        owned = set()
+        for tenant, result in zip(held + taken, results):
+            if tenant in wanted and result:
+                owned.add(tenant)
+        for tenant in sorted(owned - self._owned):
+            self._logger.info('[%s] Lease taken by %s', tenant, self.node_id)
+        for tenant in sorted(self._owned - owned):
+            self._logger.info('[%s] Lease given back by %s', tenant, self.node_id)
+
+        changed = owned != self._owned
+        self._owned = owned
+        self._renewed_at = now
+        return changed
+
+    def lead(self):
+        """
+        Take or renew the scheduler lease, at most once per heartbeat.
+
+        :return: True if this node must run the scheduler.
+        """
+        now = time.time()
+        if now < self._lead_at:
+            return self.leader
+        self._lead_at = now + HEARTBEAT_INTERVAL
+        self.leader = bool(self._lead(
+            keys=[SCHEDULER_KEY, NODES_KEY], args=[self.node_id, int(self.lease_ttl * 1000), now - self.lease_ttl]))
+        return self.leader
+
+    def leave(self):
+        """
+        Give back every lease and unregister the node, so the others take
+        over right away.
+        """
+        pipe = self.conn.pipeline(transaction=False)
+        for tenant in self._owned:
+            self._release(keys=[LEASE_KEY % tenant], args=[self.node_id], client=pipe)
+        self._release(keys=[SCHEDULER_KEY], args=[self.node_id], client=pipe)
+        pipe.zrem(NODES_KEY, self.node_id)
+        pipe.execute()
+        self._owned = set()
+        self.leader = False
@@ -0,0 +1,43 @@
+import threading
+
+import redis
+
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def get_connection_pool(host='localhost', port=6379, db=0, unix_socket_path=None):
+    """
+    Return the connection pool of a Redis server, shared by every tenant that
+    lives in it (tenants only differ by their key prefix).
+    """
+    if unix_socket_path:
+        key = (unix_socket_path, None, int(db))
+    else:
+        key = (host, int(port), int(db))
+
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None:
+            if unix_socket_path:
+                pool = redis.ConnectionPool(
+                    connection_class=redis.UnixDomainSocketConnection,
+                    path=unix_socket_path,
+                    db=int(db))
+            else:
+                pool = redis.ConnectionPool(host=host, port=int(port), db=int(db))
+            _pools[key] = pool
+    return pool
+
+
+def group_by_server(instances):
+    """
+    Group instances by the Redis server they live in.
+
+    :return: list of instance lists, one per connection pool.
+    """
+    servers = {}
+    for instance in instances:
+        servers.setdefault(id(instance.storage.pool), []).append(instance)
+    return list(servers.values())
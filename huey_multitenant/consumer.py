@@ -2,21 +2,265 @@ from __future__ import unicode_literals, absolute_import
 
 from django.conf import settings
 from django.utils.module_loading import import_string
-from huey.consumer import Consumer, EVENT_FINISHED, EVENT_STARTED
+from huey.consumer import Consumer, ProcessEnvironment, Worker
 from huey.exceptions import ConfigurationError
-from time import sleep
-from datetime import timedelta, datetime
+from datetime import datetime
+import errno
+import fcntl
+import itertools
+import logging
+import multiprocessing
 import os
-from json import loads
+import random
+import select
+import signal
+import threading
+import time
+from json import dumps
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty  # ver. < 3.0
+
+from huey_multitenant.history import duration_bucket
+from huey_multitenant.periodic import FINISH_PERIODIC_LUA, PERIODIC_KEY, PERIODIC_TASK_PREFIX, START_PERIODIC_LUA
+from huey_multitenant.sources import get_mtime, get_project_sources
 
 WORKER_IDLE_TIMEOUT = 1.
 WORKER_DEFAULT_TIMEOUT = 20.
+WORKER_MAX_IDLE_TIMEOUT = 5.
+# The idle window is this many times the average time between tasks.
+IDLE_WINDOW_FACTOR = 2.
+ARRIVAL_SMOOTHING = 0.3
+# The dispatcher reads what every consumer did from this list.
+REPORT_KEY = 'huey.multitenant.report.%s'
+REPORT_MAX_LENGTH = 100
+REPORT_TTL = 60 * 60
+# Runtime limit of every task class, set by the dispatcher from its history.
+LIMITS_KEY = 'huey.multitenant.limits.%s'
+RECYCLE_CHECK_INTERVAL = 5.
+
+
+class WorkerTracker(object):
+    """
+    State of the workers of a consumer, kept in memory shared with them:
+    tasks running and finished, seconds spent running them, when the last one
+    finished, the moving average of the time between tasks and when the task
+    of every worker runs over its limit. The duration of every task is passed
+    on with its class.
+
+    Workers signal every change, so the consumer waits for it instead of
+    polling, and the consumer wakes the idle workers when it sees queued work.
+    The primitives come from the worker environment, they work with threads,
+    greenlets and processes.
+    """
+    WORKING, FINISHED, BUSY, LAST_FINISHED, ARRIVAL, QUEUED = range(6)
+
+    def __init__(self, environment, arrival, workers=1):
+        self._changed = environment.get_stop_flag()
+        self._work = environment.get_stop_flag()
+        if isinstance(environment, ProcessEnvironment):
+            self._lock = multiprocessing.Lock()
+            self._state = multiprocessing.Array('d', 6, lock=False)
+            self._deadlines = multiprocessing.Array('d', workers, lock=False)
+            self._durations = multiprocessing.Queue()
+        else:
+            self._lock = threading.Lock()
+            self._state = [0.] * 6
+            self._deadlines = [0.] * workers
+            self._durations = None
+        self._state[self.LAST_FINISHED] = time.time()
+        self._state[self.ARRIVAL] = arrival
+        self._classes = {}
+
+    def started(self, worker=0, deadline=0.):
+        state = self._state
+        with self._lock:
+            if state[self.FINISHED] and not state[self.WORKING]:
+                gap = time.time() - state[self.LAST_FINISHED]
+                state[self.ARRIVAL] += ARRIVAL_SMOOTHING * (gap - state[self.ARRIVAL])
+            state[self.WORKING] += 1
+            self._deadlines[worker] = deadline
+        self._changed.set()
+
+    def finished(self, duration, worker=0, klass=None):
+        state = self._state
+        with self._lock:
+            state[self.WORKING] = max(state[self.WORKING] - 1, 0)
+            state[self.FINISHED] += 1
+            state[self.BUSY] += duration
+            state[self.LAST_FINISHED] = time.time()
+            self._deadlines[worker] = 0.
+            if klass is not None and self._durations is None:
+                self._add_duration(klass, duration)
+        if klass is not None and self._durations is not None:
+            self._durations.put((klass, duration))
+        self._changed.set()
+
+    def _add_duration(self, klass, duration):
+        tasks, busy, buckets = self._classes.get(klass, (0, 0., {}))
+        bucket = duration_bucket(duration)
+        buckets[bucket] = buckets.get(bucket, 0) + 1
+        self._classes[klass] = (tasks + 1, busy + duration, buckets)
+
+    def classes(self):
+        """
+        :return: dict task class -> (tasks, seconds, durations by sketch bucket)
+        """
+        if self._durations is not None:
+            while True:
+                try:
+                    klass, duration = self._durations.get_nowait()
+                except Empty:
+                    break
+                self._add_duration(klass, duration)
+        return self._classes
+
+    def overdue_at(self):
+        """
+        :return: when the first running task goes over its limit, 0 if none has one.
+        """
+        with self._lock:
+            deadlines = [deadline for deadline in self._deadlines[:] if deadline]
+        return min(deadlines) if deadlines else 0.
+
+    def snapshot(self):
+        """
+        :return: (working, finished, busy, last_finished, arrival)
+        """
+        self._changed.clear()
+        # Durations of process workers go through a pipe, keep it drained.
+        self.classes()
+        with self._lock:
+            working, finished, busy, last_finished, arrival = self._state[:self.QUEUED]
+        return int(working), int(finished), busy, last_finished, arrival
+
+    def wait(self, timeout):
+        """
+        Block until a worker signals a change or timeout seconds pass. Changes
+        since the last snapshot() return right away.
+        """
+        if timeout > 0:
+            self._changed.wait(timeout)
+
+    def queued(self):
+        """
+        :return: how many times the consumer saw queued work.
+        """
+        return self._state[self.QUEUED]
+
+    def work_queued(self):
+        """
+        Wake the workers sleeping between two empty reads of the queue, the
+        consumer saw work in it.
+        """
+        with self._lock:
+            self._state[self.QUEUED] += 1
+        self._work.set()
+        self._work.clear()
+
+    def stopping(self):
+        """
+        Wake the sleeping workers for good, the consumer stops.
+        """
+        self._work.set()
+
+    def wait_work(self, timeout):
+        """
+        Block until the consumer sees queued work or stops, or timeout seconds
+        pass.
+        """
+        self._work.wait(timeout)
+
+
+class TrackedWorker(Worker):
+    """
+    Worker that signals the tasks it runs to a WorkerTracker, and the runs of
+    coalesced periodic tasks to the scheduler (see huey_multitenant.periodic).
+    """
+
+    def __init__(self, tracker, index=0, limits=None, *args, **kwargs):
+        self.tracker = tracker
+        self.index = index
+        self.limits = limits or {}
+        super(TrackedWorker, self).__init__(*args, **kwargs)
+        self.periodic_key = PERIODIC_KEY % self.huey.storage.name
+        self._start_periodic = self.huey.storage.conn.register_script(START_PERIODIC_LUA)
+        self._finish_periodic = self.huey.storage.conn.register_script(FINISH_PERIODIC_LUA)
+
+    def process_task(self, task, ts):
+        klass = type(task).__name__
+        periodic = (task.task_id or '').startswith(PERIODIC_TASK_PREFIX)
+        if periodic:
+            self.track_periodic(self._start_periodic, [klass, task.task_id, time.time()])
+        start = time.time()
+        limit = self.limits.get(klass)
+        self.tracker.started(self.index, start + limit if limit else 0.)
+        try:
+            super(TrackedWorker, self).process_task(task, ts)
+        finally:
+            self.tracker.finished(time.time() - start, self.index, klass)
+            if periodic:
+                self.track_periodic(self._finish_periodic, [klass, task.task_id])
+
+    def track_periodic(self, script, args):
+        try:
+            script(keys=[self.periodic_key], args=args)
+        except Exception:
+            self._logger.exception('Unable to track periodic task %s', args[1])
+
+    def sleep(self):
+        # Same backoff as Worker.sleep, but stop waiting as soon as the
+        # consumer stops, and start over when the consumer sees queued work.
+        if self.delay > self.max_delay:
+            self.delay = self.max_delay
+
+        self._logger.debug('No messages, sleeping for: %s', self.delay)
+        queued = self.tracker.queued()
+        self.tracker.wait_work(self.delay)
+        if self.tracker.queued() != queued:
+            self.delay = self.default_delay
+        else:
+            self.delay *= self.backoff
+
 
 class ExecuteConsumer(Consumer):
     """
     This consumer execute one task and die. Doesn't loads any Scheduler.
     """
 
+    def __init__(self, huey, **kwargs):
+        # Consumer.__init__ creates the workers, they need the tracker.
+        self.tracker = WorkerTracker(
+            self.get_environment(kwargs.get('worker_type', 'thread')),
+            arrival=WORKER_IDLE_TIMEOUT,
+            workers=kwargs.get('workers', 1))
+        self.limits = self.read_limits(huey)
+        self._worker_index = itertools.count()
+        super(ExecuteConsumer, self).__init__(huey, **kwargs)
+
+    def read_limits(self, huey):
+        """
+        Runtime limit of every task class, in seconds.
+        """
+        try:
+            limits = huey.storage.conn.hgetall(LIMITS_KEY % huey.storage.name)
+            return dict((klass.decode('utf-8'), float(limit)) for klass, limit in limits.items())
+        except Exception:
+            logging.getLogger('huey.consumer').exception('Unable to read the runtime limits')
+            return {}
+
+    def _create_worker(self):
+        return TrackedWorker(
+            tracker=self.tracker,
+            index=next(self._worker_index),
+            limits=self.limits,
+            huey=self.huey,
+            default_delay=self.default_delay,
+            max_delay=self.max_delay,
+            backoff=self.backoff,
+            utc=self.utc)
+
     def _create_process(self, process, name):
         if process is None:
             return None
@@ -57,51 +301,88 @@ class ExecuteConsumer(Consumer):
                 self._logger.info('MaintenanceMode is on, stopping consumer')
                 exit(0)
 
-    def _stop_when_idle(self, start_time, idle_timeout, timeout):
+    def _stop_when_idle(self, start_time, idle_timeout, timeout, max_idle_timeout=None, max_tasks=None):
         """
         Stops the workers as soon as they are idle.
-        With a maximum of timeout seconds
-        """
+        With a maximum of timeout seconds, or max_tasks finished tasks.
 
-        last_finished = datetime.utcnow()
-        working = False
+        The idle window follows the time tasks take to arrive (IDLE_WINDOW_FACTOR
+        times its moving average), between idle_timeout and max_idle_timeout
+        seconds, so under sustained load one consumer drains many tasks. The
+        consumer also keeps going while the queue is not empty. It stops right
+        away when a task runs over the limit of its class.
 
-        def has_timed_out():
-            self._logger.debug("Checking total time")
-            return datetime.utcnow() > (start_time + timedelta(seconds=timeout))
-        
-        def is_idle():
-            self._logger.debug("Checking idle time")
-            return (datetime.utcnow() > (last_finished + timedelta(seconds=idle_timeout))) and not working
+        :return: (tasks finished, seconds spent running them)
+        """
+        if max_idle_timeout is None:
+            max_idle_timeout = idle_timeout
+        deadline = time.time() + timeout - (datetime.utcnow() - start_time).total_seconds()
+        lingered = 0
 
-        listener = self.huey.storage.listener()
+        def has_pending():
+            try:
+                return self.huey.storage.queue_size() > 0
+            except Exception:
+                self._logger.exception('Unable to read the queue size')
+                return False
 
         while True:
-            message = listener.get_message(ignore_subscribe_messages=True, timeout=0.5)
-            if message:
-                event = loads(message['data'].decode('utf-8'))
-                self._logger.debug("Got event from worker: {}".format(event))
-                if event and 'status' in event:
-                    if event['status'] == EVENT_FINISHED:
-                        last_finished = datetime.utcnow()
-                        working = False
-                    elif event['status'] == EVENT_STARTED:
-                        working = True
-                    else:
-                        # We may need to handle extra messages differently
-                        working = False
-
-            if has_timed_out() or is_idle():
+            working, finished, busy, last_finished, arrival = self.tracker.snapshot()
+            now = time.time()
+
+            overdue_at = self.tracker.overdue_at()
+            if overdue_at and now >= overdue_at:
+                self._logger.error('A task ran over the runtime limit of its class, stopping consumer')
+                self._kill_workers()
+                return finished, busy
+
+            if now >= deadline:
                 self._stop_worker()
-                return
-            
+                return finished, busy
+
+            if max_tasks and finished >= max_tasks and not working:
+                self._logger.info('Finished %d tasks, stopping consumer', finished)
+                self._stop_worker()
+                return finished, busy
+
+            window = min(max(IDLE_WINDOW_FACTOR * arrival, idle_timeout), max_idle_timeout)
+            idle_at = max(last_finished, lingered) + window
+            if not working and now >= idle_at:
+                if has_pending():
+                    # More work is queued, wait for it another idle window,
+                    # and don't let the workers back off from it.
+                    lingered = now
+                    self.tracker.work_queued()
+                    continue
+                self._stop_worker()
+                return finished, busy
+
+            wait_until = deadline if working else min(deadline, idle_at)
+            if overdue_at:
+                wait_until = min(wait_until, overdue_at)
+            self.tracker.wait(wait_until - now)
+
+    def stop(self, graceful=False):
+        self.tracker.stopping()
+        super(ExecuteConsumer, self).stop(graceful)
 
     def _stop_worker(self):
         self._logger.debug('Sending stop signal to workers')
         self.stop_flag.set()
+        self.tracker.stopping()
         for _, worker_process in self.worker_threads:
             worker_process.join()
-        
+
+    def _kill_workers(self):
+        """
+        Stop without waiting for the running tasks. Thread and greenlet
+        workers die with the consumer.
+        """
+        self.stop_flag.set()
+        self.tracker.stopping()
+        for _, worker_process in self.worker_threads:
+            if hasattr(worker_process, 'terminate'):
+                worker_process.terminate()
 
     def run(self):
         """
@@ -114,9 +395,194 @@ class ExecuteConsumer(Consumer):
         self.start()
 
         worker_timeout = getattr(settings, 'HUEY_WORKER_TIMEOUT', WORKER_DEFAULT_TIMEOUT)
+        max_idle_timeout = getattr(settings, 'HUEY_WORKER_MAX_IDLE_TIMEOUT', WORKER_MAX_IDLE_TIMEOUT)
+        max_tasks = getattr(settings, 'HUEY_WORKER_MAX_TASKS', None)
 
-        self._stop_when_idle(start_time, idle_timeout=WORKER_IDLE_TIMEOUT, timeout=worker_timeout)
+        finished, busy = self._stop_when_idle(
+            start_time, idle_timeout=WORKER_IDLE_TIMEOUT, timeout=worker_timeout,
+            max_idle_timeout=max_idle_timeout, max_tasks=max_tasks)
 
         total_seconds = (datetime.utcnow() - start_time).total_seconds()
         self._logger.info('Stop consumer. %s seconds' % total_seconds)
+        self.send_report(finished, busy, total_seconds)
         exit(0)
+
+    def send_report(self, tasks, busy, total_seconds):
+        """
+        Tell the dispatcher how many tasks this consumer ran and how long they
+        took, so it can size the next consumers.
+        """
+        key = REPORT_KEY % self.huey.storage.name
+        report = {'tasks': tasks, 'busy': busy, 'seconds': total_seconds, 'workers': self.workers}
+        classes = self.tracker.classes()
+        if classes:
+            report['classes'] = classes
+        report = dumps(report)
+        try:
+            pipe = self.huey.storage.conn.pipeline()
+            pipe.lpush(key, report)
+            pipe.ltrim(key, 0, REPORT_MAX_LENGTH - 1)
+            pipe.expire(key, REPORT_TTL)
+            pipe.execute()
+        except Exception:
+            self._logger.exception('Unable to send consumer report')
+
+
+class ForkServer(object):
+    """
+    Keeps the application loaded and forks an ExecuteConsumer every time the
+    dispatcher asks for one, so consumers skip the interpreter and Django
+    startup.
+
+    Protocol, one line per message:
+    - dispatcher -> server: ``fork <workers>``, ``stop``
+    - server -> dispatcher: ``ready <pid>``, ``forked <pid>``,
+      ``exit <pid> <returncode>``, ``recycle``
+    """
+
+    def __init__(self, huey, config, control_fd, status_fd):
+        self._logger = logging.getLogger('huey.consumer.ForkServer')
+        self.huey = huey
+        self.config = config
+        self.control_fd = control_fd
+        self.status_fd = status_fd
+        self.children = set()
+        self._buffer = b''
+        self._sources = get_project_sources()
+        self._checked_at = time.time()
+
+    def has_changed(self):
+        self._checked_at = time.time()
+        for filename, mtime in self._sources.items():
+            try:
+                if get_mtime(filename) != mtime:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def _send(self, message):
+        os.write(self.status_fd, (message + '\n').encode('ascii'))
+
+    def _read_commands(self):
+        data = os.read(self.control_fd, 4096)
+        if not data:
+            return None
+        self._buffer += data
+        lines = self._buffer.split(b'\n')
+        self._buffer = lines.pop()
+        return [line.decode('ascii').split() for line in lines if line]
+
+    def _close_connections(self):
+        """
+        Close every connection before forking, children must open their own.
+        """
+        from django.core.cache import caches
+        from django.db import connections
+
+        for connection in connections.all():
+            connection.close()
+        for cache in caches.all():
+            cache.close()
+        self.huey.storage.pool.disconnect()
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno != errno.ECHILD:
+                    raise
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            self.children.discard(pid)
+            if os.WIFSIGNALED(status):
+                returncode = -os.WTERMSIG(status)
+            else:
+                returncode = os.WEXITSTATUS(status)
+            self._send('exit %d %d' % (pid, returncode))
+
+    def _run_child(self, workers):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        for fd in (self.control_fd, self.status_fd) + self._wakeup:
+            os.close(fd)
+        random.seed()
+
+        config = self.config
+        if workers:
+            config = config._replace(workers=workers)
+        consumer = ExecuteConsumer(self.huey, **config.values)
+        consumer.run()
+
+    def fork(self, workers=None):
+        if self.has_changed():
+            self._logger.info('Code changed, recycling fork server')
+            self._send('recycle')
+            return False
+
+        self._close_connections()
+        pid = os.fork()
+        if pid == 0:
+            returncode = 1
+            try:
+                self._run_child(workers)
+                returncode = 0
+            except SystemExit as exc:
+                returncode = exc.code if isinstance(exc.code, int) else 0
+            except Exception:
+                self._logger.exception('Forked consumer died!')
+            finally:
+                os._exit(returncode)
+
+        self.children.add(pid)
+        self._send('forked %d' % pid)
+        return True
+
+    def run(self):
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self._wakeup[1])
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        self._logger.info('Fork server ready, PID %s', os.getpid())
+        self._send('ready %d' % os.getpid())
+
+        while True:
+            try:
+                readable, _, _ = select.select(
+                    [self.control_fd, self._wakeup[0]], [], [], RECYCLE_CHECK_INTERVAL)
+            except (select.error, OSError) as exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+                readable = []
+
+            if self._wakeup[0] in readable:
+                try:
+                    while os.read(self._wakeup[0], 512):
+                        pass
+                except OSError:
+                    pass
+            self._reap()
+
+            if self.control_fd in readable:
+                commands = self._read_commands()
+                if commands is None:
+                    self._logger.info('Dispatcher went away, stopping fork server')
+                    return
+                for command in commands:
+                    if command[0] == 'stop':
+                        return
+                    elif command[0] == 'fork':
+                        workers = int(command[1]) if len(command) > 1 else None
+                        if not self.fork(workers):
+                            return
+
+            if time.time() - self._checked_at >= RECYCLE_CHECK_INTERVAL and self.has_changed():
+                self._logger.info('Code changed, recycling fork server')
+                self._send('recycle')
+                return
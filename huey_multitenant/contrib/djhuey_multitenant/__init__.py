@@ -1,16 +1,20 @@
 import inspect
 from huey.contrib.djhuey import db_periodic_task
 from huey.api import crontab
+from huey_multitenant.periodic import COALESCE_NONE, COALESCE_POLICIES
 from huey_multitenant.registry import registry
 
 class PeriodicTask(object):
 
-    def __init__(self, minute='*', hour='*', day_of_week='*', day='*', month='*'):
+    def __init__(self, minute='*', hour='*', day_of_week='*', day='*', month='*', coalesce=COALESCE_NONE):
+        if coalesce not in COALESCE_POLICIES:
+            raise ValueError('coalesce must be one of {}'.format(', '.join(COALESCE_POLICIES)))
         self.minute = minute
         self.hour = hour
         self.day_of_week = day_of_week
         self.day = day
         self.month = month
+        self.coalesce = coalesce
 
     def __call__(self, f):
         registry.register(
@@ -19,7 +23,8 @@ class PeriodicTask(object):
             hour = self.hour,
             day_of_week = self.day_of_week,
             day = self.day,
-            month = self.month
+            month = self.month,
+            coalesce = self.coalesce
         )
         def wrapped_f(*args, **kwargs):
             return db_periodic_task(crontab(
@@ -39,9 +39,11 @@ class Command(BaseCommand):
                 kwargs.setdefault('default', None)
                 parser.add_argument(full, short, **kwargs)
 
-    def handle(self, *args, **options):
-        from huey.contrib.djhuey import HUEY
-
+    def get_consumer_config(self, options):
+        """
+        Build the consumer config from settings.HUEY and the command options.
+        Task modules are discovered here, so the config is ready to run.
+        """
         consumer_options = {}
         try:
             if isinstance(settings.HUEY, dict):
@@ -57,13 +59,18 @@ class Command(BaseCommand):
                                     consumer_options.pop('huey_verbose', None))
         autodiscover_modules("tasks")
 
-        consumer_options['workers'] = 1
         consumer_options['periodic'] = False
         consumer_options['check_worker_health'] = False
 
         config = ConsumerConfig(**consumer_options)
         config.validate()
         config.setup_logger()
+        return config
+
+    def handle(self, *args, **options):
+        from huey.contrib.djhuey import HUEY
+
+        config = self.get_consumer_config(options)
 
         consumer = ExecuteConsumer(HUEY, **config.values)
         consumer.run()
@@ -0,0 +1,30 @@
+import logging
+
+from huey_multitenant.consumer import ForkServer
+from huey_multitenant.contrib.djhuey_multitenant.management.commands.execute_task import Command as ExecuteTaskCommand
+
+logger = logging.getLogger(__name__)
+
+
+class Command(ExecuteTaskCommand):
+    """
+    Fork server for execute_task consumers. Started by the dispatcher, it
+    loads settings and task modules once and then forks a consumer for every
+    request received through the control pipe.
+    """
+    help = "Preload the application and fork execute_task consumers on request."
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--control-fd', type=int, required=True)
+        parser.add_argument('--status-fd', type=int, required=True)
+
+    def handle(self, *args, **options):
+        from huey.contrib.djhuey import HUEY
+
+        control_fd = options.pop('control_fd')
+        status_fd = options.pop('status_fd')
+        config = self.get_consumer_config(options)
+
+        server = ForkServer(HUEY, config, control_fd, status_fd)
+        server.run()
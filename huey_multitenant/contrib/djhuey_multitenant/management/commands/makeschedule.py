@@ -2,9 +2,12 @@ import logging
 import os
 import sys
 
+from django.apps import apps
+from django.conf import settings
 from django.utils.module_loading import autodiscover_modules
 from django.core.management.base import BaseCommand
 from huey_multitenant.registry import registry
+from huey_multitenant.sources import get_project_sources
 
 logger = logging.getLogger(__name__)
 
@@ -15,10 +18,13 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         autodiscover_modules("tasks")
         logger.info('Discovering Periodic Tasks:')
-        with open(os.path.join(os.path.dirname(sys.argv[0]), 'schedule.info'), 'w') as f:
+        info_file = os.path.join(os.path.dirname(sys.argv[0]), 'schedule.info')
+        # Write to a temporary file first, so the dispatcher never reads a
+        # half written schedule.
+        with open(info_file + '.tmp', 'w') as f:
             f.write("""# Autogenerated schedule info file. Don't touch this file directly, instead configure your decorated task.
 # Format:
-#   minute | hour | day_of_week | day | month | method
+#   minute | hour | day_of_week | day | month | method [| coalesce]
 # For day-of-week, 0=Sunday and 6=Saturday.
 # Acceptable inputs:
 #    * = every distinct value
@@ -26,11 +32,26 @@ class Command(BaseCommand):
 #    m-n = run every time m..n
 #    m,n = run on m and n
 #\n""")
+            self.write_fingerprint(f)
             for task in registry.get_periodic_tasks():
                 logger.info('+ {}'.format(task['task']))
                 f.write(registry.task_cron(task))
+        os.rename(info_file + '.tmp', info_file)
 
         sys.exit(0)
 
-
-
+    def write_fingerprint(self, f):
+        """
+        Record the settings and the sources the schedule was made from, the
+        dispatcher reuses this file while none of them change.
+        """
+        task_modules = [sys.modules[app_config.name + '.tasks'] for app_config in apps.get_app_configs()
+                        if sys.modules.get(app_config.name + '.tasks') is not None]
+        settings_module = sys.modules.get(settings.SETTINGS_MODULE)
+        if settings_module is not None:
+            task_modules.append(settings_module)
+
+        f.write('#! settings {}\n'.format(settings.SETTINGS_MODULE))
+        for filename, mtime in sorted(get_project_sources(task_modules).items()):
+            f.write('#! source {} {}\n'.format(mtime, filename))
+        f.write('#\n')
@@ -1,59 +1,231 @@
+from concurrent.futures import as_completed
 from concurrent.futures.thread import ThreadPoolExecutor
 from configparser import ConfigParser
 import logging
 import os
-import pickle
 import sys
 import time
 from logging.handlers import RotatingFileHandler
 
-from huey.consumer import ProcessEnvironment
+from huey.consumer import ProcessEnvironment, ThreadEnvironment
+from redis.exceptions import RedisError
 
-from huey_multitenant.application import HueyApplication, HueyConsumer
+from huey_multitenant.admission import SAMPLE_INTERVAL, AdmissionControl
+from huey_multitenant.application import MAX_SECONDS_RUNNING, HueyApplication, HueyConsumer
+from huey_multitenant.cluster import HEARTBEAT_INTERVAL
+from huey_multitenant.connections import group_by_server
+from huey_multitenant.fairshare import FairShare
+from huey_multitenant.history import RuntimeHistory
+from huey_multitenant.message import read_header
+from huey_multitenant.metrics import CONSUMER_LIFETIME, CONSUMER_TASKS, CONSUMERS, CONSUMERS_STARTED, \
+    DISPATCH_LATENCY, QUEUE_DEPTH, REGISTRY, SPAWN_SECONDS, start_metrics_server
+from huey_multitenant.reloader import FileWatcher
 from huey_multitenant.scheduler import Scheduler
+from huey_multitenant.sizing import ConsumerSizing
+from huey_multitenant.supervisor import Supervisor
+from huey_multitenant.table import ConsumerTable
+from huey_multitenant.wakeup import QueueWatcher, Waker, configure_notifications
+
+
+# Safety net when waking on work: queues are still checked at least this
+# often, in case a notification is missed.
+WAKE_TIMEOUT = 5
+
+# How often conf and schedule.info files are checked for changes.
+RELOAD_INTERVAL = 5
+
+# How often queue depths are read for the metrics while there are no free
+# consumers (they are read anyway when looking for work).
+METRICS_INTERVAL = 5
+
+# Tasks expected to run for less than this many seconds may take the slots
+# reserved for short tasks.
+SHORT_TASK_DURATION = 1.
+
+# Runtime limits derived from the history are never shorter than this.
+MIN_RUNTIME_LIMIT = 60
+
+# A pending task gains one priority level every this many seconds, up to the
+# highest priority pending, so low priorities are not starved.
+PRIORITY_AGING = 30
+
+# Settings applied to a running instance, without creating it again.
+TUNABLE_SETTINGS = ('weight', 'min_consumers', 'max_consumers', 'workers', 'priority', 'task_priorities')
+
+
+def parse_task_priorities(value):
+    """
+    :param value: ``klass:priority`` pairs separated by commas
+    :return: dict task class -> priority
+    """
+    priorities = {}
+    for item in value.split(','):
+        if item.strip():
+            klass, priority = item.rsplit(':', 1)
+            priorities[klass.strip()] = int(priority)
+    return priorities
+
+
+def read_conf(path):
+    """
+    Read the HueyApplication arguments from a conf file.
+
+    :return: dict of arguments, None if the file has no section.
+    """
+    settings = None
+    parser = ConfigParser()
+    parser["DEFAULT"] = {
+        'workers': '1',
+        'worker-type': 'thread',
+        'redis_host': 'localhost',
+        'redis_port': '6379',
+        'redis_db': '0',
+        'redis_socket': '',
+        'use_python3': 'false',
+        'pickle_protocol': '0',
+        'compress_threshold': '0',
+        'fork_server': 'false',
+        'weight': '1',
+        'min_consumers': '0',
+        'max_consumers': '0',
+        'priority': '0',
+        'task_priorities': ''
+    }
+    parser.read(path)
+    for section in parser.sections():
+        settings = dict(
+            name=parser.get(section, 'redis_prefix'),
+            python_path=parser.get(section, 'python'),
+            script_path=parser.get(section, 'script'),
+            workers=parser.get(section, 'workers'),
+            worker_type=parser.get(section, 'worker-type'),
+            settings=parser.get(section, 'settings'),
+            redis_host=parser.get(section, 'redis_host'),
+            redis_port=parser.get(section, 'redis_port'),
+            redis_prefix=parser.get(section, 'redis_prefix') or section,
+            redis_db=parser.getint(section, 'redis_db'),
+            redis_socket=parser.get(section, 'redis_socket') or None,
+            weight=parser.getfloat(section, 'weight'),
+            min_consumers=parser.getint(section, 'min_consumers'),
+            max_consumers=parser.getint(section, 'max_consumers'),
+            priority=parser.getint(section, 'priority'),
+            task_priorities=parse_task_priorities(parser.get(section, 'task_priorities')),
+            use_python3=parser.getboolean(section, 'use_python3', fallback=False),
+            pickle_protocol=parser.getint(section, 'pickle_protocol'),
+            compress_threshold=parser.getint(section, 'compress_threshold'),
+            fork_server=parser.getboolean(section, 'fork_server', fallback=False)
+        )
+    return settings
 
 
 class Dispatcher(object):
     """
     Main Dispatcher
     """
-    def __init__(self, conf_path, max_consumers, periodic, verbose, logfile=None):
+    def __init__(self, conf_path, max_consumers, periodic, verbose, logfile=None, wake_on_work=False,
+                 reload=False, metrics_port=0, cluster=None, min_free_memory=0, max_load=0, history_file=None,
+                 policy='fair', reserved_slots=0, runtime_limit_factor=0, periodic_jitter=0,
+                 configure_notifications=False):
         self._total_consumers = max_consumers
         self.is_verbose = verbose
         self.tasks = []
         self.instances = []
-        self.consumers = []
+        self.consumers = ConsumerTable()
+        self.fair_share = FairShare()
+        self.sizing = ConsumerSizing()
+        self.admission = AdmissionControl(min_free_memory * 2 ** 20, max_load)
+        self.policy = policy
+        self.reserved_slots = reserved_slots
+        self.runtime_limit_factor = runtime_limit_factor
+        self.periodic = periodic
+        self.periodic_jitter = periodic_jitter
+        # Runtime limits published for every instance, and the ones to publish.
+        self._limits = {}
+        self._pending_limits = {}
+        self.waker = None
+        self.supervisor = None
+        self.wake_on_work = wake_on_work
+        self.configure_notifications = configure_notifications
+        self.conf_path = conf_path
+        self.reload = reload
+        self.files = FileWatcher()
+        self._confs = {}
+        self._conf_settings = {}
+        self._reload_at = time.time() + RELOAD_INTERVAL
+        self._scheduler = None
+        self._watched_servers = set()
+        self._notifying_servers = set()
+        # Instances with consumers that finished since their reports were read.
+        self._finished = set()
+        self.metrics_port = metrics_port
+        self._metrics_at = 0
+        # When every task at the head of a queue was first seen, by instance.
+        self._first_seen = {}
+        # Priority and aged priority of the pending tasks, by instance.
+        self._priorities = {}
+        self.cluster = cluster
+        self._heartbeat_at = 0
 
         self.setup_logger(logfile)
 
         self._logger.info('Init Dispatcher')
         self._logger.info('- Consumers = %d', max_consumers)
         self._logger.info('- Periodic  = %s', 'enabled' if periodic else 'disabled')
+        self._logger.info('- Periodic jitter = %s', '%gs' % periodic_jitter if periodic_jitter else 'disabled')
         self._logger.info('- Verbose   = %s', 'enabled' if verbose else 'disabled')
+        self._logger.info('- Wake on work = %s', 'enabled' if wake_on_work else 'disabled')
+        self._logger.info('- Configure notifications = %s', 'enabled' if configure_notifications else 'disabled')
+        self._logger.info('- Reload    = %s', 'enabled' if reload else 'disabled')
+        self._logger.info('- Metrics   = %s', 'port %d' % metrics_port if metrics_port else 'disabled')
+        self._logger.info('- Cluster   = %s', 'node %s' % cluster.node_id if cluster else 'disabled')
+        self._logger.info('- Min free memory = %s', '%d MB' % min_free_memory if min_free_memory else 'disabled')
+        self._logger.info('- Max load  = %s', '%.2f' % max_load if max_load else 'disabled')
+        self._logger.info('- Policy    = %s', policy)
+        self._logger.info('- Reserved slots = %d', reserved_slots)
+        self._logger.info('- Runtime limits = %s',
+                          '%gx p99' % runtime_limit_factor if runtime_limit_factor else 'disabled')
+        self.history = RuntimeHistory(history_file)
 
         self.setup_sentry(conf_path)
         self.load_config(conf_path)
+        self.setup_notifications(self.instances)
 
-        # Create the scheduler process (but don't start it yet).
         if periodic:
-            scheduler = self._create_scheduler()
-            self.scheduler = self._create_process(scheduler, 'Scheduler')
-            self.scheduler.start()
+            self.setup_scheduler()
+
+        self.setup_waker()
+
+        if metrics_port:
+            start_metrics_server(metrics_port)
 
         self.start()
 
+    def setup_scheduler(self):
+        """
+        Create the scheduler and start it in its own process. When reloading
+        or serving metrics it runs in a thread, to share the instances and
+        the metrics with the dispatcher.
+        """
+        self._scheduler = self._create_scheduler()
+        environment = ThreadEnvironment() if self.reload or self.metrics_port else ProcessEnvironment()
+        self.scheduler = self._create_process(self._scheduler, 'Scheduler', environment)
+        self.scheduler.start()
+
     def _create_scheduler(self):
         return Scheduler(
             instances=self.instances,
-            interval=60,
-            utc=True)
+            interval=5,
+            utc=True,
+            cluster=self.cluster,
+            jitter=self.periodic_jitter)
 
-    def _create_process(self, process, name):
+    def _create_process(self, process, name, environment=None):
         """
         Repeatedly call the `loop()` method of the given process. Unhandled
         exceptions in the `loop()` method will cause the process to terminate.
         """
         def _run():
+            process.initialize()
             try:
                 while True:
                     process.loop()
@@ -61,7 +233,49 @@ class Dispatcher(object):
                 pass
             except:
                 self._logger.exception('Process %s died!', name)
-        return ProcessEnvironment().create_process(_run, name)
+        return (environment or ProcessEnvironment()).create_process(_run, name)
+
+    def setup_waker(self):
+        """
+        Wake up the main loop when a consumer exits, a fork server sends a
+        message or, when waking on work, a queue gets work.
+        """
+        self.waker = Waker()
+        self.supervisor = Supervisor(self.waker, MAX_SECONDS_RUNNING)
+        self.watch_queues(self.instances)
+
+    def setup_notifications(self, instances):
+        """
+        With --configure-notifications, enable the keyspace notifications that
+        the queue and the schedule watchers need on every Redis server not set
+        up yet, in one place for all of them so that they do not overwrite
+        each other's flags. Otherwise the watchers only check them.
+        """
+        flags = 'K' + ('l' if self.wake_on_work else '') + ('z' if self.periodic else '')
+        if not self.configure_notifications or len(flags) == 1:
+            return
+        for group in group_by_server(instances):
+            pool = group[0].storage.pool
+            if id(pool) not in self._notifying_servers:
+                self._notifying_servers.add(id(pool))
+                configure_notifications(group[0].storage.conn, flags)
+
+    def watch_queues(self, instances):
+        """
+        Wake up on the events of the instances, listening to the queues of
+        every Redis server that is not watched yet when waking on work.
+        """
+        for instance in instances:
+            if instance.zygote is not None:
+                instance.zygote.waker = self.waker
+
+        if not self.wake_on_work:
+            return
+        for group in group_by_server(instances):
+            pool = group[0].storage.pool
+            if id(pool) not in self._watched_servers:
+                self._watched_servers.add(id(pool))
+                QueueWatcher(group[0].storage.conn, self.waker).start()
 
     @property
     def loglevel(self):
@@ -101,92 +315,489 @@ class Dispatcher(object):
             self._logger.error('Applications not configured in %s', conf_path)
             sys.exit(1)
 
-        all_conf = (conf for conf in os.listdir(conf_path) if conf.endswith('.conf'))
+        self.conf_path = conf_path
+        for conf in sorted(conf for conf in os.listdir(conf_path) if conf.endswith('.conf')):
+            self.files.track(os.path.join(conf_path, conf))
+            instance = self._load_instances_from_conf(conf, conf_path)
+            if instance is not None:
+                self._confs[conf] = instance
+            else:
+                self._conf_settings[conf] = None
 
-        pool = ThreadPoolExecutor(16)
-        instances = pool.map(lambda conf: self._load_instances_from_conf(conf, conf_path), all_conf)
-        self.instances = [instance for instance in instances if instance is not None]
-        pool.shutdown()
+        self.instances = list(self._confs.values())
         if len(self.instances) == 0:
             self._logger.error('Check that you have almost one application configured in %s', conf_path)
             sys.exit(1)
 
+        self.load_periodic_tasks(self.instances)
+        for instance in self.instances:
+            self.files.track(instance.schedule_file)
+
+    def load_periodic_tasks(self, instances):
+        """
+        Load the periodic tasks of the instances. Running makeschedule is CPU
+        bound, so at most one per CPU runs at the same time.
+        """
+        start = time.time()
+        cached = 0
+        pool = ThreadPoolExecutor(os.cpu_count() or 1)
+        futures = {pool.submit(instance.load_periodic_tasks): instance for instance in instances}
+        for future in as_completed(futures):
+            try:
+                cached += future.result()
+            except Exception:
+                self._logger.exception('[%s] Error loading periodic tasks', futures[future].name)
+        pool.shutdown()
+        self._logger.info('Periodic tasks of %d instances loaded in %.2fs (%d cached)',
+                          len(instances), time.time() - start, cached)
+
     def _load_instances_from_conf(self, conf, conf_path):
-        self._logger.info(conf)
+        settings = self._read_conf(conf, conf_path)
+        if settings is None:
+            return None
+        return self._create_instance(conf, settings)
+
+    def _create_instance(self, conf, settings):
         try:
-            parser = ConfigParser()
-            parser["DEFAULT"] = {
-                'workers': '1',
-                'worker-type': 'thread',
-                'redis_host': 'localhost',
-                'redis_port': '6379',
-                'use_python3': 'false'
-            }
-            parser.read(os.path.join(conf_path, conf))
-            for section in parser.sections():
-                instance = HueyApplication(
-                    name=parser.get(section, 'redis_prefix'),
-                    python_path=parser.get(section, 'python'),
-                    script_path=parser.get(section, 'script'),
-                    workers=parser.get(section, 'workers'),
-                    worker_type=parser.get(section, 'worker-type'),
-                    settings=parser.get(section, 'settings'),
-                    redis_host=parser.get(section, 'redis_host'),
-                    redis_port=parser.get(section, 'redis_port'),
-                    redis_prefix=parser.get(section, 'redis_prefix') or section,
-                    use_python3=parser.getboolean(section, 'use_python3', fallback=False)
-                )
-        except Exception as e:
+            instance = HueyApplication(**settings)
+        except Exception:
             self._logger.exception('Error reading config %s', conf)
-            instance = None
+            return None
+        self._conf_settings[conf] = settings
         return instance
 
+    def _read_conf(self, conf, conf_path):
+        """
+        Read the HueyApplication arguments from a conf file.
+        """
+        self._logger.info(conf)
+        try:
+            settings = read_conf(os.path.join(conf_path, conf))
+        except Exception:
+            self._logger.exception('Error reading config %s', conf)
+            return None
+        return settings
+
+    def reload_config(self):
+        """
+        Apply the changes of the conf files and of the schedule.info files of
+        the instances. Only the instances of the conf files that changed are
+        created, updated or retired, the others keep running untouched.
+        """
+        changes = self.read_changes()
+        if changes is None:
+            return
+        created, retired, reread = self.apply_changes(*changes)
+        if not created and not retired and not reread:
+            return
+        schedules = self.load_instances(created, reread)
+        self.switch_instances(created, retired, schedules)
+        self.stop_instances(retired)
+
+    def read_changes(self):
+        """
+        Read the conf files that are new or changed since the last reload.
+        It only reads files, nothing the dispatcher loop uses is changed.
+
+        :return: (conf files, files changed, settings of the conf files read,
+            None when they are not valid), or None if the confs can't be listed.
+        """
+        try:
+            confs = set(conf for conf in os.listdir(self.conf_path) if conf.endswith('.conf'))
+        except OSError:
+            self._logger.exception('Unable to read %s', self.conf_path)
+            return None
+        changed = self.files.changed()
+
+        new_settings = {}
+        for conf in sorted(confs):
+            path = os.path.join(self.conf_path, conf)
+            if conf in self._confs and path not in changed:
+                continue
+            if conf not in self._confs:
+                # A new conf, or one that could not be loaded before.
+                if conf in self._conf_settings and path not in changed:
+                    continue
+                self.files.track(path)
+            new_settings[conf] = self._read_conf(conf, self.conf_path)
+        return confs, changed, new_settings
+
+    def apply_changes(self, confs, changed, new_settings):
+        """
+        Update the instances of the conf files read by read_changes, creating
+        the new instances and the ones whose settings can't be tuned.
+
+        :return: (instances created, instances retired, instances whose
+            schedule.info changed)
+        """
+        created = []
+        retired = []
+        # Confs that could not be loaded are only in _conf_settings.
+        for conf in sorted(confs | set(self._confs) | set(self._conf_settings)):
+            path = os.path.join(self.conf_path, conf)
+            instance = self._confs.get(conf)
+            if conf not in confs:
+                self.files.forget(path)
+                self._conf_settings.pop(conf, None)
+                if instance is not None:
+                    self._logger.info('[%s] Removed %s', instance.name, conf)
+                    retired.append(self._confs.pop(conf))
+                continue
+            if conf not in new_settings:
+                continue
+
+            settings = new_settings[conf]
+            if settings is None:
+                # Keep the instance running as it was until the conf is fixed.
+                self._conf_settings.setdefault(conf, None)
+                continue
+
+            previous = self._conf_settings.get(conf)
+            if instance is not None and previous is not None:
+                updated = set(key for key in settings if settings[key] != previous[key])
+                if not updated:
+                    continue
+                if updated.issubset(TUNABLE_SETTINGS) and settings['weight'] > 0:
+                    self._logger.info('[%s] Updated %s', instance.name, ', '.join(sorted(updated)))
+                    instance.weight = float(settings['weight'])
+                    instance.min_consumers = settings['min_consumers']
+                    instance.max_consumers = settings['max_consumers']
+                    instance.workers = int(settings['workers'])
+                    instance.priority = settings['priority']
+                    instance.task_priorities = settings['task_priorities']
+                    self._conf_settings[conf] = settings
+                    continue
+
+            new_instance = self._create_instance(conf, settings)
+            if new_instance is None:
+                self._conf_settings.setdefault(conf, None)
+                continue
+            self._logger.info('[%s] %s %s', new_instance.name, 'Reloaded' if instance else 'Added', conf)
+            created.append(new_instance)
+            self._confs[conf] = new_instance
+            if instance is not None:
+                retired.append(instance)
+
+        reread = []
+        for instance in self._confs.values():
+            if instance not in created and instance.schedule_file in changed:
+                self._logger.info('[%s] Schedule changed', instance.name)
+                reread.append(instance)
+        return created, retired, reread
+
+    def load_instances(self, created, reread):
+        """
+        Load the periodic tasks of the instances created, that are not used
+        yet, and read the schedule.info files that changed. Runs makeschedule
+        and reads files, leaving the instances in use untouched.
+
+        :return: the periodic tasks read again, by instance.
+        """
+        if created:
+            self.setup_notifications(created)
+            self.load_periodic_tasks(created)
+            self.watch_queues(created)
+        return dict((instance, instance.parse_schedule()) for instance in reread)
+
+    def switch_instances(self, created, retired, schedules):
+        """
+        Start using the instances created and the schedules read again, and
+        forget the state of the instances retired.
+        """
+        for instance, periodic_tasks in schedules.items():
+            instance.periodic_tasks = periodic_tasks
+        for instance in created:
+            self.files.track(instance.schedule_file)
+
+        names = set(instance.name for instance in self._confs.values())
+        for instance in retired:
+            if instance.name not in names:
+                self.fair_share.forget(instance)
+                self.sizing.forget(instance)
+                self.admission.forget(instance)
+                self.history.forget(instance)
+                self._limits.pop(instance.name, None)
+                self._pending_limits.pop(instance.name, None)
+                self._finished.discard(instance.name)
+                self._first_seen.pop(instance.name, None)
+                self._priorities.pop(instance.name, None)
+                REGISTRY.remove(instance.name)
+
+        self.instances = [self._confs[conf] for conf in sorted(self._confs)]
+        if self._scheduler is not None:
+            self._scheduler.update_instances(self.instances, schedules)
+
+    def stop_instances(self, retired):
+        """
+        Stop the fork servers of the instances retired, waiting for them.
+        """
+        for instance in retired:
+            instance.stop()
+
     def get_task_data(self, task):
-        """Convert a message from the queue into a task"""
-        raw = pickle.loads(task)
-        if len(raw) == 7:
-            task_id, klass_str, _, _, _, _, _ = raw
-        elif len(raw) == 6:
-            task_id, klass_str, _, _, _, _ = raw
-        return task_id, klass_str
+        """Read task id and class from a message, without its arguments"""
+        return read_header(task)
 
     def task_exists(self, task_id):
-        for consumer in self.consumers:
-            if consumer.task_id == task_id:
-                return True
-        return False
+        return self.consumers.has_task(task_id)
 
     def instance_is_active(self, instance):
-        for consumer in self.consumers:
-            if consumer.app == instance:
-                return True
-        return False
-
-    def consume_task(self):
-        for idx, _instance in enumerate(self.instances):
-            tasks = _instance.get_pending_tasks()
-            for _task in tasks:
-                task_id, task_klass = self.get_task_data(_task)
-
-                if not self.task_exists(task_id):
-                    self._logger.info('Consume task: %s %s', task_klass, task_id)
-                    self.consumers.append(HueyConsumer(_instance, task_id))
-                    if len(self.instances) > 1:
-                        self.instances.append(self.instances.pop(idx))
-                    return True
-        return False
+        return self.consumers.count(instance) > 0
+
+    def probe_queues(self):
+        """
+        Read length and head of every queue, with one pipelined round trip per
+        Redis server.
+
+        Every consumer of an instance may own one of its pending tasks, so the
+        head only needs one message per running consumer plus one per free
+        slot. Without free slots only the lengths are read. The reports of the
+        instances whose consumers finished are read, and their new runtime
+        limits written, in the same round trip.
+
+        :return: dict instance name -> (length, [(task_id, klass_str), ...])
+        """
+        free = self._total_consumers - len(self.consumers)
+        queues = {}
+        for instances in group_by_server(self.owned_instances()):
+            pipe, reporting, heads = self.queue_probe(instances, free)
+            try:
+                results = pipe.execute()
+            except RedisError:
+                self._logger.exception('Error reading queues of %s', ', '.join(i.name for i in instances))
+                self._finished.update(instance.name for instance in reporting)
+                continue
+            self.read_queue_probe(instances, reporting, heads, results, queues)
+        return queues
+
+    def queue_probe(self, instances, free):
+        """
+        Pipeline reading the queues of instances living in the same Redis
+        server, see probe_queues.
+
+        :return: pipeline, the instances whose reports it reads, and whether
+            it reads the heads of the queues.
+        """
+        reporting = [instance for instance in instances if instance.name in self._finished]
+        self._finished.difference_update(instance.name for instance in reporting)
+        # No consumer can be started without free slots: the heads are not
+        # needed, and a head of length 0 would read the whole queue.
+        heads = free > 0
+        pipe = instances[0].storage.conn.pipeline(transaction=False)
+        for instance in instances:
+            pipe.llen(instance.storage.queue_key)
+            if heads:
+                pipe.lrange(instance.storage.queue_key, -max(self.consumers.count(instance) + free, 1), -1)
+        for instance in reporting:
+            instance.pop_reports(pipe)
+        for instance in instances:
+            if instance.name in self._pending_limits:
+                instance.set_runtime_limits(self._pending_limits[instance.name], pipe)
+        return pipe, reporting, heads
+
+    def read_queue_probe(self, instances, reporting, heads, results, queues):
+        """
+        Add the pending queues read by a queue_probe pipeline to `queues`.
+        Without heads, only the queue depths are updated.
+        """
+        now = time.time()
+        step = 2 if heads else 1
+        count = step * len(instances)
+        for index, instance in enumerate(instances):
+            length = results[index * step]
+            QUEUE_DEPTH.labels(instance.name).set(length)
+            if not heads:
+                continue
+            tasks = results[index * step + 1]
+            first_seen = self._first_seen.pop(instance.name, {})
+            self._priorities.pop(instance.name, None)
+            if length:
+                queues[instance.name] = (length, [self.get_task_data(task) for task in reversed(tasks)])
+                self._first_seen[instance.name] = dict(
+                    (task_id, first_seen.get(task_id, now)) for task_id, _ in queues[instance.name][1])
+                self.read_priorities(instance, queues[instance.name][1], now)
+        for instance in instances:
+            self._pending_limits.pop(instance.name, None)
+        for instance, reports in zip(reporting, results[count:]):
+            learned = False
+            for report in self.sizing.report(instance, reports):
+                CONSUMER_TASKS.labels(instance.name).observe(report['tasks'])
+                learned = self.history.report(instance, report) or learned
+            if learned and self.runtime_limit_factor:
+                self.update_runtime_limits(instance)
+
+    def read_priorities(self, instance, tasks, now):
+        """
+        Keep the highest priority of the pending tasks of an instance, and
+        the highest one with every task aged a level per PRIORITY_AGING
+        seconds it waited at the head of the queue. Tasks with a consumer
+        already started for them don't count.
+        """
+        first_seen = self._first_seen[instance.name]
+        priorities = [
+            (instance.task_priority(task_klass), now - first_seen[task_id])
+            for task_id, task_klass in tasks if not self.task_exists(task_id)]
+        if not priorities:
+            return
+        priority = max(priority for priority, _ in priorities)
+        aged = max(priority + int(waited // PRIORITY_AGING) for priority, waited in priorities)
+        self._priorities[instance.name] = (priority, aged)
+
+    def update_runtime_limits(self, instance):
+        """
+        Derive the runtime limits of the task classes of an instance from
+        their history, to be published by the next queue probe.
+        """
+        limits = self.history.limits(instance, self.runtime_limit_factor, MIN_RUNTIME_LIMIT, MAX_SECONDS_RUNNING)
+        if limits != self._limits.get(instance.name):
+            self._logger.info('[%s] Runtime limits: %s', instance.name,
+                              ', '.join('%s %gs' % item for item in sorted(limits.items())))
+            self._limits[instance.name] = limits
+            self._pending_limits[instance.name] = limits
+
+    def consume_tasks(self):
+        """
+        Start consumers for pending tasks while there are free slots. Slots
+        are given to the instances by weighted fair share.
+        """
+        self.start_consumers(self.probe_queues())
+
+    def start_consumers(self, queues):
+        """
+        Instances with higher priority pending tasks go first; aged tasks
+        rise up to the highest priority pending. With the sejf policy,
+        instances whose next task is expected to be the shortest go first.
+        The last reserved_slots free slots are only given to instances whose
+        next task is short.
+
+        :param queues: pending queues, see probe_queues.
+        """
+        def expected(instance):
+            return self.expected_runtime(instance, queues[instance.name][1])
+
+        instances = [instance for instance in self.instances if instance.name in queues]
+        top = max([self._priorities.get(instance.name, (instance.priority,))[0] for instance in instances] or [0])
+
+        def priority(instance):
+            return min(self._priorities.get(instance.name, (0, instance.priority))[1], top)
+
+        pending = self.fair_share.queue(
+            instances, self.consumers.count, expected if self.policy == 'sejf' else None, priority)
+
+        while len(self.consumers) < self._total_consumers:
+            instance = self.fair_share.pop(pending)
+            if instance is None:
+                break
+            length, tasks = queues[instance.name]
+            if self._total_consumers - len(self.consumers) <= self.reserved_slots and \
+                    expected(instance) >= SHORT_TASK_DURATION:
+                continue
+            workers = self.get_workers(instance, length)
+            if workers and not self.admission.admit(instance, self.consumers):
+                # The tasks stay queued until there is room for a consumer.
+                break
+            if workers and self.consume_task(instance, tasks, workers):
+                self.fair_share.charge(instance)
+                self.fair_share.push(pending, instance, self.consumers.count(instance),
+                                     expected(instance) if self.policy == 'sejf' else 0., priority(instance))
+
+    def expected_runtime(self, instance, tasks):
+        """
+        Expected duration of the next task a consumer of the instance would
+        be started for: the average of its class, or of every task of the
+        instance when the class never ran.
+        """
+        for task_id, task_klass in tasks:
+            if not self.task_exists(task_id):
+                expected = self.history.expected(instance, task_klass)
+                if expected is not None:
+                    return expected
+                break
+        return self.sizing.duration(instance)
+
+    def get_workers(self, instance, length):
+        """
+        Workers for a new consumer of the instance, 0 when the running ones
+        are enough for its backlog. An instance below its min_consumers always
+        gets one.
+        """
+        consumers = self.consumers.for_instance(instance)
+        workers = self.sizing.workers(instance, length, sum(consumer.workers for consumer in consumers))
+        if not workers and len(consumers) < instance.min_consumers:
+            workers = 1
+        return workers
+
+    def consume_task(self, instance, tasks, workers=None):
+        task_id = self.pick_task(instance, tasks, workers)
+        if task_id is None:
+            return False
+        start = time.time()
+        consumer = HueyConsumer(instance, task_id, workers)
+        self.supervisor.add(consumer)
+        self.add_consumer(consumer, start)
+        return True
+
+    def pick_task(self, instance, tasks, workers=None):
+        """
+        First of the pending tasks without a consumer, or None.
+        """
+        for task_id, task_klass in tasks:
+            if not self.task_exists(task_id):
+                self._logger.info('Consume task: %s %s (%s workers)', task_klass, task_id, workers or instance.workers)
+                return task_id
+        return None
+
+    def add_consumer(self, consumer, start):
+        """
+        Keep a consumer started at `start`.
+        """
+        name = consumer.app.name
+        self.consumers.add(consumer)
+        if not consumer.is_forked:
+            # Forked consumers are observed when the fork server answers.
+            SPAWN_SECONDS.labels(name).observe(time.time() - start)
+        first_seen = self._first_seen.get(name, {}).pop(consumer.task_id, start)
+        DISPATCH_LATENCY.labels(name).observe(start - first_seen)
+        CONSUMERS_STARTED.labels(name).inc()
+
+    def release_consumer(self, consumer):
+        """
+        Free the slot of a consumer that exited.
+        """
+        self.consumers.remove(consumer)
+        self.admission.finished(consumer)
+        self._finished.add(consumer.app.name)
+        CONSUMER_LIFETIME.labels(consumer.app.name).observe(time.time() - consumer.started)
 
     def start(self):
         self._logger.info('Start Dispatcher')
         timeout = 0.5
+        if self.wake_on_work:
+            timeout = WAKE_TIMEOUT
+        if self.cluster is not None:
+            timeout = min(timeout, HEARTBEAT_INTERVAL)
+        if self.admission.enabled:
+            timeout = min(timeout, SAMPLE_INTERVAL)
         while True:
             try:
-                time.sleep(timeout)
-                consumed = True
-                while (len(self.consumers) < self._total_consumers) and consumed:
-                    consumed = self.consume_task()
+                self.heartbeat_if_due()
+                self.waker.wait(self.supervisor.timeout(timeout))
+                self.reload_if_due()
+
+                # Release finished consumers first, so their slots can be
+                # used right away.
+                for consumer in self.supervisor.reap():
+                    self.release_consumer(consumer)
+                self.supervisor.expire()
+                self.admission.sample(self.consumers)
+
+                if len(self.consumers) < self._total_consumers:
+                    self.consume_tasks()
+                elif self.metrics_due():
+                    self.probe_queues()
 
-                self.consumers = [c for c in self.consumers if c.is_running()]
+                self.update_metrics()
+                self.history.save_if_due()
 
             except KeyboardInterrupt:
                 self._logger.info('Received SIGINT')
@@ -197,5 +808,57 @@ class Dispatcher(object):
                 self.stop()
                 break
 
+    def owned_instances(self):
+        """
+        Instances this dispatcher starts consumers for: every instance, or in
+        cluster mode the ones this node holds the lease of.
+        """
+        if self.cluster is None:
+            return self.instances
+        owned = self.cluster.owned()
+        return [instance for instance in self.instances if instance.name in owned]
+
+    def heartbeat(self):
+        """
+        Send a cluster heartbeat, see Cluster.heartbeat.
+        """
+        try:
+            self.cluster.heartbeat([instance.name for instance in self.instances])
+        except RedisError:
+            self._logger.exception('Error sending the cluster heartbeat.')
+
+    def heartbeat_if_due(self):
+        if self.cluster is not None and time.time() >= self._heartbeat_at:
+            self._heartbeat_at = time.time() + HEARTBEAT_INTERVAL
+            self.heartbeat()
+
+    def reload_due(self):
+        return self.reload and time.time() >= self._reload_at
+
+    def reload_if_due(self):
+        if self.reload_due():
+            self._reload_at = time.time() + RELOAD_INTERVAL
+            try:
+                self.reload_config()
+            except Exception:
+                self._logger.exception('Error reloading config.')
+
+    def metrics_due(self):
+        return self.metrics_port and time.time() >= self._metrics_at
+
+    def update_metrics(self):
+        if self.metrics_due():
+            self._metrics_at = time.time() + METRICS_INTERVAL
+            for instance in self.instances:
+                CONSUMERS.labels(instance.name).set(self.consumers.count(instance))
+
     def stop(self):
         self._logger.info('Shutting down')
+        self.history.save()
+        for instance in self.instances:
+            instance.stop()
+        if self.cluster is not None:
+            try:
+                self.cluster.leave()
+            except RedisError:
+                self._logger.exception('Error leaving the cluster.')
@@ -0,0 +1,160 @@
+import datetime
+import heapq
+import itertools
+import re
+
+
+dash_re = re.compile(r'(\d+)-(\d+)')
+every_re = re.compile(r'\*/(\d+)')
+
+ONE_MINUTE = datetime.timedelta(minutes=1)
+# Give up looking for the next fire time after this many days (covers leap
+# days).
+MAX_DAYS = 5 * 366
+
+
+def _parse(value, acceptable, weekday=False):
+    """
+    Convert a crontab field into a bitmask, with the same rules as
+    huey.crontab.
+    """
+    mask = 0
+    for piece in str(value).split(','):
+        if piece == '*':
+            values = acceptable
+        elif piece.isdigit():
+            piece = int(piece)
+            if piece not in acceptable:
+                raise ValueError('%d is not a valid input' % piece)
+            values = [piece % 7 if weekday else piece]
+        else:
+            dash_match = dash_re.match(piece)
+            every_match = every_re.match(piece)
+            if dash_match:
+                lhs, rhs = map(int, dash_match.groups())
+                if lhs not in acceptable or rhs not in acceptable:
+                    raise ValueError('%s is not a valid input' % piece)
+                if weekday:
+                    lhs %= 7
+                    rhs %= 7
+                values = range(lhs, rhs + 1)
+            elif every_match:
+                if weekday:
+                    raise ValueError('Cannot perform this kind of matching on day-of-week.')
+                values = acceptable[::int(every_match.groups()[0])]
+            else:
+                continue
+        for item in values:
+            mask |= 1 << (item % 7 if weekday else item)
+    return mask
+
+
+def _next_bit(mask, start):
+    """
+    Smallest value >= start whose bit is set in mask, or None.
+    """
+    rest = mask >> start
+    if not rest:
+        return None
+    return start + (rest & -rest).bit_length() - 1
+
+
+class CronEntry(object):
+    """
+    A crontab compiled to one bitmask per field. Calling it tells if a
+    datetime matches, like the function returned by huey.crontab.
+
+    For day-of-week, 0=Sunday and 6=Saturday.
+    """
+
+    def __init__(self, minute='*', hour='*', day_of_week='*', day='*', month='*'):
+        self.months = _parse(month, range(1, 13))
+        self.days = _parse(day, range(1, 32))
+        self.weekdays = _parse(day_of_week, range(8), weekday=True)
+        self.hours = _parse(hour, range(24))
+        self.minutes = _parse(minute, range(60))
+
+    def _matches_day(self, date):
+        weekday = (date.weekday() + 1) % 7
+        return (self.months >> date.month & 1 and
+                self.days >> date.day & 1 and
+                self.weekdays >> weekday & 1)
+
+    def __call__(self, dt):
+        return bool(self._matches_day(dt) and
+                    self.hours >> dt.hour & 1 and
+                    self.minutes >> dt.minute & 1)
+
+    def next_fire(self, after):
+        """
+        First minute after the given datetime that matches, or None if it
+        never does.
+        """
+        start = after.replace(second=0, microsecond=0) + ONE_MINUTE
+        date = start.date()
+        for _ in range(MAX_DAYS):
+            if self._matches_day(date):
+                same_day = date == start.date()
+                hour = _next_bit(self.hours, start.hour if same_day else 0)
+                while hour is not None:
+                    same_hour = same_day and hour == start.hour
+                    minute = _next_bit(self.minutes, start.minute if same_hour else 0)
+                    if minute is not None:
+                        return datetime.datetime(date.year, date.month, date.day, hour, minute)
+                    hour = _next_bit(self.hours, hour + 1)
+            date += datetime.timedelta(days=1)
+        return None
+
+
+class CronIndex(object):
+    """
+    Periodic tasks of every instance in a min-heap ordered by their next fire
+    time, so every minute only the tasks that are due are looked at.
+    """
+
+    def __init__(self, instances, now):
+        self._heap = []
+        self._counter = itertools.count()
+        for app in instances:
+            self.add(app, now)
+
+    def add(self, app, now):
+        """
+        Index the periodic tasks of an instance.
+        """
+        for task in app.periodic_tasks:
+            self._push(app, task, task['validate_datetime'].next_fire(now))
+
+    def remove(self, apps):
+        """
+        Drop the periodic tasks of the given instances.
+        """
+        apps = set(apps)
+        self._heap = [entry for entry in self._heap if entry[2] not in apps]
+        heapq.heapify(self._heap)
+
+    def _push(self, app, task, fire_at):
+        if fire_at is not None:
+            heapq.heappush(self._heap, (fire_at, next(self._counter), app, task))
+
+    def pop_due(self, now):
+        """
+        Periodic tasks that fire at the minute of `now`. Fire times missed
+        while the scheduler was late are skipped, not caught up.
+
+        :return: list of (app, task)
+        """
+        minute = now.replace(second=0, microsecond=0)
+        due = []
+        while self._heap and self._heap[0][0] <= minute:
+            fire_at, _, app, task = heapq.heappop(self._heap)
+            if fire_at == minute:
+                due.append((app, task))
+            self._push(app, task, task['validate_datetime'].next_fire(now))
+        return due
+
+    def next_fire_times(self):
+        """
+        :return: sorted list of (datetime, instance name, method)
+        """
+        return sorted((fire_at, app.name, task['method']) for fire_at, _, app, task in self._heap)
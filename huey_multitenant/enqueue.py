@@ -0,0 +1,158 @@
+import datetime
+import logging
+import os
+import time
+import uuid
+
+from huey.storage import RedisStorage
+
+from huey_multitenant.connections import get_connection_pool, group_by_server
+from huey_multitenant.core import read_conf
+from huey_multitenant.message import encode_message, message_protocol
+
+
+# Messages sent to Redis in one pipelined round trip.
+BATCH_SIZE = 500
+
+TASK_PREFIX = 'queue_task_'
+
+
+def task_name(task):
+    """
+    Name of a task in the queue: ``queue_task_<function>``, from the function
+    name or its dotted path.
+    """
+    task = task.split('.')[-1]
+    if task.startswith(TASK_PREFIX):
+        return task
+    return TASK_PREFIX + task
+
+
+class Tenant(object):
+    """
+    Queue of a tenant, without its Django project.
+    """
+
+    def __init__(self, name, storage, use_python3=False, pickle_protocol=0, compress_threshold=0):
+        self.name = name
+        self.storage = storage
+        self.use_python3 = use_python3
+        self.pickle_protocol = message_protocol(use_python3, pickle_protocol)
+        self.compress_threshold = compress_threshold
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        :param settings: HueyApplication arguments, see read_conf.
+        """
+        storage = RedisStorage(
+            name=settings['redis_prefix'],
+            connection_pool=get_connection_pool(settings['redis_host'], settings['redis_port'],
+                                                settings['redis_db'], settings['redis_socket']))
+        return cls(settings['name'], storage, settings['use_python3'], settings['pickle_protocol'],
+                   settings['compress_threshold'])
+
+    def encode_message(self, task_data):
+        return encode_message(task_data, self.pickle_protocol, self.compress_threshold)
+
+
+def load_tenants(conf_path):
+    """
+    Tenants of the conf files of a folder.
+
+    :return: list of Tenant
+    """
+    tenants = []
+    for conf in sorted(conf for conf in os.listdir(conf_path) if conf.endswith('.conf')):
+        settings = read_conf(os.path.join(conf_path, conf))
+        if settings is not None:
+            tenants.append(Tenant.from_settings(settings))
+    return tenants
+
+
+class BulkEnqueuer(object):
+    """
+    Enqueue many tasks of one or many tenants, writing the messages straight
+    to Redis as the scheduler does, encoded as set in the conf of every
+    tenant. Messages are buffered and sent with one pipeline per Redis
+    server, a single LPUSH per queue, every `batch_size` tasks and on flush.
+    Tasks with an eta or a delay go to the schedule, so no consumer is
+    started until they are due.
+
+    Use it as a context manager to flush on exit::
+
+        with BulkEnqueuer(load_tenants(conf_path)) as enqueuer:
+            enqueuer.add('django1', 'send_mail', args=(user_id,))
+    """
+
+    def __init__(self, tenants, batch_size=BATCH_SIZE):
+        self._logger = logging.getLogger()
+        self.tenants = dict((tenant.name, tenant) for tenant in tenants)
+        self.batch_size = batch_size
+        self.enqueued = 0
+        self.scheduled = 0
+        self._queued = {}
+        self._scheduled = {}
+        self._pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def add(self, tenant, task, args=(), kwargs=None, eta=None, delay=None, retries=0, retry_delay=0,
+            task_id=None):
+        """
+        :param tenant: tenant name (its redis_prefix)
+        :param task: task function name, dotted path or queue name
+        :param eta: Unix time to run the task at
+        :param delay: seconds to wait before running the task
+        :return: task id
+        """
+        if tenant not in self.tenants:
+            raise ValueError('Unknown tenant %s' % tenant)
+        if eta is not None and delay is not None:
+            raise ValueError('Both a delay and an eta cannot be specified at the same time')
+        if delay is not None:
+            eta = time.time() + float(delay)
+        tenant = self.tenants[tenant]
+        task_id = task_id or str(uuid.uuid4())
+        # Huey keeps execution times as naive UTC datetimes.
+        execute_time = datetime.datetime.utcfromtimestamp(float(eta)) if eta is not None else None
+        message = tenant.encode_message(
+            (task_id, task_name(task), execute_time, int(retries), int(retry_delay),
+             (tuple(args), dict(kwargs or {})), None))
+
+        if execute_time is None:
+            self._queued.setdefault(tenant, []).append(message)
+        else:
+            self._scheduled.setdefault(tenant, []).append((message, tenant.storage.convert_ts(execute_time)))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+        return task_id
+
+    def flush(self):
+        """
+        Send the buffered messages.
+
+        :return: number of messages sent.
+        """
+        queued, self._queued = self._queued, {}
+        scheduled, self._scheduled = self._scheduled, {}
+        sent, self._pending = self._pending, 0
+        for group in group_by_server(set(queued) | set(scheduled)):
+            pipe = group[0].storage.conn.pipeline(transaction=False)
+            for tenant in group:
+                if tenant in queued:
+                    pipe.lpush(tenant.storage.queue_key, *queued[tenant])
+                if tenant in scheduled:
+                    items = []
+                    for message, score in scheduled[tenant]:
+                        items.extend((message, score))
+                    pipe.zadd(tenant.storage.schedule_key, *items)
+            pipe.execute()
+        self.enqueued += sum(len(messages) for messages in queued.values())
+        self.scheduled += sum(len(messages) for messages in scheduled.values())
+        return sent
@@ -0,0 +1,90 @@
+import heapq
+import itertools
+
+
+class FairShare(object):
+    """
+    Weighted fair queueing of consumer slots among instances.
+
+    Every instance has a virtual finish time that grows by 1 / weight each time
+    it gets a consumer, and the pending instance with the lowest one goes
+    first, so over time an instance gets slots in proportion to its weight no
+    matter how deep its queue is. Instances below their min_consumers go
+    before every other one and instances at their max_consumers are skipped.
+    Instances with higher priority pending tasks go first. With the expected
+    duration of their next task, instances with shorter tasks go first
+    (shortest expected job first). Virtual time breaks the ties.
+
+    Picking an instance is O(log instances).
+    """
+
+    def __init__(self):
+        self._finish = {}
+        # Start time of the instances waiting for a consumer, kept until they
+        # get one: recomputed at every queue, the instances with a higher
+        # weight would always go first.
+        self._waiting = {}
+        self._virtual_time = 0.
+        self._counter = itertools.count()
+
+    def _start(self, instance):
+        # An instance that was idle restarts at the current virtual time, it
+        # does not bank credit while it has nothing to do.
+        return max(self._finish.get(instance.name, 0.), self._virtual_time)
+
+    def queue(self, instances, running, expected=None, priority=None):
+        """
+        Build the queue of instances waiting for a consumer.
+
+        :param instances: instances with pending tasks
+        :param running: function returning the consumers running for an instance
+        :param expected: function returning the expected duration of the next
+            task of an instance, to dispatch the shortest first
+        :param priority: function returning the priority of the pending tasks
+            of an instance
+        """
+        waiting, self._waiting = self._waiting, {}
+        heap = []
+        for instance in instances:
+            if instance.name in waiting:
+                self._waiting[instance.name] = waiting[instance.name]
+            self.push(heap, instance, running(instance), expected(instance) if expected else 0.,
+                      priority(instance) if priority else 0)
+        return heap
+
+    def push(self, heap, instance, running, expected=0., priority=0):
+        if instance.max_consumers and running >= instance.max_consumers:
+            self._waiting.pop(instance.name, None)
+            return
+        start = self._waiting.get(instance.name)
+        if start is None:
+            start = self._waiting[instance.name] = self._start(instance)
+        heapq.heappush(heap, (
+            running >= instance.min_consumers,
+            -priority,
+            expected,
+            start + 1. / instance.weight,
+            next(self._counter),
+            instance))
+
+    def pop(self, heap):
+        if not heap:
+            return None
+        return heapq.heappop(heap)[-1]
+
+    def charge(self, instance):
+        """
+        Account a consumer started for the instance.
+        """
+        start = self._waiting.pop(instance.name, None)
+        if start is None:
+            start = self._start(instance)
+        self._finish[instance.name] = start + 1. / instance.weight
+        self._virtual_time = start
+
+    def forget(self, instance):
+        """
+        Drop the accounting of an instance that is not dispatched anymore.
+        """
+        self._finish.pop(instance.name, None)
+        self._waiting.pop(instance.name, None)
@@ -0,0 +1,190 @@
+from __future__ import division
+
+import json
+import logging
+import math
+import os
+import time
+
+
+# Durations are counted in buckets growing by this factor from SKETCH_MIN
+# seconds: quantiles are within about 10% of the real ones.
+SKETCH_GROWTH = 2 ** .25
+SKETCH_MIN = .001
+# Counts are halved past this weight, so old tasks fade away.
+SKETCH_WEIGHT = 1000.
+# Weight of every task in the average duration of its class.
+TASK_SMOOTHING = .1
+# Runtime limits are only derived for task classes that ran this many times.
+LIMIT_MIN_TASKS = 20
+# How often the history is written to disk.
+SAVE_INTERVAL = 60
+
+
+def duration_bucket(duration):
+    """
+    Sketch bucket of a task duration, in seconds.
+    """
+    if duration <= SKETCH_MIN:
+        return 0
+    return int(math.ceil(math.log(duration / SKETCH_MIN, SKETCH_GROWTH)))
+
+
+def bucket_duration(bucket):
+    """
+    Upper bound of a sketch bucket, in seconds.
+    """
+    return SKETCH_MIN * SKETCH_GROWTH ** bucket
+
+
+class TaskHistory(object):
+    """
+    Runtime of a task class: moving average and quantile sketch of its
+    durations.
+    """
+
+    def __init__(self, average=None, tasks=0, buckets=None):
+        self.average = average
+        self.tasks = tasks
+        self.buckets = buckets or {}
+
+    def add(self, tasks, busy, buckets):
+        """
+        :param tasks: tasks run
+        :param busy: seconds spent running them
+        :param buckets: their durations, bucket -> tasks (see duration_bucket)
+        """
+        if not tasks:
+            return
+        mean = busy / tasks
+        if self.average is None:
+            self.average = mean
+        else:
+            self.average += (1 - (1 - TASK_SMOOTHING) ** tasks) * (mean - self.average)
+        self.tasks += tasks
+        for bucket, count in buckets.items():
+            bucket = int(bucket)
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        if sum(self.buckets.values()) > SKETCH_WEIGHT:
+            self.buckets = dict((bucket, count / 2) for bucket, count in self.buckets.items() if count >= .02)
+
+    def quantile(self, q):
+        total = sum(self.buckets.values())
+        if not total:
+            return self.average
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= q * total:
+                return bucket_duration(bucket)
+        return bucket_duration(max(self.buckets))
+
+    def to_json(self):
+        return {'average': self.average, 'tasks': self.tasks, 'buckets': self.buckets}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['average'], int(data['tasks']),
+                   dict((int(bucket), float(count)) for bucket, count in data['buckets'].items()))
+
+
+class RuntimeHistory(object):
+    """
+    Runtime of every task class of every instance, learned from the consumer
+    reports and kept in a JSON file across restarts.
+    """
+
+    def __init__(self, path=None):
+        self._logger = logging.getLogger()
+        self.path = path
+        self._tasks = {}
+        self._dirty = False
+        self._save_at = time.time() + SAVE_INTERVAL
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self._tasks = dict(
+                (name, dict((klass, TaskHistory.from_json(task)) for klass, task in classes.items()))
+                for name, classes in data.items())
+        except (IOError, OSError):
+            return
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self._logger.exception('Invalid runtime history %s', self.path)
+            return
+        self._logger.info('Runtime history of %d task classes loaded from %s',
+                          sum(len(classes) for classes in self._tasks.values()), self.path)
+
+    def save(self):
+        """
+        Write the history, if it changed, replacing the file atomically.
+        """
+        self._save_at = time.time() + SAVE_INTERVAL
+        if not self.path or not self._dirty:
+            return
+        data = dict(
+            (name, dict((klass, task.to_json()) for klass, task in classes.items()))
+            for name, classes in self._tasks.items())
+        temp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(data, f)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            self._logger.exception('Unable to save the runtime history to %s', self.path)
+            return
+        self._dirty = False
+
+    def save_if_due(self):
+        if time.time() >= self._save_at:
+            self.save()
+
+    def report(self, instance, report):
+        """
+        Learn the task classes of a consumer report (see
+        ExecuteConsumer.send_report).
+
+        :return: True if it had any.
+        """
+        classes = report.get('classes')
+        if not classes:
+            return False
+        history = self._tasks.setdefault(instance.name, {})
+        try:
+            for klass, (tasks, busy, buckets) in classes.items():
+                history.setdefault(klass, TaskHistory()).add(int(tasks), float(busy), buckets)
+        except (ValueError, TypeError, AttributeError):
+            self._logger.exception('[%s] Invalid task classes in report %r', instance.name, classes)
+        self._dirty = True
+        return True
+
+    def get(self, instance, klass):
+        return self._tasks.get(instance.name, {}).get(klass)
+
+    def expected(self, instance, klass):
+        """
+        Average duration of a task class, None when it never ran.
+        """
+        task = self.get(instance, klass)
+        return task.average if task is not None else None
+
+    def classes(self, instance):
+        return self._tasks.get(instance.name, {})
+
+    def limits(self, instance, factor, minimum, maximum):
+        """
+        Runtime limit of the task classes of an instance: factor times their
+        99th percentile, between minimum and maximum seconds.
+
+        :return: dict task class -> seconds
+        """
+        return dict(
+            (klass, round(min(max(factor * task.quantile(.99), minimum), maximum), 1))
+            for klass, task in self.classes(instance).items() if task.tasks >= LIMIT_MIN_TASKS)
+
+    def forget(self, instance):
+        if self._tasks.pop(instance.name, None) is not None:
+            self._dirty = True
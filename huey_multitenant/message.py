@@ -0,0 +1,178 @@
+import pickle
+import struct
+import zlib
+
+
+# Pickle opcodes found at the start of a binary pickled tuple.
+PROTO = 0x80
+FRAME = 0x95
+MARK = 0x28
+GLOBAL = 0x63
+STACK_GLOBAL = 0x93
+# String opcodes: opcode -> size of the length prefix.
+_STRING_OPCODES = {
+    0x58: 4,  # BINUNICODE
+    0x8c: 1,  # SHORT_BINUNICODE
+    0x54: 4,  # BINSTRING
+    0x55: 1,  # SHORT_BINSTRING
+    0x42: 4,  # BINBYTES
+    0x43: 1,  # SHORT_BINBYTES
+}
+# Memo opcodes: opcode -> size of the argument.
+_MEMO_OPCODES = {
+    0x71: 1,  # BINPUT
+    0x72: 4,  # LONG_BINPUT
+    0x94: 0,  # MEMOIZE
+}
+
+# Compressed messages are pickled calls to _inflate(task_id, klass_str,
+# codec, body), with the id and class in the clear: the header is read
+# without decompressing the body, and the consumers get the task back from a
+# plain pickle.loads.
+INFLATE = ('huey_multitenant.message', '_inflate')
+CODEC_ZLIB = 'zlib'
+
+
+def _inflate(task_id, klass_str, codec, body):
+    if codec != CODEC_ZLIB:
+        raise ValueError('Unknown message codec %s' % codec)
+    return pickle.loads(zlib.decompress(body))
+
+
+class _Compressed(object):
+
+    def __init__(self, task_id, klass_str, body):
+        self.task_id = task_id
+        self.klass_str = klass_str
+        self.body = body
+
+    def __reduce__(self):
+        return _inflate, (self.task_id, self.klass_str, CODEC_ZLIB, self.body)
+
+
+def message_protocol(use_python3, protocol=0):
+    """
+    Pickle protocol of the messages of an instance: the one of its conf, or
+    the highest one its Python reads.
+    """
+    if not protocol:
+        return 3 if use_python3 else 2
+    if not 2 <= protocol <= pickle.HIGHEST_PROTOCOL:
+        raise ValueError('pickle_protocol must be between 2 and %d' % pickle.HIGHEST_PROTOCOL)
+    if protocol > 2 and not use_python3:
+        raise ValueError('pickle_protocol must be 2 without use_python3')
+    return protocol
+
+
+def encode_message(task_data, protocol, compress_threshold=0):
+    """
+    Pickle a message tuple, compressing it when the pickle is larger than
+    compress_threshold bytes (0 = never) and compression makes it smaller.
+    """
+    message = pickle.dumps(task_data, protocol=protocol)
+    if compress_threshold and len(message) > compress_threshold:
+        compressed = pickle.dumps(_Compressed(task_data[0], task_data[1], zlib.compress(message)), protocol=protocol)
+        if len(compressed) < len(message):
+            return compressed
+    return message
+
+
+def _skip_memo(message, pos):
+    while message[pos] in _MEMO_OPCODES:
+        pos += 1 + _MEMO_OPCODES[message[pos]]
+    return pos
+
+
+def _read_string(message, pos):
+    """
+    :return: (string, position after it), or (None, pos) if there is no
+        string at pos.
+    """
+    size = _STRING_OPCODES.get(message[pos])
+    if size is None:
+        return None, pos
+    pos += 1
+    length = message[pos] if size == 1 else struct.unpack_from('<I', message, pos)[0]
+    pos += size
+    value = message[pos:pos + length]
+    if len(value) != length:
+        return None, pos
+    return value.decode('utf-8'), pos + length
+
+
+def _skip_inflate(message, pos):
+    """
+    Skip the _inflate global of a compressed message.
+
+    :return: position after it, pos if there is none, or None if there is
+        another global.
+    """
+    if message[pos] == GLOBAL:
+        module_end = message.index(b'\n', pos)
+        name_end = message.index(b'\n', module_end + 1)
+        found = (message[pos + 1:module_end].decode('utf-8'), message[module_end + 1:name_end].decode('utf-8'))
+        pos = name_end + 1
+    elif message[pos] in _STRING_OPCODES:
+        module, pos = _read_string(message, pos)
+        name, pos = _read_string(message, _skip_memo(message, pos))
+        pos = _skip_memo(message, pos)
+        if message[pos] != STACK_GLOBAL:
+            return None
+        found = (module, name)
+        pos += 1
+    else:
+        return pos
+    if found != INFLATE:
+        return None
+    return _skip_memo(message, pos)
+
+
+def _read_strings(message, count):
+    """
+    Read the first `count` strings of a binary pickled tuple, or of the
+    arguments of a compressed message.
+
+    :return: list of strings, or None if the message has another layout.
+    """
+    pos = 0
+    if message[pos] == PROTO:
+        pos += 2
+    if message[pos] == FRAME:
+        pos += 9
+    pos = _skip_inflate(message, pos)
+    if pos is None or message[pos] != MARK:
+        return None
+    pos += 1
+
+    fields = []
+    while len(fields) < count:
+        pos = _skip_memo(message, pos)
+        value, pos = _read_string(message, pos)
+        if value is None:
+            return None
+        fields.append(value)
+    return fields
+
+
+def read_header(message):
+    """
+    Read the task id and task class of a queue message.
+
+    Messages are pickled ``(task_id, klass_str, execute_time, retries,
+    retry_delay, data, on_complete)`` tuples, or compressed (see
+    encode_message). The id and class are the first two strings of the
+    stream, so they are read straight from the bytes and the task arguments
+    are never unpickled nor decompressed. Anything else (text protocol, other
+    layouts) falls back to a full unpickle.
+
+    :return: (task_id, klass_str)
+    """
+    try:
+        fields = _read_strings(message, 2)
+    except (IndexError, ValueError, struct.error, UnicodeDecodeError):
+        fields = None
+    if fields is not None:
+        return fields[0], fields[1]
+
+    raw = pickle.loads(message)
+    return raw[0], raw[1]
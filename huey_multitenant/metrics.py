@@ -0,0 +1,219 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('%s="%s"' % extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """
+    A metric with one child per combination of label values.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._create_child())
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(values, None)
+
+    def _create_child(self):
+        raise NotImplementedError
+
+    def collect(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.kind)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._collect_child(values, child))
+        return lines
+
+    def _collect_child(self, values, child):
+        return ['%s%s %s' % (self.name, _format_labels(self.labelnames, values), _format_value(child.get()))]
+
+
+class _Value(object):
+
+    def __init__(self):
+        self._value = 0.
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def set(self, value):
+        self._value = value
+
+    def get(self):
+        return self._value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _create_child(self):
+        return _Value()
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _create_child(self):
+        return _Value()
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def get(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _create_child(self):
+        return _Histogram(self.buckets)
+
+    def _collect_child(self, values, child):
+        counts, total = child.get()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (
+                self.name, _format_labels(self.labelnames, values, ('le', _format_value(bound))), cumulative))
+        labels = _format_labels(self.labelnames, values)
+        lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+        lines.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def remove(self, *values):
+        """
+        Drop the children with the given label values of every metric.
+        """
+        for metric in self.metrics:
+            metric.remove(*values)
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.collect())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'huey_multitenant_queue_depth', 'Pending tasks in the queue.', ['tenant']))
+CONSUMERS = REGISTRY.register(Gauge(
+    'huey_multitenant_consumers', 'Running consumers.', ['tenant']))
+DISPATCH_LATENCY = REGISTRY.register(Histogram(
+    'huey_multitenant_dispatch_latency_seconds',
+    'Seconds from a task first seen at the head of its queue until a consumer is started for it.', ['tenant']))
+SPAWN_SECONDS = REGISTRY.register(Histogram(
+    'huey_multitenant_spawn_seconds', 'Seconds until a consumer process exists.', ['tenant']))
+CONSUMERS_STARTED = REGISTRY.register(Counter(
+    'huey_multitenant_consumers_started_total', 'Consumers started.', ['tenant']))
+CONSUMER_LIFETIME = REGISTRY.register(Histogram(
+    'huey_multitenant_consumer_lifetime_seconds', 'Seconds a consumer ran.', ['tenant']))
+CONSUMER_TASKS = REGISTRY.register(Histogram(
+    'huey_multitenant_consumer_tasks', 'Tasks drained by a consumer.', ['tenant'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)))
+CONSUMER_KILLS = REGISTRY.register(Counter(
+    'huey_multitenant_consumer_kills_total', 'Consumers killed for running too long.', ['tenant']))
+CONSUMER_MEMORY = REGISTRY.register(Gauge(
+    'huey_multitenant_consumer_memory_bytes', 'Learned peak memory of a consumer.', ['tenant']))
+ADMISSION_DEFERRED = REGISTRY.register(Counter(
+    'huey_multitenant_admission_deferred_total', 'Consumers deferred for lack of memory or CPU.', ['tenant']))
+SCHEDULER_LAG = REGISTRY.register(Histogram(
+    'huey_multitenant_scheduler_lag_seconds', 'Seconds the periodic tasks run after the minute starts.'))
+PERIODIC_ENQUEUE_OFFSET = REGISTRY.register(Histogram(
+    'huey_multitenant_periodic_enqueue_offset_seconds', 'Seconds into the minute a periodic task is enqueued.',
+    buckets=(1, 2, 5, 10, 15, 20, 30, 40, 50, 60)))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger().debug('Metrics: ' + format, *args)
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """
+    Serve the metrics in Prometheus text format from a daemon thread.
+    """
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='Metrics')
+    thread.daemon = True
+    thread.start()
+    return server
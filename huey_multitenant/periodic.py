@@ -0,0 +1,63 @@
+# Coalescing of periodic tasks whose previous run is still pending.
+#
+# The state of the last run of every coalesced periodic task of an instance is
+# kept in one Redis hash, task class -> "<queued|running> <task id> <time>".
+# The scheduler enqueues a run only when the policy of the task allows it, and
+# the consumer running it moves the state from queued to running and clears it
+# when done. Every change is a compare-and-set on the task id, so a stale
+# consumer never clears the state of a newer run.
+
+# Coalescing policies, when the previous run is still pending:
+# - none: enqueue the new run anyway.
+# - skip: drop the new run while the previous one is queued or running.
+# - merge: drop the new run while the previous one is queued; while it runs,
+#   queue one more run after it.
+COALESCE_NONE = 'none'
+COALESCE_SKIP = 'skip'
+COALESCE_MERGE = 'merge'
+COALESCE_POLICIES = (COALESCE_NONE, COALESCE_SKIP, COALESCE_MERGE)
+
+PERIODIC_KEY = 'huey.multitenant.periodic.%s'
+# Ids of the coalesced runs, so the consumers know which tasks to track.
+PERIODIC_TASK_PREFIX = 'periodic:'
+
+# A state older than this is ignored, its consumer may have been killed.
+QUEUED_TTL = 60 * 60
+RUNNING_TTL = 20 * 60
+
+# KEYS: periodic hash, queue. ARGV: task class, policy, task id, now, message,
+# queued ttl, running ttl. Returns 1 if the message was enqueued.
+ENQUEUE_PERIODIC_LUA = """
+local state = redis.call('hget', KEYS[1], ARGV[1])
+if state then
+    local kind, at = string.match(state, '^(%S+) %S+ (%S+)$')
+    local ttl = tonumber(kind == 'queued' and ARGV[6] or ARGV[7])
+    if at and tonumber(ARGV[4]) - tonumber(at) < ttl then
+        if kind == 'queued' or ARGV[2] == 'skip' then
+            return 0
+        end
+    end
+end
+redis.call('hset', KEYS[1], ARGV[1], 'queued ' .. ARGV[3] .. ' ' .. ARGV[4])
+redis.call('lpush', KEYS[2], ARGV[5])
+return 1
+"""
+
+# KEYS: periodic hash. ARGV: task class, task id, now.
+START_PERIODIC_LUA = """
+local state = redis.call('hget', KEYS[1], ARGV[1])
+if state and string.match(state, '^queued (%S+) ') == ARGV[2] then
+    redis.call('hset', KEYS[1], ARGV[1], 'running ' .. ARGV[2] .. ' ' .. ARGV[3])
+    return 1
+end
+return 0
+"""
+
+# KEYS: periodic hash. ARGV: task class, task id.
+FINISH_PERIODIC_LUA = """
+local state = redis.call('hget', KEYS[1], ARGV[1])
+if state and string.match(state, '^%S+ (%S+) ') == ARGV[2] then
+    return redis.call('hdel', KEYS[1], ARGV[1])
+end
+return 0
+"""
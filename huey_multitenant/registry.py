@@ -4,7 +4,7 @@ class TaskRegistry(object):
     def __init__(self):
         self._registry = []
 
-    def register(self, task, minute='*', hour='*', day_of_week='*', day='*', month='*'):
+    def register(self, task, minute='*', hour='*', day_of_week='*', day='*', month='*', coalesce='none'):
         for item in self._registry:
             if item['task'] == task:
                 return
@@ -16,10 +16,14 @@ class TaskRegistry(object):
             'day_of_week': day_of_week,
             'day': day,
             'month': month,
+            'coalesce': coalesce,
         })
 
     def task_cron(self, task):
-        return '{} {} {} {} {} {}\n'.format(task['minute'], task['hour'], task['day_of_week'], task['day'], task['month'], task['task'],)
+        line = '{} {} {} {} {} {}'.format(task['minute'], task['hour'], task['day_of_week'], task['day'], task['month'], task['task'],)
+        if task.get('coalesce', 'none') != 'none':
+            line += ' {}'.format(task['coalesce'])
+        return line + '\n'
 
     def get_periodic_tasks(self):
         return self._registry
@@ -0,0 +1,36 @@
+import os
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class FileWatcher(object):
+    """
+    Detect tracked files that were created, modified or deleted, comparing
+    their modification time every time it is asked.
+    """
+
+    def __init__(self):
+        self._mtimes = {}
+
+    def track(self, path):
+        self._mtimes[path] = get_mtime(path)
+
+    def forget(self, path):
+        self._mtimes.pop(path, None)
+
+    def changed(self):
+        """
+        :return: set of tracked paths that changed since the last call.
+        """
+        changed = set()
+        for path, mtime in list(self._mtimes.items()):
+            current = get_mtime(path)
+            if current != mtime:
+                self._mtimes[path] = current
+                changed.add(path)
+        return changed
@@ -1,11 +1,46 @@
+import hashlib
+import heapq
+import itertools
 import logging
-import pickle
+import threading
 import time
 import uuid
 
 from huey.consumer import BaseProcess
 from huey.exceptions import QueueWriteException
-from huey.exceptions import ScheduleReadException
+from redis.exceptions import RedisError
+
+from huey_multitenant.cluster import HEARTBEAT_INTERVAL
+from huey_multitenant.connections import group_by_server
+from huey_multitenant.cron import CronIndex
+from huey_multitenant.metrics import PERIODIC_ENQUEUE_OFFSET, SCHEDULER_LAG
+from huey_multitenant.periodic import COALESCE_NONE, PERIODIC_TASK_PREFIX
+from huey_multitenant.wakeup import ScheduleWatcher, Waker
+
+
+# Periodic tasks are spread over at most this many seconds after the minute
+# starts, so they still run in their minute when the scheduler is late.
+MAX_JITTER = 55
+
+
+def periodic_offset(name, klass, jitter):
+    """
+    Seconds after the start of the minute a periodic task is enqueued, the
+    same on every run and every dispatcher.
+
+    :param name: instance name
+    :param klass: task class, as in the queue
+    :param jitter: window, in seconds
+    """
+    window = int(jitter * 1000)
+    if window <= 0:
+        return 0.
+    value = int(hashlib.md5(('%s:%s' % (name, klass)).encode('utf-8')).hexdigest()[:8], 16)
+    return value % window / 1000.
+
+
+def periodic_klass(task):
+    return 'queue_task_{}'.format(task['method'].split('.')[-1])
 
 
 class Scheduler(BaseProcess):
@@ -14,80 +49,344 @@ class Scheduler(BaseProcess):
     that the scheduler does not actually execute any tasks, but simply enqueues
     them so that they can be picked up by the worker processes.
 
-    If periodic tasks are enabled, the scheduler will wake up every 60 seconds
-    to enqueue any periodic tasks that should be run.
+    The scheduler keeps the time of the earliest scheduled task of every
+    instance and sleeps until the next one is due. It wakes up early when a
+    task is added to a schedule, through keyspace notifications or, when they
+    are not available, by re-reading every schedule each `interval` seconds.
+    Periodic tasks are enqueued at the start of every minute or, with a
+    jitter, each one at a fixed offset into its minute.
+
+    In cluster mode only the scheduler of the node holding the scheduler
+    lease runs; the others keep following the minutes to take over.
     """
-    def __init__(self, instances, interval, utc):
+    def __init__(self, instances, interval, utc, cluster=None, jitter=0):
         self._logger = logging.getLogger()
         self._logger.info('Init Scheduler')
 
         self.instances = instances
         self.interval = min(interval, 60)
         self.utc = utc
-        self._counter = 0
-        self._q, self._r = divmod(60, self.interval)
-        self._cr = self._r
-        self._next_loop = time.time()
+        self._next_loop = self.next_minute(time.time())
+        self.jitter = min(max(jitter, 0), MAX_JITTER)
+        # Periodic tasks of the minute waiting for their offset: heap of
+        # (time, counter, app, task).
+        self._spread = []
+        self._counter = itertools.count()
+        # Periodic tasks enqueued by second of the current minute.
+        self._shape = {}
+        self.cron = CronIndex(instances, self.get_now())
+        for fire_at, name, method in self.cron.next_fire_times():
+            self._logger.debug('Next run of %s %s: %s', name, method, fire_at)
+        self._next_due = {}
+        self._refresh_at = 0
+        self.waker = None
+        self.watchers = []
+        self._watched = set()
+        self._update = None
+        self._lock = threading.Lock()
+        self.cluster = cluster
+        self.leading = cluster is None
+
+    def initialize(self):
+        """
+        Start listening to schedule changes. Called in the scheduler process.
+        """
+        self.waker = Waker()
+        self.watch(self.instances)
+
+    def watch(self, instances):
+        """
+        Listen to the schedules of every Redis server of the instances that
+        is not watched yet.
+        """
+        for group in group_by_server(instances):
+            pool = group[0].storage.pool
+            if id(pool) in self._watched:
+                continue
+            self._watched.add(id(pool))
+            watcher = ScheduleWatcher(group[0].storage.conn, self.waker)
+            watcher.start()
+            self.watchers.append(watcher)
+
+    def update_instances(self, instances, changed=()):
+        """
+        Replace the instances to schedule, only when the scheduler runs in a
+        thread of the dispatcher. Applied by the scheduler on its next loop.
+
+        :param changed: instances whose periodic tasks were read again.
+        """
+        with self._lock:
+            if self._update is not None:
+                changed = self._update[1] | set(changed)
+            self._update = (list(instances), set(changed))
+        if self.waker is not None:
+            self.waker.wake()
+
+    def apply_update(self):
+        with self._lock:
+            update, self._update = self._update, None
+        if update is None:
+            return
+
+        instances, changed = update
+        current = set(self.instances)
+        self.cron.remove([app for app in self.instances if app not in instances or app in changed])
+        now = self.get_now()
+        for app in instances:
+            if app not in current or app in changed:
+                self.cron.add(app, now)
+
+        names = set(app.name for app in instances)
+        for name in list(self._next_due):
+            if name not in names:
+                del self._next_due[name]
+
+        self.instances = instances
+        if any(app not in current for app in instances):
+            # Read the earliest scheduled task of the new instances.
+            self._refresh_at = 0
+            if self.waker is not None:
+                self.watch(instances)
+
+    @staticmethod
+    def next_minute(ts):
+        return (int(ts) // 60 + 1) * 60
+
+    def get_score(self, now):
+        """
+        Schedule score of a datetime (as RedisStorage.convert_ts), keeping the
+        sub-second part.
+        """
+        return time.mktime(now.timetuple()) + now.microsecond / 1e6
+
+    def lead(self):
+        """
+        :return: True if this scheduler must run, see Cluster.lead.
+        """
+        if self.cluster is None:
+            return True
+        try:
+            leading = self.cluster.lead()
+        except RedisError:
+            self._logger.exception('Error renewing the scheduler lease.')
+            leading = False
+        if leading != self.leading:
+            self._logger.info('Scheduler %s on %s', 'leading' if leading else 'following', self.cluster.node_id)
+            if leading:
+                # Read every schedule again, they changed meanwhile.
+                self._refresh_at = 0
+            else:
+                self._next_due = {}
+            self.leading = leading
+        return leading
 
     def loop(self, now=None):
-        current = self._next_loop
-        self._next_loop += self.interval
-        if self._next_loop < time.time():
-            self._logger.info('scheduler skipping iteration to avoid race.')
+        self.apply_update()
+        if not self.lead():
+            # Let the minutes go by, to run from the next one when leading.
+            self.pop_periodic_tasks()
+            self.wait()
             return
 
+        self.refresh_due()
+
+        now = now or self.get_now()
+        self.read_schedules(now, self.get_due(now))
+        self.enqueue_periodic_tasks(self.pop_periodic_tasks())
+
+        self.wait()
+
+    def get_due(self, now):
+        """
+        Instances with scheduled tasks due at now.
+        """
+        score = self.get_score(now)
+        return [app for app in self.instances if self._next_due.get(app.name, score + 1) <= score]
+
+    def pop_periodic_tasks(self):
+        """
+        Periodic tasks to enqueue: the ones due when a new minute started,
+        as their offset into the minute comes (see periodic_offset).
+
+        :return: list of (app, task)
+        """
+        current = time.time()
+        if current >= self._next_loop:
+            start = self._next_loop
+            SCHEDULER_LAG.labels().observe(current - start)
+            if current >= start + 60:
+                self._logger.info('scheduler skipped %d minute(s).', (current - start) // 60)
+            self.report_shape()
+            self._next_loop = self.next_minute(current)
+            minute = self._next_loop - 60
+            for app, task in self.cron.pop_due(self.get_now()):
+                fire_at = minute + periodic_offset(app.name, periodic_klass(task), self.jitter)
+                heapq.heappush(self._spread, (fire_at, next(self._counter), app, task))
+
+        tasks = []
+        instances = set(self.instances)
+        while self._spread and self._spread[0][0] <= current:
+            _, _, app, task = heapq.heappop(self._spread)
+            if app in instances:
+                tasks.append((app, task))
+        return tasks
+
+    def count_enqueued(self):
+        """
+        Account a periodic task enqueued now in the load shape of the minute.
+        """
+        offset = time.time() % 60
+        PERIODIC_ENQUEUE_OFFSET.labels().observe(offset)
+        with self._lock:
+            self._shape[int(offset)] = self._shape.get(int(offset), 0) + 1
+
+    def report_shape(self):
+        """
+        Log how the periodic tasks of the last minute were spread.
+        """
+        with self._lock:
+            shape, self._shape = self._shape, {}
+        if shape:
+            self._logger.info('%d periodic tasks enqueued over %d second(s), at most %d in one second.',
+                              sum(shape.values()), len(shape), max(shape.values()))
+
+    def get_timeout(self):
+        """
+        Seconds until the next scheduled task is due, the next minute starts
+        or the next spread periodic task comes.
+        """
+        timeout = min(self._next_loop, self._refresh_at) - time.time()
+        if self._spread:
+            timeout = min(timeout, self._spread[0][0] - time.time())
+        if self._next_due:
+            timeout = min(timeout, min(self._next_due.values()) - self.get_score(self.get_now()))
+        if self.cluster is not None:
+            timeout = min(timeout, HEARTBEAT_INTERVAL)
+        return max(timeout, 0)
+
+    def wait(self):
+        """
+        Sleep until the next scheduled task is due, the next minute starts or
+        a schedule changes.
+        """
+        timeout = self.get_timeout()
+        if self.waker is not None:
+            self.waker.wait(timeout)
+        else:
+            time.sleep(timeout)
+
+    def _set_due(self, app, score):
+        if score is None:
+            self._next_due.pop(app.name, None)
+        else:
+            self._next_due[app.name] = float(score)
+
+    def refresh_due(self):
+        """
+        Read the earliest scheduled task of every schedule that changed, or of
+        every schedule when notifications are not available.
+        """
+        for group in group_by_server(self.pop_stale()):
+            self.refresh_group(group)
+
+    def pop_stale(self):
+        """
+        Instances whose earliest scheduled task must be read again.
+        """
+        changed = set()
+        for watcher in self.watchers:
+            changed |= watcher.pop_changed()
+
+        if time.time() >= self._refresh_at or None in changed:
+            instances = self.instances
+            if self.watchers and all(watcher.enabled for watcher in self.watchers):
+                self._refresh_at = float('inf')
+            else:
+                self._refresh_at = time.time() + self.interval
+        elif changed:
+            instances = [app for app in self.instances if app.storage.schedule_key in changed]
+        else:
+            instances = []
+        return instances
+
+    def refresh_group(self, group):
+        """
+        Read the earliest scheduled task of instances of the same Redis server.
+        """
+        pipe = group[0].storage.conn.pipeline(transaction=False)
+        for app in group:
+            app.get_next_scheduled(pipe)
         try:
-            for app in self.instances:
-                task_list = app.get_schedule(now or self.get_now())
-                for task in task_list:
-                    self.enqueue_task(app, task)
-        except ScheduleReadException:
+            results = pipe.execute()
+        except RedisError:
             self._logger.exception('Error reading from task schedule.')
+            return
+        for app, score in zip(group, results):
+            self._set_due(app, score)
+
+    def read_schedules(self, now, instances):
+        """
+        Move due scheduled tasks to their queues, reading the schedules of all
+        the instances of a Redis server in one pipelined round trip.
+        """
+        for group in group_by_server(instances):
+            self.read_group(now, group)
 
-        # The scheduler has an interesting property of being able to run at
-        # intervals that are not factors of 60. Suppose we ask our
-        # scheduler to run every 45 seconds. We still want to schedule
-        # periodic tasks once per minute, however. So we use a running
-        # remainder to ensure that no matter what interval the scheduler is
-        # running at, we still are enqueueing tasks once per minute at the
-        # same time.
-        if self._counter >= self._q:
-            self._counter = 0
-            if self._cr:
-                self.sleep_for_interval(current, self._cr)
-            if self._r:
-                self._cr += self._r
-                if self._cr >= self.interval:
-                    self._cr -= self.interval
-                    self._counter -= 1
-
-            self.enqueue_periodic_tasks(now or self.get_now(), current)
-        self._counter += 1
-
-        self.sleep_for_interval(current, self.interval)
-
-    def enqueue_periodic_tasks(self, now, start):
-        for app in self.instances:
-            # Defino el protocolo de pickle que tengo que usar para serializar las tareas
-            # Ver https://docs.python.org/3/library/pickle.html#data-stream-format
-            pickle_protocol = 3 if app.use_python3 else 2
-            for task in app.get_periodic_tasks(now):
-                self._logger.info('Scheduling periodic task %s.', task)
-                # En lugar de llamar al comando enqueue_task se genera la entrada en Redis a mano.
-                task_data = (
-                    str(uuid.uuid4()),
-                    'queue_task_{}'.format(task['method'].split('.')[-1]),
-                    None,
-                    0,
-                    0,
-                    ((), {}),
-                    None
-                )
-                msg = pickle.dumps(task_data, protocol=pickle_protocol)
+    def read_group(self, now, group):
+        pipe = group[0].storage.conn.pipeline(transaction=False)
+        for app in group:
+            app.get_schedule(now, pipe)
+            app.get_next_scheduled(pipe)
+        try:
+            results = pipe.execute()
+        except RedisError:
+            self._logger.exception('Error reading from task schedule.')
+            # Try again in a second.
+            for app in group:
+                self._set_due(app, self.get_score(now) + 1)
+            return
+
+        for app, task_list, score in zip(group, results[::2], results[1::2]):
+            for task in task_list or []:
+                self.enqueue_task(app, task)
+            self._set_due(app, score)
+
+    def enqueue_periodic_tasks(self, tasks):
+        """
+        :param tasks: list of (app, task), see pop_periodic_tasks.
+        """
+        for app, task in tasks:
+            self._logger.info('Scheduling periodic task %s.', task)
+            # En lugar de llamar al comando enqueue_task se genera la entrada en Redis a mano.
+            task_data = (
+                self.periodic_task_id(task),
+                periodic_klass(task),
+                None,
+                0,
+                0,
+                ((), {}),
+                None
+            )
+            msg = app.encode_message(task_data)
+            coalesce = task.get('coalesce', COALESCE_NONE)
+            if coalesce == COALESCE_NONE:
                 app.storage.enqueue(msg)
+            elif not app.enqueue_periodic(task_data[1], coalesce, task_data[0], msg):
+                self._logger.info('Periodic task %s not enqueued, its previous run is still pending (%s).',
+                                  task['method'], coalesce)
+                continue
+            self.count_enqueued()
 
         return True
 
+    def periodic_task_id(self, task):
+        """
+        Runs of coalesced periodic tasks are told apart by the consumers.
+        """
+        if task.get('coalesce', COALESCE_NONE) == COALESCE_NONE:
+            return str(uuid.uuid4())
+        return PERIODIC_TASK_PREFIX + str(uuid.uuid4())
+
     def enqueue_task(self, app, task):
         """
         Convenience method for enqueueing a task.
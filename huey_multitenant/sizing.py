@@ -0,0 +1,67 @@
+import json
+import logging
+import math
+
+
+# Pending tasks should be done in about this many seconds.
+DRAIN_TIME = 10.
+# Seconds per task assumed until an instance reports.
+DEFAULT_TASK_DURATION = 1.
+DURATION_SMOOTHING = 0.3
+
+
+class ConsumerSizing(object):
+    """
+    Choose how many workers a new consumer of an instance gets, from the
+    length of its queue and the average duration of its tasks, as reported by
+    the consumers that finished.
+
+    The workers already running for the instance count against its backlog,
+    so no consumer is started while they are enough to drain it in
+    DRAIN_TIME seconds. The `workers` setting of the instance is a floor as
+    long as that many tasks are pending: short tasks are drained by a whole
+    consumer, not by one worker that backs off between them.
+    """
+
+    def __init__(self, drain_time=DRAIN_TIME):
+        self._logger = logging.getLogger()
+        self.drain_time = drain_time
+        self._duration = {}
+
+    def duration(self, instance):
+        return self._duration.get(instance.name, DEFAULT_TASK_DURATION)
+
+    def report(self, instance, reports):
+        """
+        Learn the duration of the tasks of an instance.
+
+        :param reports: JSON reports sent by ExecuteConsumer.send_report
+        :return: the valid reports, decoded
+        """
+        valid = []
+        for report in reports:
+            try:
+                report = json.loads(report.decode('utf-8'))
+                tasks, busy = int(report['tasks']), float(report['busy'])
+            except (ValueError, KeyError, TypeError):
+                self._logger.exception('[%s] Invalid consumer report %r', instance.name, report)
+                continue
+            valid.append(report)
+            if tasks:
+                duration = self.duration(instance)
+                self._duration[instance.name] = duration + DURATION_SMOOTHING * (busy / tasks - duration)
+        self._logger.debug('[%s] Task duration %.3fs', instance.name, self.duration(instance))
+        return valid
+
+    def workers(self, instance, pending, running):
+        """
+        :param pending: length of the queue of the instance
+        :param running: workers of the consumers running for the instance
+        :return: workers for a new consumer, 0 when none is needed.
+        """
+        wanted = int(math.ceil(pending * self.duration(instance) / self.drain_time))
+        wanted = max(wanted, min(pending, instance.workers))
+        return max(min(wanted - running, instance.workers), 0)
+
+    def forget(self, instance):
+        self._duration.pop(instance.name, None)
@@ -0,0 +1,62 @@
+from __future__ import unicode_literals, absolute_import
+
+import os
+import sys
+
+
+def get_project_root():
+    """
+    Folder of the running manage.py.
+    """
+    return os.path.dirname(os.path.abspath(sys.argv[0])) + os.sep
+
+
+def get_source_file(module):
+    """
+    Source file of a loaded module, or None when it has no file.
+    """
+    filename = getattr(module, '__file__', None)
+    if not filename:
+        return None
+    filename = os.path.abspath(filename)
+    if filename.endswith(('.pyc', '.pyo')) and os.path.exists(filename[:-1]):
+        filename = filename[:-1]
+    return filename
+
+
+def get_mtime(filename):
+    """
+    Modification time of a file in integer microseconds, the same from Python
+    2 and 3, so it can be compared exactly and written without losing digits.
+
+    :raises OSError: the file does not exist.
+    """
+    return int(round(os.stat(filename).st_mtime * 1000000))
+
+
+def get_project_sources(extra_modules=()):
+    """
+    Modification times of every loaded module that lives inside the project,
+    plus the given modules wherever they live.
+
+    :return: dict filename -> mtime, as returned by get_mtime()
+    """
+    root = get_project_root()
+    filenames = set()
+    for module in list(sys.modules.values()):
+        filename = get_source_file(module)
+        if filename and filename.startswith(root):
+            filenames.add(filename)
+    for module in extra_modules:
+        filename = get_source_file(module)
+        if filename:
+            filenames.add(filename)
+    filenames.add(os.path.abspath(sys.argv[0]))
+
+    sources = {}
+    for filename in filenames:
+        try:
+            sources[filename] = get_mtime(filename)
+        except OSError:
+            pass
+    return sources
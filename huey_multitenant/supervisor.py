@@ -0,0 +1,172 @@
+import heapq
+import itertools
+import logging
+import os
+import select
+import subprocess
+import time
+
+from huey_multitenant.metrics import CONSUMER_KILLS
+
+
+def open_pidfd(pid):
+    """
+    File descriptor that becomes readable when the process exits, or None
+    when pidfds are not supported (Linux 5.3+ and Python 3.9+ only).
+
+    :raises ProcessLookupError: the process does not exist anymore.
+    """
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except ProcessLookupError:
+        raise
+    except OSError:
+        return None
+
+
+def wait_process(process, timeout):
+    """
+    Like process.wait(timeout), blocking on a pidfd instead of sleep-polling
+    when possible.
+
+    :raises subprocess.TimeoutExpired: the process is still running.
+    """
+    try:
+        fd = open_pidfd(process.pid)
+    except ProcessLookupError:
+        fd = None
+    if fd is None:
+        return process.wait(timeout)
+    try:
+        readable, _, _ = select.select([fd], [], [], timeout)
+    finally:
+        os.close(fd)
+    if not readable:
+        raise subprocess.TimeoutExpired(process.args, timeout)
+    return process.wait()
+
+
+class Supervisor(object):
+    """
+    Running consumers. Their slots are released as soon as they exit and the
+    ones running for too long are killed.
+
+    Every consumer gets a pidfd registered with the waker, so an exit wakes
+    the dispatcher up and only that consumer is checked. Without pidfds the
+    waker is woken up by SIGCHLD instead, and consumers are only polled after
+    one arrives. Deadlines are kept in a heap, so only the consumers that
+    reach theirs are looked at.
+    """
+
+    def __init__(self, waker, max_seconds_running):
+        self._logger = logging.getLogger()
+        self.waker = waker
+        self.max_seconds_running = max_seconds_running
+        self.use_pidfd = hasattr(os, 'pidfd_open')
+        self._consumers = set()
+        self._pidfds = {}
+        # Consumers that exited, or may have exited, but are not released yet.
+        self._exited = set()
+        # Consumers without pidfd, polled after a SIGCHLD. Forked consumers
+        # are children of the fork server, so they are polled every time.
+        self._polled = set()
+        self._sigchld = False
+        self._deadlines = []
+        self._counter = itertools.count()
+        if not self.use_pidfd:
+            self.watch_children()
+
+    def __len__(self):
+        return len(self._consumers)
+
+    def watch_children(self):
+        self.use_pidfd = False
+        self._sigchld = True
+        self.waker.watch_children(self._on_sigchld)
+
+    def _on_sigchld(self):
+        self._sigchld = True
+
+    def add(self, consumer):
+        self._consumers.add(consumer)
+        heapq.heappush(self._deadlines, (
+            consumer.started + self.max_seconds_running, next(self._counter), consumer))
+        if not self.use_pidfd or consumer.process.pid is None:
+            # A consumer asked to a fork server has no PID until it is forked.
+            self._polled.add(consumer)
+            return
+
+        try:
+            fd = open_pidfd(consumer.process.pid)
+        except ProcessLookupError:
+            self._exited.add(consumer)
+            return
+        if fd is None:
+            self._logger.info('pidfds not supported, waiting for SIGCHLD instead')
+            self.watch_children()
+            self._polled.add(consumer)
+            return
+        self._pidfds[consumer] = fd
+        self.waker.register(fd, lambda: self._on_exit(consumer))
+
+    def _on_exit(self, consumer):
+        self._close_pidfd(consumer)
+        self._exited.add(consumer)
+
+    def _close_pidfd(self, consumer):
+        fd = self._pidfds.pop(consumer, None)
+        if fd is not None:
+            self.waker.unregister(fd)
+            os.close(fd)
+
+    def remove(self, consumer):
+        self._close_pidfd(consumer)
+        self._consumers.discard(consumer)
+        self._exited.discard(consumer)
+        self._polled.discard(consumer)
+
+    def reap(self):
+        """
+        :return: consumers that exited since the last call.
+        """
+        candidates = list(self._exited)
+        if self._sigchld:
+            self._sigchld = False
+            candidates.extend(self._polled)
+        else:
+            candidates.extend(consumer for consumer in self._polled if consumer.is_forked)
+
+        finished = []
+        for consumer in set(candidates):
+            # A forked consumer is only released once its fork server
+            # reported the exit, which wakes the dispatcher up as well.
+            if consumer.process.poll() is not None:
+                self.remove(consumer)
+                finished.append(consumer)
+        return finished
+
+    def expire(self, now=None):
+        """
+        Kill the consumers past their deadline. A killed consumer gets a new
+        deadline, in case it does not die.
+        """
+        now = now or time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, consumer = heapq.heappop(self._deadlines)
+            if consumer not in self._consumers or consumer in self._exited:
+                continue
+            CONSUMER_KILLS.labels(consumer.app.name).inc()
+            consumer.kill_consumer()
+            heapq.heappush(self._deadlines, (now + self.max_seconds_running, next(self._counter), consumer))
+
+    def timeout(self, timeout, now=None):
+        """
+        Seconds to wait for events, no later than the next deadline.
+        """
+        while self._deadlines and self._deadlines[0][2] not in self._consumers:
+            heapq.heappop(self._deadlines)
+        if not self._deadlines:
+            return timeout
+        return max(min(timeout, self._deadlines[0][0] - (now or time.time())), 0)
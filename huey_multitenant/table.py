@@ -0,0 +1,44 @@
+class ConsumerTable(object):
+    """
+    Running consumers, indexed by the task id they were started for and by
+    tenant, so the dispatcher checks run in constant time. Consumers asked to
+    a fork server have no PID yet, so they are not indexed by PID.
+    """
+
+    def __init__(self):
+        self._consumers = set()
+        self._by_task = {}
+        self._by_tenant = {}
+
+    def __len__(self):
+        return len(self._consumers)
+
+    def __iter__(self):
+        return iter(list(self._consumers))
+
+    def add(self, consumer):
+        self._consumers.add(consumer)
+        self._by_task[consumer.task_id] = consumer
+        self._by_tenant.setdefault(consumer.app.name, set()).add(consumer)
+
+    def remove(self, consumer):
+        self._consumers.discard(consumer)
+        if self._by_task.get(consumer.task_id) is consumer:
+            del self._by_task[consumer.task_id]
+        tenant = self._by_tenant.get(consumer.app.name)
+        if tenant is not None:
+            tenant.discard(consumer)
+            if not tenant:
+                del self._by_tenant[consumer.app.name]
+
+    def has_task(self, task_id):
+        return task_id in self._by_task
+
+    def count(self, instance):
+        """
+        Number of consumers running for the instance.
+        """
+        return len(self._by_tenant.get(instance.name, ()))
+
+    def for_instance(self, instance):
+        return list(self._by_tenant.get(instance.name, ()))
@@ -0,0 +1,206 @@
+import logging
+import os
+import selectors
+import signal
+import threading
+import time
+
+from redis.exceptions import ConnectionError, ResponseError
+
+
+RECONNECT_DELAY = 5
+NOTIFY_KEYSPACE_EVENTS = 'notify-keyspace-events'
+
+
+def missing_flags(current, flags):
+    """
+    :return: the keyspace notification flags of `flags` that the server
+        configuration `current` does not enable.
+    """
+    return ''.join(flag for flag in flags if flag not in current and not (flag != 'K' and 'A' in current))
+
+
+def read_notifications(conn):
+    return conn.config_get(NOTIFY_KEYSPACE_EVENTS).get(NOTIFY_KEYSPACE_EVENTS, '')
+
+
+def configure_notifications(conn, flags):
+    """
+    Enable the keyspace notifications `flags` of a Redis server in a single
+    update, with the flags of every watcher of the server so that they do not
+    overwrite each other, and read the configuration back.
+
+    :return: True if the server publishes all of them.
+    """
+    logger = logging.getLogger()
+    try:
+        current = read_notifications(conn)
+        missing = missing_flags(current, flags)
+        if not missing:
+            return True
+        conn.config_set(NOTIFY_KEYSPACE_EVENTS, current + missing)
+        current = read_notifications(conn)
+    except (ConnectionError, ResponseError):
+        logger.exception('Unable to enable keyspace notifications %s', flags)
+        return False
+    if missing_flags(current, flags):
+        logger.error('Keyspace notifications %s were not enabled, the server has %s', flags, current or 'none')
+        return False
+    logger.info('Enabled keyspace notifications (%s)', current)
+    return True
+
+
+class Waker(object):
+    """
+    Self-pipe the dispatcher blocks on. Anything that may produce work or free
+    a consumer slot wakes it: new messages in a queue, a child that exits, or
+    a registered file descriptor that becomes readable.
+    """
+
+    def __init__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self._read_fd, selectors.EVENT_READ)
+
+    def wake(self):
+        try:
+            os.write(self._write_fd, b'\0')
+        except BlockingIOError:
+            # The pipe is full, the dispatcher is already going to wake up.
+            pass
+
+    def watch_children(self, callback=None):
+        """
+        Wake up every time a child process exits, calling callback from the
+        signal handler. Must be called from the main thread.
+        """
+        def handler(signum, frame):
+            if callback is not None:
+                callback()
+        signal.signal(signal.SIGCHLD, handler)
+        signal.set_wakeup_fd(self._write_fd)
+
+    def register(self, fd, callback):
+        self.selector.register(fd, selectors.EVENT_READ, callback)
+
+    def unregister(self, fd):
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def wait(self, timeout):
+        """
+        Block until something happens or timeout seconds pass.
+
+        :return: True if woken up by an event.
+        """
+        events = self.selector.select(timeout)
+        for key, _ in events:
+            if key.fd == self._read_fd:
+                try:
+                    while os.read(self._read_fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            else:
+                key.data()
+        return bool(events)
+
+
+class KeyspaceWatcher(object):
+    """
+    Listen to keyspace notifications of the huey keys of a Redis server that
+    match `key_pattern`, and call on_event() for every event in `events`.
+    """
+    key_pattern = None
+    flags = 'K'
+    events = ()
+
+    def __init__(self, conn, waker):
+        self._logger = logging.getLogger()
+        self.conn = conn
+        self.waker = waker
+        db = conn.connection_pool.connection_kwargs.get('db', 0)
+        self.prefix = '__keyspace@%d__:' % db
+        self.enabled = False
+
+    def check_notifications(self):
+        """
+        Check that the server publishes the keyspace notifications we need,
+        as configured by the operator or with --configure-notifications.
+        """
+        try:
+            missing = missing_flags(read_notifications(self.conn), self.flags)
+        except (ConnectionError, ResponseError):
+            self._logger.exception('Unable to read keyspace notifications, waking up by timeout only')
+            return False
+        if missing:
+            self._logger.warning('Keyspace notifications %s are not enabled for %s, waking up by timeout only '
+                                 '(set notify-keyspace-events or use --configure-notifications)',
+                                 missing, self.key_pattern)
+            return False
+        return True
+
+    def start(self):
+        self.enabled = self.check_notifications()
+        if self.enabled:
+            thread = threading.Thread(target=self.run, name=type(self).__name__)
+            thread.daemon = True
+            thread.start()
+
+    def on_event(self, key):
+        self.waker.wake()
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self.conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.prefix + self.key_pattern)
+                for message in pubsub.listen():
+                    if message['data'] in self.events:
+                        self.on_event(message['channel'][len(self.prefix):].decode('utf-8'))
+            except ConnectionError:
+                self._logger.exception('Lost keyspace notifications connection')
+            # Something may have changed while disconnected.
+            self.on_event(None)
+            time.sleep(RECONNECT_DELAY)
+
+
+class QueueWatcher(KeyspaceWatcher):
+    """
+    Wake up as soon as a message is pushed to any huey queue.
+    """
+    key_pattern = 'huey.redis.*'
+    flags = 'Kl'
+    events = (b'lpush', b'rpush', b'linsert')
+
+
+class ScheduleWatcher(KeyspaceWatcher):
+    """
+    Wake up as soon as a task is added to any huey schedule, remembering which
+    schedules changed.
+    """
+    key_pattern = 'huey.schedule.*'
+    flags = 'Kz'
+    events = (b'zadd',)
+
+    def __init__(self, conn, waker):
+        super(ScheduleWatcher, self).__init__(conn, waker)
+        self.changed = set()
+        self._lock = threading.Lock()
+
+    def on_event(self, key):
+        with self._lock:
+            self.changed.add(key)
+        self.waker.wake()
+
+    def pop_changed(self):
+        """
+        :return: keys of the schedules that changed, None meaning any of them.
+        """
+        with self._lock:
+            changed, self.changed = self.changed, set()
+        return changed
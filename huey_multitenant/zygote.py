@@ -0,0 +1,218 @@
+import collections
+import errno
+import logging
+import os
+import subprocess
+import time
+
+from huey_multitenant.metrics import SPAWN_SECONDS
+from huey_multitenant.supervisor import wait_process
+
+
+FORK_TIMEOUT = 5
+
+# Return code of a consumer the fork server did not fork in time.
+FORK_FAILED = -1
+
+
+class ForkedProcess(object):
+    """
+    Process forked by a fork server. Mimics the parts of subprocess.Popen
+    used by the dispatcher.
+
+    The PID is None until the fork server answers; if it does not answer in
+    FORK_TIMEOUT seconds the process ends with FORK_FAILED.
+    """
+
+    def __init__(self, zygote, pid=None):
+        self.zygote = zygote
+        self.server = zygote.process
+        self.pid = pid
+        self.returncode = None
+        self.requested_at = time.time()
+        self.deadline = self.requested_at + FORK_TIMEOUT
+
+    def poll(self):
+        if self.returncode is None:
+            if self.pid is None:
+                self.zygote.check_pending()
+            else:
+                self.returncode = self.zygote.poll_child(self.pid, self.server)
+        return self.returncode
+
+    def fail(self):
+        self.returncode = FORK_FAILED
+
+    def communicate(self):
+        return None, None
+
+
+class Zygote(object):
+    """
+    Client for the tenant fork server (``manage.py forkserver``).
+
+    The fork server keeps settings and task modules loaded and forks an
+    ExecuteConsumer on request. It is started lazily; until it reports that
+    it is ready, and whenever it fails, fork() returns None and the caller
+    falls back to a cold ``execute_task``.
+
+    fork() does not wait for the answer: the fork server answers the requests
+    in order, and the answers are read when the status pipe becomes readable
+    (see read_messages). A fork server that does not answer in time is
+    restarted, and the consumers waiting for it fail.
+    """
+
+    def __init__(self, app):
+        self._logger = logging.getLogger()
+        self.app = app
+        self.waker = None
+        self.process = None
+        self.ready = False
+        self.control_fd = None
+        self.status_fd = None
+        self._buffer = b''
+        self._pending = collections.deque()
+        self._exited = {}
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        control_r, self.control_fd = os.pipe()
+        self.status_fd, status_w = os.pipe()
+        os.set_blocking(self.status_fd, False)
+
+        cmd = self.app.build_command(
+            'forkserver --no-periodic -k %s -w %s --control-fd %d --status-fd %d' % (
+                self.app.worker_type, self.app.workers, control_r, status_w))
+        self.process = subprocess.Popen(cmd, shell=False, pass_fds=(control_r, status_w))
+        os.close(control_r)
+        os.close(status_w)
+        self.ready = False
+        self._buffer = b''
+        if self.waker is not None:
+            self.waker.register(self.status_fd, self.read_messages)
+        self._logger.info('[{}] forkserver PID: {}'.format(self.app.name, self.process.pid))
+
+    def stop(self):
+        if self.control_fd is not None:
+            try:
+                os.write(self.control_fd, b'stop\n')
+            except OSError:
+                pass
+            if self.waker is not None:
+                self.waker.unregister(self.status_fd)
+            os.close(self.control_fd)
+            os.close(self.status_fd)
+            self.control_fd = self.status_fd = None
+        if self.process is not None:
+            try:
+                wait_process(self.process, FORK_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+        self.ready = False
+        while self._pending:
+            self._pending.popleft().fail()
+
+    def read_messages(self):
+        """
+        Consume every pending message from the fork server.
+        """
+        if self.status_fd is None:
+            return
+        while True:
+            try:
+                data = os.read(self.status_fd, 4096)
+            except OSError as exc:
+                if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                self.ready = False
+                break
+            self._buffer += data
+
+        lines = self._buffer.split(b'\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            message = line.decode('ascii').split()
+            if not message:
+                continue
+            if message[0] == 'ready':
+                self._logger.info('[{}] forkserver ready'.format(self.app.name))
+                self.ready = True
+            elif message[0] == 'forked':
+                self._forked(int(message[1]))
+            elif message[0] == 'exit':
+                self._exited[int(message[1])] = int(message[2])
+            elif message[0] == 'recycle':
+                self._logger.info('[{}] forkserver recycled, code changed'.format(self.app.name))
+                self.ready = False
+
+    def fork(self, workers=None):
+        """
+        Ask the fork server for a new consumer.
+
+        :return: ForkedProcess or None when the fork server is not available.
+        """
+        if not self.is_alive():
+            if self.process is not None:
+                self.stop()
+            self.start()
+            return None
+
+        self.read_messages()
+        if not self.ready:
+            if not self.is_alive():
+                self.stop()
+            return None
+
+        try:
+            os.write(self.control_fd, ('fork %d\n' % int(workers or self.app.workers)).encode('ascii'))
+        except OSError:
+            self.stop()
+            return None
+
+        process = ForkedProcess(self)
+        self._pending.append(process)
+        return process
+
+    def _forked(self, pid):
+        if not self._pending:
+            self._logger.error('[{}] forkserver forked PID {} unasked'.format(self.app.name, pid))
+            return
+        process = self._pending.popleft()
+        process.pid = pid
+        SPAWN_SECONDS.labels(self.app.name).observe(time.time() - process.requested_at)
+        self._logger.info('[{}] execute_task PID: {} (forked)'.format(self.app.name, pid))
+
+    def check_pending(self):
+        """
+        Read the answers of the fork server, and restart it when it did not
+        answer a request in time.
+        """
+        self.read_messages()
+        if self._pending and (time.time() >= self._pending[0].deadline or not self.is_alive()):
+            self._logger.error('[{}] forkserver did not answer, restarting it'.format(self.app.name))
+            if self.is_alive():
+                self.process.kill()
+            self.stop()
+
+    def poll_child(self, pid, server):
+        """
+        Return code of a forked consumer or None while it is running.
+        """
+        self.read_messages()
+        if pid in self._exited:
+            return self._exited.pop(pid)
+        if server is self.process and self.is_alive():
+            return None
+
+        # The fork server is gone, so nobody reports the exit anymore.
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return 0
+        return None
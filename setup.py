@@ -13,7 +13,7 @@ setup(
     author='InvGate Discover Team',
     author_email='neoassets@invgate.com',
     url='https://github.com/InvGate/huey-multitenant',
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'tests.*']),
     install_requires=["click", "huey", "redis"],
     package_data={
         'huey_multitenant': [
@@ -29,8 +29,9 @@ setup(
     ],
     entry_points={
         'console_scripts': [
-            'huey_multitenant = huey_multitenant.bin.dispatcherctl:consumer_main'
+            'huey_multitenant = huey_multitenant.bin.dispatcherctl:consumer_main',
+            'huey_multitenant_enqueue = huey_multitenant.bin.enqueuectl:enqueue_main',
         ]
     },
-    scripts=['huey_multitenant/bin/dispatcherctl.py'],
+    scripts=['huey_multitenant/bin/dispatcherctl.py', 'huey_multitenant/bin/enqueuectl.py'],
 )
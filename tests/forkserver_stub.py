@@ -0,0 +1,34 @@
+import os
+import sys
+import time
+
+
+# Stand-in for ``manage.py forkserver``, speaking the protocol of
+# huey_multitenant.consumer.ForkServer:
+# - fork: forks a consumer that exits with the number of workers asked for
+# - silent: never answers
+# - crash: exits on the first request
+
+
+def main(mode, args):
+    control = int(args[args.index('--control-fd') + 1])
+    status = int(args[args.index('--status-fd') + 1])
+    os.write(status, ('ready %d\n' % os.getpid()).encode('ascii'))
+    for line in os.fdopen(control):
+        command = line.split()
+        if command[0] == 'stop':
+            break
+        if mode == 'crash':
+            sys.exit(1)
+        if mode == 'fork':
+            pid = os.fork()
+            if pid == 0:
+                time.sleep(.1)
+                os._exit(int(command[1]))
+            os.write(status, ('forked %d\n' % pid).encode('ascii'))
+            _, code = os.waitpid(pid, 0)
+            os.write(status, ('exit %d %d\n' % (pid, os.WEXITSTATUS(code))).encode('ascii'))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2:])
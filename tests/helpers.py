@@ -0,0 +1,91 @@
+import os
+import unittest
+
+import redis
+
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/15')
+
+# Prefix of the huey keys of the tests, and class of their tasks as named by
+# the queue_command decorator.
+TENANT = 'huey_multitenant_tests'
+TASK_CLASS = 'queuecmd_send_mail'
+
+
+class Instance(object):
+    """
+    Stand-in for a HueyApplication, with the settings the dispatcher reads.
+    """
+
+    def __init__(self, name, weight=1., min_consumers=0, max_consumers=0, workers=4, priority=0,
+                 periodic_tasks=()):
+        self.name = name
+        self.weight = weight
+        self.min_consumers = min_consumers
+        self.max_consumers = max_consumers
+        self.workers = workers
+        self.priority = priority
+        self.periodic_tasks = list(periodic_tasks)
+
+
+class Process(object):
+
+    def __init__(self, pid, returncode=None):
+        self.pid = pid
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+
+class Consumer(object):
+    """
+    Stand-in for a HueyConsumer, a pid of None being a fork not answered yet.
+    """
+
+    def __init__(self, app, task_id, pid=None):
+        self.app = app
+        self.task_id = task_id
+        self.process = Process(pid)
+
+
+class Storage(object):
+    """
+    Stand-in for a huey storage whose queue has the given sizes, one per call.
+    """
+
+    def __init__(self, sizes):
+        self.sizes = list(sizes)
+
+    def queue_size(self):
+        return self.sizes.pop(0) if self.sizes else 0
+
+
+class Huey(object):
+
+    def __init__(self, queue_sizes=()):
+        self.storage = Storage(queue_sizes)
+
+
+class RedisTestCase(unittest.TestCase):
+    """
+    Tests against the Redis database of REDIS_URL, skipped when there is no
+    server. The keys in `keys` are deleted before and after every test.
+    """
+    keys = ()
+
+    @classmethod
+    def setUpClass(cls):
+        cls.conn = redis.Redis.from_url(REDIS_URL)
+        try:
+            cls.conn.ping()
+        except redis.ConnectionError:
+            raise unittest.SkipTest('Redis is not available at %s' % REDIS_URL)
+
+    def setUp(self):
+        if self.keys:
+            self.conn.delete(*self.keys)
+
+    def tearDown(self):
+        if self.keys:
+            self.conn.delete(*self.keys)
@@ -0,0 +1,98 @@
+import logging
+import unittest
+
+import redis
+
+from huey_multitenant.cluster import LEASE_KEY, NODES_KEY, SCHEDULER_KEY, Cluster, HashRing
+from tests.helpers import REDIS_URL, TENANT, RedisTestCase
+
+
+TENANTS = ['tenant%d' % i for i in range(4000)]
+
+
+class HashRingTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertIsNone(HashRing([]).get('tenant'))
+
+    def test_single_node(self):
+        ring = HashRing(['node1'])
+        self.assertEqual(set(ring.get(tenant) for tenant in TENANTS), set(['node1']))
+
+    def test_same_on_every_node(self):
+        # Every node builds its own ring, they must agree.
+        first, second = HashRing(['a', 'b', 'c']), HashRing(['c', 'a', 'b'])
+        for tenant in TENANTS:
+            self.assertEqual(first.get(tenant), second.get(tenant))
+
+    def test_distribution(self):
+        nodes = ['node%d' % i for i in range(5)]
+        ring = HashRing(nodes)
+        counts = dict((node, 0) for node in nodes)
+        for tenant in TENANTS:
+            counts[ring.get(tenant)] += 1
+        mean = len(TENANTS) / float(len(nodes))
+        for count in counts.values():
+            self.assertLess(abs(count - mean) / mean, .35, counts)
+
+    def test_join_moves_only_to_the_new_node(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = 0
+        for tenant in TENANTS:
+            if before.get(tenant) != after.get(tenant):
+                self.assertEqual(after.get(tenant), 'd')
+                moved += 1
+        self.assertLess(abs(moved / float(len(TENANTS)) - .25), .1)
+
+    def test_leave_moves_only_its_tenants(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'c'])
+        for tenant in TENANTS:
+            if before.get(tenant) != 'b':
+                self.assertEqual(before.get(tenant), after.get(tenant))
+            else:
+                self.assertIn(after.get(tenant), ('a', 'c'))
+
+
+class ClusterTest(RedisTestCase):
+    tenants = ['%s%d' % (TENANT, i) for i in range(20)]
+    keys = [NODES_KEY, SCHEDULER_KEY] + [LEASE_KEY % tenant for tenant in tenants]
+
+    def setUp(self):
+        super(ClusterTest, self).setUp()
+        logging.disable(logging.CRITICAL)
+        conn = redis.StrictRedis.from_url(REDIS_URL)
+        self.a, self.b = Cluster(conn, 'a'), Cluster(conn, 'b')
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        super(ClusterTest, self).tearDown()
+
+    def heartbeat(self):
+        for node in (self.a, self.b, self.a, self.b):
+            node.heartbeat(self.tenants)
+
+    def test_tenants_are_split(self):
+        self.heartbeat()
+        self.assertEqual(self.a.owned() | self.b.owned(), set(self.tenants))
+        self.assertFalse(self.a.owned() & self.b.owned())
+        self.assertTrue(self.a.owned() and self.b.owned())
+        for tenant in self.a.owned():
+            self.assertEqual(self.conn.get(LEASE_KEY % tenant), b'a')
+
+    def test_leave_hands_over(self):
+        self.heartbeat()
+        self.a.leave()
+        self.assertEqual(self.a.owned(), set())
+        self.b.heartbeat(self.tenants)
+        self.assertEqual(self.b.owned(), set(self.tenants))
+
+    def test_one_leader(self):
+        self.heartbeat()
+        self.assertTrue(self.a.lead())
+        self.assertFalse(self.b.lead())
+        self.a.leave()
+        # The lease is checked again on the next heartbeat.
+        self.b._lead_at = 0
+        self.assertTrue(self.b.lead())
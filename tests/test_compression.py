@@ -0,0 +1,54 @@
+import os
+import pickle
+import unittest
+
+from huey_multitenant import message
+from huey_multitenant.message import encode_message, message_protocol, read_header
+from tests.test_message import TASK, failing_loads
+
+
+class EncodeMessageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = message.pickle.loads
+
+    def tearDown(self):
+        message.pickle.loads = self.loads
+
+    def test_compressed(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            data = encode_message(TASK, protocol, compress_threshold=100)
+            self.assertLess(len(data), len(pickle.dumps(TASK, protocol)), protocol)
+            self.assertEqual(read_header(data), TASK[:2], protocol)
+            self.assertEqual(pickle.loads(data), TASK, protocol)
+
+    def test_compressed_is_not_decompressed(self):
+        message.pickle.loads = failing_loads
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(read_header(encode_message(TASK, protocol, 100)), TASK[:2], protocol)
+
+    def test_small_messages_are_not_compressed(self):
+        for protocol in (2, pickle.HIGHEST_PROTOCOL):
+            task = TASK[:5] + (((), {}), None)
+            self.assertEqual(encode_message(task, protocol, 1000), pickle.dumps(task, protocol))
+            self.assertEqual(encode_message(TASK, protocol), pickle.dumps(TASK, protocol))
+
+    def test_incompressible_messages(self):
+        task = TASK[:5] + (((os.urandom(1000),), {}), None)
+        data = encode_message(task, 2, 100)
+        self.assertEqual(data, pickle.dumps(task, 2))
+
+    def test_unknown_codec(self):
+        with self.assertRaises(ValueError):
+            message._inflate(TASK[0], TASK[1], 'lzma', b'')
+
+    def test_message_protocol(self):
+        self.assertEqual(message_protocol(False), 2)
+        self.assertEqual(message_protocol(True), 3)
+        self.assertEqual(message_protocol(True, 4), 4)
+        with self.assertRaises(ValueError):
+            message_protocol(False, 4)
+        with self.assertRaises(ValueError):
+            message_protocol(True, 1)
+        with self.assertRaises(ValueError):
+            message_protocol(True, pickle.HIGHEST_PROTOCOL + 1)
@@ -0,0 +1,213 @@
+import datetime
+import logging
+import multiprocessing
+import threading
+import time
+import unittest
+
+from tests.helpers import TASK_CLASS, Huey
+
+try:
+    from huey.consumer import ProcessEnvironment, ThreadEnvironment
+    from huey_multitenant.consumer import IDLE_WINDOW_FACTOR, ExecuteConsumer, TrackedWorker, WorkerTracker
+except ImportError:
+    # The consumers run in the Django projects of the tenants.
+    raise unittest.SkipTest('Django is not installed')
+
+
+class Consumer(ExecuteConsumer):
+    """
+    ExecuteConsumer without workers, recording how it stops.
+    """
+
+    def __init__(self, arrival, queue_sizes=()):
+        self._logger = logging.getLogger('huey.consumer')
+        self.tracker = WorkerTracker(ThreadEnvironment(), arrival=arrival)
+        self.huey = Huey(queue_sizes)
+        self.stop_flag = threading.Event()
+        self.worker_threads = []
+        self.stopped = None
+
+    def _stop_worker(self):
+        self.stopped = 'stop'
+
+    def _kill_workers(self):
+        self.stopped = 'kill'
+
+    def stop_when_idle(self, idle_timeout=.05, timeout=5., max_idle_timeout=.3, max_tasks=None):
+        """
+        :return: (tasks finished, seconds until the consumer stopped)
+        """
+        start = time.time()
+        finished, _ = self._stop_when_idle(datetime.datetime.utcnow(), idle_timeout, timeout, max_idle_timeout,
+                                           max_tasks)
+        return finished, time.time() - start
+
+
+def sleeping_worker(tracker, delay):
+    """
+    TrackedWorker that only sleeps, backed off to `delay` seconds.
+    """
+    worker = TrackedWorker.__new__(TrackedWorker)
+    worker._logger = logging.getLogger('huey.consumer')
+    worker.tracker = tracker
+    worker.default_delay, worker.max_delay, worker.backoff = .1, 10., 2.
+    worker.delay = delay
+    return worker
+
+
+class IdleStopTest(unittest.TestCase):
+
+    def test_stops_when_idle(self):
+        consumer = Consumer(arrival=.01)
+        finished, elapsed = consumer.stop_when_idle()
+        self.assertEqual(consumer.stopped, 'stop')
+        self.assertEqual(finished, 0)
+        self.assertLess(elapsed, .25)
+
+    def test_window_follows_arrivals(self):
+        consumer = Consumer(arrival=.1)
+        _, elapsed = consumer.stop_when_idle()
+        self.assertGreaterEqual(elapsed, IDLE_WINDOW_FACTOR * .1 - .01)
+        self.assertLess(elapsed, .3)
+
+    def test_window_is_bounded(self):
+        consumer = Consumer(arrival=60.)
+        _, elapsed = consumer.stop_when_idle(max_idle_timeout=.2)
+        self.assertGreaterEqual(elapsed, .19)
+        self.assertLess(elapsed, .5)
+
+    def test_keeps_going_while_queued(self):
+        consumer = Consumer(arrival=.01, queue_sizes=[3, 1])
+        _, elapsed = consumer.stop_when_idle()
+        self.assertEqual(consumer.stopped, 'stop')
+        self.assertGreaterEqual(elapsed, 3 * .05 - .01)
+        self.assertEqual(consumer.huey.storage.sizes, [])
+
+    def test_lingering_wakes_the_workers(self):
+        consumer = Consumer(arrival=.01, queue_sizes=[2])
+        worker = sleeping_worker(consumer.tracker, delay=5.)
+        thread = threading.Thread(target=worker.sleep)
+        thread.start()
+        time.sleep(.01)
+        consumer.stop_when_idle()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(worker.delay, worker.default_delay)
+
+    def test_waits_for_running_tasks(self):
+        consumer = Consumer(arrival=.01)
+        consumer.tracker.started()
+        timer = threading.Timer(.2, consumer.tracker.finished, (.2,))
+        timer.start()
+        finished, elapsed = consumer.stop_when_idle()
+        timer.join()
+        self.assertEqual(finished, 1)
+        self.assertGreaterEqual(elapsed, .2)
+
+    def test_timeout(self):
+        consumer = Consumer(arrival=.01)
+        consumer.tracker.started()
+        _, elapsed = consumer.stop_when_idle(timeout=.2)
+        self.assertEqual(consumer.stopped, 'stop')
+        self.assertLess(elapsed, .4)
+
+    def test_max_tasks(self):
+        consumer = Consumer(arrival=10.)
+        for _ in range(3):
+            consumer.tracker.started()
+            consumer.tracker.finished(.01)
+        finished, elapsed = consumer.stop_when_idle(max_tasks=3)
+        self.assertEqual(finished, 3)
+        self.assertLess(elapsed, .1)
+
+
+class RuntimeLimitTest(unittest.TestCase):
+
+    def test_overdue_task_kills_the_consumer(self):
+        consumer = Consumer(arrival=.01)
+        consumer.tracker.started(0, time.time() + .1)
+        _, elapsed = consumer.stop_when_idle()
+        self.assertEqual(consumer.stopped, 'kill')
+        self.assertGreaterEqual(elapsed, .09)
+        self.assertLess(elapsed, .3)
+
+    def test_task_within_its_limit(self):
+        consumer = Consumer(arrival=.01)
+        consumer.tracker.started(0, time.time() + 5)
+        timer = threading.Timer(.1, consumer.tracker.finished, (.1, 0, TASK_CLASS))
+        timer.start()
+        finished, _ = consumer.stop_when_idle()
+        timer.join()
+        self.assertEqual(consumer.stopped, 'stop')
+        self.assertEqual(finished, 1)
+
+    def test_overdue_at(self):
+        tracker = WorkerTracker(ThreadEnvironment(), arrival=1., workers=3)
+        self.assertEqual(tracker.overdue_at(), 0.)
+        tracker.started(0, 0.)
+        tracker.started(1, 200.)
+        tracker.started(2, 100.)
+        self.assertEqual(tracker.overdue_at(), 100.)
+        tracker.finished(1., 2)
+        self.assertEqual(tracker.overdue_at(), 200.)
+
+    def test_kill_workers(self):
+        consumer = Consumer(arrival=.01)
+        process = multiprocessing.Process(target=time.sleep, args=(30,))
+        process.start()
+        thread = threading.Thread(target=consumer.stop_flag.wait)
+        thread.start()
+        consumer.worker_threads = [(None, process), (None, thread)]
+        ExecuteConsumer._kill_workers(consumer)
+        process.join(5)
+        thread.join(5)
+        self.assertFalse(process.is_alive())
+        self.assertFalse(thread.is_alive())
+
+    def test_durations_of_process_workers(self):
+        tracker = WorkerTracker(ProcessEnvironment(), arrival=1.)
+        worker = multiprocessing.Process(target=tracker.finished, args=(.5, 0, TASK_CLASS))
+        worker.start()
+        worker.join(5)
+        tracker.finished(1.5, 0, TASK_CLASS)
+        deadline = time.time() + 5
+        while time.time() < deadline and tracker.classes().get(TASK_CLASS, (0,))[0] < 2:
+            time.sleep(.01)
+        tasks, busy, _ = tracker.classes()[TASK_CLASS]
+        self.assertEqual((tasks, busy), (2, 2.))
+
+
+class WorkerTrackerTest(unittest.TestCase):
+
+    def test_sleep_backs_off(self):
+        worker = sleeping_worker(WorkerTracker(ThreadEnvironment(), arrival=1.), delay=.05)
+        worker.sleep()
+        self.assertEqual(worker.delay, .1)
+
+    def test_stopping_wakes_the_workers(self):
+        tracker = WorkerTracker(ThreadEnvironment(), arrival=1.)
+        start = time.time()
+        tracker.stopping()
+        sleeping_worker(tracker, delay=5.).sleep()
+        self.assertLess(time.time() - start, 1.)
+
+    def test_arrival(self):
+        tracker = WorkerTracker(ThreadEnvironment(), arrival=1.)
+        tracker.started()
+        tracker.finished(.01)
+        # Tasks that run back to back do not change the average.
+        self.assertEqual(tracker.snapshot()[4], 1.)
+        time.sleep(.1)
+        tracker.started()
+        arrival = tracker.snapshot()[4]
+        self.assertLess(arrival, 1.)
+        self.assertGreater(arrival, .1)
+
+    def test_snapshot(self):
+        tracker = WorkerTracker(ThreadEnvironment(), arrival=1., workers=2)
+        tracker.started(0)
+        tracker.started(1)
+        tracker.finished(.5, 1)
+        working, finished, busy, _, _ = tracker.snapshot()
+        self.assertEqual((working, finished, busy), (1, 1, .5))
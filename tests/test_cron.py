@@ -0,0 +1,129 @@
+import datetime
+import random
+import unittest
+
+from huey.api import crontab
+
+from huey_multitenant.cron import CronEntry, CronIndex
+from tests.helpers import Instance
+
+
+ONE_MINUTE = datetime.timedelta(minutes=1)
+
+ENTRIES = [
+    {},
+    {'minute': '*/15'},
+    {'minute': '0', 'hour': '3'},
+    {'minute': '5,35', 'hour': '9-17', 'day_of_week': '1-5'},
+    {'minute': '0', 'hour': '*/6', 'day': '1,15'},
+    {'minute': '30', 'hour': '23', 'day_of_week': '0'},
+    {'minute': '0', 'hour': '0', 'day_of_week': '7'},
+    {'minute': '59', 'hour': '23', 'day': '31'},
+    {'minute': '0', 'hour': '12', 'day': '1', 'month': '*/3'},
+    {'minute': '10-20', 'hour': '0', 'day_of_week': '6', 'month': '2'},
+]
+
+STARTS = [
+    datetime.datetime(2026, 1, 1, 0, 0),
+    datetime.datetime(2026, 2, 27, 23, 59, 30),
+    datetime.datetime(2026, 6, 30, 17, 35, 0, 500),
+    datetime.datetime(2026, 12, 31, 23, 59, 59),
+    datetime.datetime(2028, 2, 28, 12, 0),
+]
+
+
+def brute_force_next(entry, after, limit=datetime.timedelta(days=400)):
+    """
+    First minute after `after` matched by huey.crontab, checking minute by
+    minute the days it matches.
+    """
+    validate = crontab(**entry)
+    validate_day = crontab(**dict(
+        (key, value) for key, value in entry.items() if key in ('month', 'day', 'day_of_week')))
+    dt = after.replace(second=0, microsecond=0) + ONE_MINUTE
+    end = after + limit
+    while dt <= end:
+        if not validate_day(dt):
+            dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            continue
+        if validate(dt):
+            return dt
+        dt += ONE_MINUTE
+    return None
+
+
+class CronEntryTest(unittest.TestCase):
+
+    def test_matches_like_crontab(self):
+        rng = random.Random(8)
+        start = datetime.datetime(2026, 1, 1)
+        moments = [start + datetime.timedelta(minutes=rng.randrange(3 * 366 * 24 * 60)) for _ in range(2000)]
+        for entry in ENTRIES:
+            expected, compiled = crontab(**entry), CronEntry(**entry)
+            for dt in moments:
+                self.assertEqual(compiled(dt), expected(dt), (entry, dt))
+
+    def test_next_fire_like_crontab(self):
+        for entry in ENTRIES:
+            compiled = CronEntry(**entry)
+            for after in STARTS:
+                self.assertEqual(compiled.next_fire(after), brute_force_next(entry, after), (entry, after))
+
+    def test_next_fire_is_after(self):
+        entry = CronEntry(minute='*')
+        after = datetime.datetime(2026, 3, 1, 10, 15)
+        self.assertEqual(entry.next_fire(after), datetime.datetime(2026, 3, 1, 10, 16))
+        self.assertEqual(entry.next_fire(after.replace(second=59)), datetime.datetime(2026, 3, 1, 10, 16))
+
+    def test_leap_day(self):
+        entry = CronEntry(minute='0', hour='0', day='29', month='2')
+        self.assertEqual(entry.next_fire(datetime.datetime(2026, 3, 1)), datetime.datetime(2028, 2, 29))
+
+    def test_impossible_dates(self):
+        for day, month in (('31', '2'), ('30', '2'), ('31', '4'), ('31', '4,6,9,11')):
+            entry = {'minute': '0', 'hour': '0', 'day': day, 'month': month}
+            after = datetime.datetime(2026, 1, 1)
+            self.assertIsNone(CronEntry(**entry).next_fire(after), entry)
+            self.assertIsNone(brute_force_next(entry, after, datetime.timedelta(days=5 * 366)), entry)
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            CronEntry(minute='60')
+        with self.assertRaises(ValueError):
+            CronEntry(day_of_week='*/2')
+        with self.assertRaises(ValueError):
+            CronEntry(month='0-3')
+
+
+def instance(name, entries):
+    """
+    Instance with a periodic task for every method -> crontab entry.
+    """
+    return Instance(name, periodic_tasks=[
+        {'method': method, 'validate_datetime': CronEntry(**entry)} for method, entry in entries.items()])
+
+
+class CronIndexTest(unittest.TestCase):
+
+    def test_pop_due(self):
+        now = datetime.datetime(2026, 1, 1, 9, 59, 10)
+        app = instance('a', {'hourly': {'minute': '0'}, 'quarter': {'minute': '*/15'},
+                             'feb31': {'day': '31', 'month': '2'}})
+        index = CronIndex([app], now)
+        self.assertEqual([method for _, _, method in index.next_fire_times()], ['hourly', 'quarter'])
+
+        self.assertEqual(index.pop_due(datetime.datetime(2026, 1, 1, 9, 59, 50)), [])
+        due = index.pop_due(datetime.datetime(2026, 1, 1, 10, 0, 1))
+        self.assertEqual(sorted(task['method'] for _, task in due), ['hourly', 'quarter'])
+        self.assertEqual(index.next_fire_times()[0][0], datetime.datetime(2026, 1, 1, 10, 15))
+
+    def test_missed_fires_are_skipped(self):
+        index = CronIndex([instance('a', {'quarter': {'minute': '*/15'}})], datetime.datetime(2026, 1, 1, 9, 59))
+        self.assertEqual(index.pop_due(datetime.datetime(2026, 1, 1, 10, 31)), [])
+        self.assertEqual(index.next_fire_times()[0][0], datetime.datetime(2026, 1, 1, 10, 45))
+
+    def test_remove(self):
+        a, b = instance('a', {'every': {}}), instance('b', {'every': {}})
+        index = CronIndex([a, b], datetime.datetime(2026, 1, 1))
+        index.remove([a])
+        self.assertEqual([name for _, name, _ in index.next_fire_times()], ['b'])
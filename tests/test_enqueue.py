@@ -0,0 +1,73 @@
+import datetime
+import pickle
+
+import redis
+from huey.storage import RedisStorage
+
+from huey_multitenant.enqueue import BulkEnqueuer, Tenant
+from tests.helpers import REDIS_URL, TENANT, RedisTestCase
+
+
+def commands(conn, name):
+    """
+    :return: how many times the server ran a command.
+    """
+    return conn.info('commandstats').get('cmdstat_%s' % name, {}).get('calls', 0)
+
+
+class BulkEnqueuerTest(RedisTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(BulkEnqueuerTest, cls).setUpClass()
+        pool = redis.ConnectionPool.from_url(REDIS_URL)
+        cls.tenants = [Tenant(name, RedisStorage(name=name, connection_pool=pool), use_python3=True)
+                       for name in (TENANT, TENANT + 'b')]
+        cls.storage = cls.tenants[0].storage
+        cls.keys = [key for tenant in cls.tenants
+                    for key in (tenant.storage.queue_key, tenant.storage.schedule_key)]
+
+    def test_batches(self):
+        before = commands(self.conn, 'lpush')
+        enqueuer = BulkEnqueuer(self.tenants, batch_size=3)
+        task_ids = [enqueuer.add(TENANT, 'send_mail', args=(i,)) for i in range(7)]
+        # Two batches of three were sent, one LPUSH each.
+        self.assertEqual(self.conn.llen(self.storage.queue_key), 6)
+        self.assertEqual(commands(self.conn, 'lpush') - before, 2)
+        self.assertEqual(enqueuer.flush(), 1)
+        self.assertEqual(enqueuer.enqueued, 7)
+
+        # Huey pops the queue from the right, first in first out.
+        messages = [pickle.loads(self.conn.rpop(self.storage.queue_key)) for _ in range(7)]
+        self.assertEqual([message[0] for message in messages], task_ids)
+        self.assertEqual(messages[0][1], 'queue_task_send_mail')
+        self.assertEqual(messages[0][5], ((0,), {}))
+
+    def test_one_lpush_per_queue(self):
+        before = commands(self.conn, 'lpush')
+        with BulkEnqueuer(self.tenants) as enqueuer:
+            for i in range(5):
+                enqueuer.add(TENANT, 'send_mail', args=(i,))
+                enqueuer.add(TENANT + 'b', 'send_mail', args=(i,))
+        self.assertEqual(commands(self.conn, 'lpush') - before, 2)
+        for tenant in self.tenants:
+            self.assertEqual(self.conn.llen(tenant.storage.queue_key), 5)
+
+    def test_scheduled(self):
+        eta = datetime.datetime(2026, 1, 2, 3, 4, 5)
+        with BulkEnqueuer(self.tenants) as enqueuer:
+            task_id = enqueuer.add(TENANT, 'send_mail', eta=(eta - datetime.datetime(1970, 1, 1)).total_seconds())
+            enqueuer.add(TENANT, 'send_mail', delay=3600)
+        self.assertEqual(enqueuer.scheduled, 2)
+        self.assertEqual(self.conn.llen(self.storage.queue_key), 0)
+
+        # Members are the messages and scores their times, as huey reads them.
+        message, score = self.conn.zrange(self.storage.schedule_key, 0, 0, withscores=True)[0]
+        self.assertEqual(pickle.loads(message)[:3], (task_id, 'queue_task_send_mail', eta))
+        self.assertEqual(score, self.storage.convert_ts(eta))
+        self.assertEqual([pickle.loads(message)[0] for message in self.storage.read_schedule(eta)], [task_id])
+        self.assertEqual(self.conn.zcard(self.storage.schedule_key), 1)
+
+    def test_unknown_tenant(self):
+        with self.assertRaises(ValueError):
+            BulkEnqueuer(self.tenants).add('other', 'send_mail')
@@ -0,0 +1,107 @@
+import unittest
+
+from huey_multitenant.fairshare import FairShare
+from tests.helpers import Instance
+
+
+class FairShareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fair_share = FairShare()
+        self.running = {}
+
+    def dispatch(self, instances, slots, **kwargs):
+        """
+        Give `slots` consumers away one at a time, as the dispatcher does.
+
+        :return: names of the instances picked, in order
+        """
+        picked = []
+        for _ in range(slots):
+            heap = self.fair_share.queue(instances, lambda instance: self.running.get(instance.name, 0), **kwargs)
+            instance = self.fair_share.pop(heap)
+            if instance is None:
+                break
+            self.fair_share.charge(instance)
+            self.running[instance.name] = self.running.get(instance.name, 0) + 1
+            picked.append(instance.name)
+        return picked
+
+    def test_weights(self):
+        heavy, light = Instance('heavy', weight=3), Instance('light', weight=1)
+        picked = self.dispatch([heavy, light], 40)
+        self.assertEqual(picked.count('heavy'), 30)
+        self.assertEqual(picked.count('light'), 10)
+        # Slots are interleaved, not given in a burst.
+        self.assertIn('light', picked[:4])
+
+    def test_weights_within_a_round(self):
+        heavy, light = Instance('heavy', weight=3), Instance('light', weight=1)
+        heap = self.fair_share.queue([heavy, light], lambda instance: 0)
+        picked = []
+        for _ in range(8):
+            instance = self.fair_share.pop(heap)
+            self.fair_share.charge(instance)
+            self.fair_share.push(heap, instance, picked.count(instance.name) + 1)
+            picked.append(instance.name)
+        self.assertEqual(picked.count('light'), 2)
+
+    def test_equal_weights_alternate(self):
+        picked = self.dispatch([Instance('a'), Instance('b')], 6)
+        self.assertEqual(sorted(picked[0:2]), ['a', 'b'])
+        self.assertEqual(sorted(picked[2:4]), ['a', 'b'])
+
+    def test_min_consumers_go_first(self):
+        heavy, small = Instance('heavy', weight=100), Instance('small', weight=1, min_consumers=2)
+        self.assertEqual(self.dispatch([heavy, small], 2), ['small', 'small'])
+
+    def test_max_consumers(self):
+        capped = Instance('capped', weight=100, max_consumers=2)
+        picked = self.dispatch([capped, Instance('other')], 10)
+        self.assertEqual(picked.count('capped'), 2)
+        self.assertEqual(self.dispatch([capped], 1), [])
+
+    def test_idle_instances_do_not_bank_credit(self):
+        busy, idle = Instance('busy'), Instance('idle')
+        self.dispatch([busy], 20)
+        picked = self.dispatch([busy, idle], 10)
+        self.assertEqual(picked.count('idle'), 5)
+
+    def test_priority_goes_first(self):
+        heavy, urgent = Instance('heavy', weight=100), Instance('urgent')
+        priorities = {'heavy': 0, 'urgent': 5}
+        picked = self.dispatch([heavy, urgent], 3, priority=lambda instance: priorities[instance.name])
+        self.assertEqual(picked, ['urgent'] * 3)
+
+    def test_min_consumers_go_before_priority(self):
+        urgent, small = Instance('urgent'), Instance('small', min_consumers=1)
+        priorities = {'urgent': 5, 'small': 0}
+        picked = self.dispatch([urgent, small], 2, priority=lambda instance: priorities[instance.name])
+        self.assertEqual(picked, ['small', 'urgent'])
+
+    def test_same_priority_is_fair(self):
+        picked = self.dispatch([Instance('a', weight=2), Instance('b')], 6, priority=lambda instance: 3)
+        self.assertEqual(picked.count('a'), 4)
+
+    def test_shortest_expected_goes_first(self):
+        slow, fast = Instance('slow', weight=10), Instance('fast')
+        durations = {'slow': 30., 'fast': .5}
+        picked = self.dispatch([slow, fast], 3, expected=lambda instance: durations[instance.name])
+        self.assertEqual(picked, ['fast'] * 3)
+
+    def test_priority_goes_before_expected(self):
+        slow, fast = Instance('slow'), Instance('fast')
+        durations = {'slow': 30., 'fast': .5}
+        priorities = {'slow': 1, 'fast': 0}
+        picked = self.dispatch([slow, fast], 1, expected=lambda instance: durations[instance.name],
+                               priority=lambda instance: priorities[instance.name])
+        self.assertEqual(picked, ['slow'])
+
+    def test_forget(self):
+        instance = Instance('a')
+        self.dispatch([instance], 5)
+        self.fair_share.forget(instance)
+        self.assertNotIn('a', self.fair_share._finish)
+
+    def test_empty(self):
+        self.assertIsNone(self.fair_share.pop(self.fair_share.queue([], lambda instance: 0)))
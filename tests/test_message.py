@@ -0,0 +1,42 @@
+import datetime
+import pickle
+import unittest
+
+from huey_multitenant import message
+from huey_multitenant.message import read_header
+from tests.helpers import TASK_CLASS
+
+
+TASK = ('4f6a0c8e-5b1d-4c2a-9e3f-1d2c3b4a5f6e', TASK_CLASS, datetime.datetime(2026, 1, 2, 3, 4, 5), 3, 10,
+        ((1, u'\xe1rbol'), {'to': 'someone@example.com', 'body': 'x' * 2000}), None)
+
+
+def failing_loads(data):
+    raise AssertionError('The header was unpickled')
+
+
+class ReadHeaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = message.pickle.loads
+
+    def tearDown(self):
+        message.pickle.loads = self.loads
+
+    def test_every_protocol(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(read_header(pickle.dumps(TASK, protocol)), TASK[:2], protocol)
+
+    def test_binary_protocols_are_not_unpickled(self):
+        message.pickle.loads = failing_loads
+        for protocol in range(1, pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(read_header(pickle.dumps(TASK, protocol)), TASK[:2], protocol)
+
+    def test_other_globals_fall_back(self):
+        data = pickle.dumps((datetime.date(2026, 1, 1), TASK_CLASS), 2)
+        self.assertEqual(read_header(data), (datetime.date(2026, 1, 1), TASK_CLASS))
+
+    def test_truncated(self):
+        data = pickle.dumps(TASK, 2)
+        with self.assertRaises(Exception):
+            read_header(data[:20])
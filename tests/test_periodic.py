@@ -0,0 +1,96 @@
+from huey_multitenant.periodic import COALESCE_MERGE, COALESCE_SKIP, ENQUEUE_PERIODIC_LUA, FINISH_PERIODIC_LUA, \
+    PERIODIC_KEY, QUEUED_TTL, RUNNING_TTL, START_PERIODIC_LUA
+from tests.helpers import TASK_CLASS, TENANT, RedisTestCase
+
+
+NOW = 1790000000
+
+
+class CoalescingTest(RedisTestCase):
+    """
+    The coalescing scripts, run by the scheduler and the consumers. Runs of
+    the none policy are enqueued without them.
+    """
+    periodic_key = PERIODIC_KEY % TENANT
+    queue_key = 'huey.redis.%s' % TENANT
+    keys = (periodic_key, queue_key)
+
+    def setUp(self):
+        super(CoalescingTest, self).setUp()
+        self._enqueue = self.conn.register_script(ENQUEUE_PERIODIC_LUA)
+        self._start = self.conn.register_script(START_PERIODIC_LUA)
+        self._finish = self.conn.register_script(FINISH_PERIODIC_LUA)
+
+    def enqueue(self, policy, task_id, now=NOW):
+        return self._enqueue(keys=[self.periodic_key, self.queue_key],
+                             args=[TASK_CLASS, policy, task_id, now, 'message %s' % task_id, QUEUED_TTL, RUNNING_TTL])
+
+    def start(self, task_id, now=NOW):
+        return self._start(keys=[self.periodic_key], args=[TASK_CLASS, task_id, now])
+
+    def finish(self, task_id):
+        return self._finish(keys=[self.periodic_key], args=[TASK_CLASS, task_id])
+
+    def state(self):
+        state = self.conn.hget(self.periodic_key, TASK_CLASS)
+        return state.decode('utf-8').split()[:2] if state else None
+
+    def queued(self):
+        return self.conn.llen(self.queue_key)
+
+    def test_skip(self):
+        self.assertEqual(self.enqueue(COALESCE_SKIP, 'periodic:1'), 1)
+        self.assertEqual(self.state(), ['queued', 'periodic:1'])
+        self.assertEqual(self.enqueue(COALESCE_SKIP, 'periodic:2'), 0)
+
+        self.assertEqual(self.start('periodic:1'), 1)
+        self.assertEqual(self.state(), ['running', 'periodic:1'])
+        self.assertEqual(self.enqueue(COALESCE_SKIP, 'periodic:3'), 0)
+
+        self.assertEqual(self.finish('periodic:1'), 1)
+        self.assertIsNone(self.state())
+        self.assertEqual(self.enqueue(COALESCE_SKIP, 'periodic:4'), 1)
+        self.assertEqual(self.queued(), 2)
+
+    def test_merge(self):
+        self.assertEqual(self.enqueue(COALESCE_MERGE, 'periodic:1'), 1)
+        self.assertEqual(self.enqueue(COALESCE_MERGE, 'periodic:2'), 0)
+
+        self.start('periodic:1')
+        # One more run is queued after the running one, and only one.
+        self.assertEqual(self.enqueue(COALESCE_MERGE, 'periodic:3'), 1)
+        self.assertEqual(self.state(), ['queued', 'periodic:3'])
+        self.assertEqual(self.enqueue(COALESCE_MERGE, 'periodic:4'), 0)
+        self.assertEqual(self.queued(), 2)
+
+    def test_stale_consumer(self):
+        self.enqueue(COALESCE_MERGE, 'periodic:1')
+        self.start('periodic:1')
+        self.enqueue(COALESCE_MERGE, 'periodic:2')
+        # The first run ends, it must not clear the state of the second one.
+        self.assertEqual(self.finish('periodic:1'), 0)
+        self.assertEqual(self.state(), ['queued', 'periodic:2'])
+        self.assertEqual(self.start('periodic:1'), 0)
+        self.assertEqual(self.state(), ['queued', 'periodic:2'])
+
+        self.assertEqual(self.start('periodic:2'), 1)
+        self.assertEqual(self.finish('periodic:2'), 1)
+        self.assertIsNone(self.state())
+
+    def test_start_unknown(self):
+        self.assertEqual(self.start('periodic:1'), 0)
+        self.assertEqual(self.finish('periodic:1'), 0)
+        self.assertIsNone(self.state())
+
+    def test_expired_queued(self):
+        self.enqueue(COALESCE_SKIP, 'periodic:1')
+        self.assertEqual(self.enqueue(COALESCE_SKIP, 'periodic:2', NOW + QUEUED_TTL - 1), 0)
+        self.assertEqual(self.enqueue(COALESCE_SKIP, 'periodic:3', NOW + QUEUED_TTL), 1)
+        self.assertEqual(self.state(), ['queued', 'periodic:3'])
+
+    def test_expired_running(self):
+        # The consumer may have been killed while running it.
+        self.enqueue(COALESCE_SKIP, 'periodic:1')
+        self.start('periodic:1', NOW + 10)
+        self.assertEqual(self.enqueue(COALESCE_SKIP, 'periodic:2', NOW + 10 + RUNNING_TTL - 1), 0)
+        self.assertEqual(self.enqueue(COALESCE_SKIP, 'periodic:3', NOW + 10 + RUNNING_TTL), 1)
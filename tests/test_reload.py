@@ -0,0 +1,110 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from huey_multitenant import core
+from tests.helpers import TASK_CLASS
+
+
+CONF = """[%(name)s]
+python=/usr/bin/python
+script=%(path)s/%(name)s/manage.py
+settings=%(name)s.settings
+redis_prefix=%(name)s
+%(extra)s
+"""
+
+
+class Dispatcher(core.Dispatcher):
+    """
+    Dispatcher that loads the confs without periodic tasks and doesn't run.
+    """
+
+    def load_periodic_tasks(self, instances):
+        pass
+
+    def start(self):
+        pass
+
+
+class ReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.path = tempfile.mkdtemp()
+        self.mtime = time.time()
+        self.write('a')
+        self.write('b')
+        self.dispatcher = Dispatcher(self.path, 2, False, False, reload=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        logging.disable(logging.NOTSET)
+
+    def write(self, name, extra=''):
+        conf = os.path.join(self.path, '%s.conf' % name)
+        with open(conf, 'w') as f:
+            f.write(CONF % {'name': name, 'path': self.path, 'extra': extra})
+        # Every change gets a later modification time, however fast they go.
+        self.mtime += 10
+        os.utime(conf, (self.mtime, self.mtime))
+
+    def remove(self, name):
+        os.remove(os.path.join(self.path, '%s.conf' % name))
+
+    def instances(self):
+        return dict((instance.name, instance) for instance in self.dispatcher.instances)
+
+    def test_unchanged(self):
+        before = self.instances()
+        self.dispatcher.reload_config()
+        self.assertEqual(self.instances(), before)
+
+    def test_add(self):
+        self.write('c', 'workers=3')
+        self.dispatcher.reload_config()
+        self.assertEqual(sorted(self.instances()), ['a', 'b', 'c'])
+        self.assertEqual(self.instances()['c'].workers, 3)
+
+    def test_retire(self):
+        self.remove('b')
+        self.dispatcher.reload_config()
+        self.assertEqual(sorted(self.instances()), ['a'])
+        self.assertNotIn('b.conf', self.dispatcher._conf_settings)
+
+    def test_tune(self):
+        a = self.instances()['a']
+        self.write('a', 'weight=3\nworkers=2\npriority=1\ntask_priorities=%s:5' % TASK_CLASS)
+        self.dispatcher.reload_config()
+        self.assertIs(self.instances()['a'], a)
+        self.assertEqual((a.weight, a.workers, a.priority), (3., 2, 1))
+        self.assertEqual(a.task_priorities, {TASK_CLASS: 5})
+
+    def test_recreate(self):
+        a = self.instances()['a']
+        self.write('a', 'worker-type=process')
+        self.dispatcher.reload_config()
+        self.assertIsNot(self.instances()['a'], a)
+        self.assertEqual(self.instances()['a'].worker_type, 'process')
+
+    def test_invalid_conf_keeps_the_instance(self):
+        a = self.instances()['a']
+        self.write('a', 'weight=0')
+        self.dispatcher.reload_config()
+        self.assertIs(self.instances()['a'], a)
+        self.assertEqual(a.weight, 1.)
+
+    def test_invalid_conf_removed(self):
+        with open(os.path.join(self.path, 'c.conf'), 'w') as f:
+            f.write('[c]\n')
+        self.dispatcher.reload_config()
+        self.assertNotIn('c', self.instances())
+        self.assertIn('c.conf', self.dispatcher._conf_settings)
+
+        self.remove('c')
+        self.dispatcher.reload_config()
+        self.assertNotIn('c.conf', self.dispatcher._conf_settings)
+        self.assertEqual(sorted(self.instances()), ['a', 'b'])
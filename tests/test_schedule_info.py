@@ -0,0 +1,70 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from huey_multitenant.application import HueyApplication
+from huey_multitenant.sources import get_mtime
+from tests.helpers import TASK_CLASS
+
+
+class ScheduleIsFreshTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.path = tempfile.mkdtemp()
+        self.script = os.path.join(self.path, 'manage.py')
+        self.tasks = os.path.join(self.path, 'tasks.py')
+        for filename in (self.script, self.tasks):
+            open(filename, 'w').close()
+        # A modification time that a float round trip would not keep.
+        os.utime(self.tasks, ns=(1700000000123456789, 1700000000123456789))
+        self.app = HueyApplication('app', '/usr/bin/python', self.script, 1, 'thread', 'app.settings',
+                                   'localhost', 6379, 'app')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        logging.disable(logging.NOTSET)
+
+    def write(self, settings='app.settings', sources=None):
+        """
+        Write schedule.info like makeschedule does.
+        """
+        if sources is None:
+            sources = dict((filename, get_mtime(filename)) for filename in (self.script, self.tasks))
+        with open(self.app.schedule_file, 'w') as f:
+            if settings is not None:
+                f.write('#! settings {}\n'.format(settings))
+            for filename, mtime in sorted(sources.items()):
+                f.write('#! source {} {}\n'.format(mtime, filename))
+            f.write('#\n* * * * * {}\n'.format(TASK_CLASS))
+
+    def test_fresh(self):
+        self.write()
+        self.assertTrue(self.app.schedule_is_fresh())
+
+    def test_missing(self):
+        self.assertFalse(self.app.schedule_is_fresh())
+
+    def test_missing_fingerprint(self):
+        self.write(settings=None, sources={})
+        self.assertFalse(self.app.schedule_is_fresh())
+
+    def test_float_mtimes(self):
+        self.write(sources={self.tasks: os.stat(self.tasks).st_mtime})
+        self.assertFalse(self.app.schedule_is_fresh())
+
+    def test_other_settings(self):
+        self.write(settings='app.other_settings')
+        self.assertFalse(self.app.schedule_is_fresh())
+
+    def test_changed_source(self):
+        self.write()
+        os.utime(self.tasks, ns=(1700000000123457789, 1700000000123457789))
+        self.assertFalse(self.app.schedule_is_fresh())
+
+    def test_deleted_source(self):
+        self.write()
+        os.remove(self.tasks)
+        self.assertFalse(self.app.schedule_is_fresh())
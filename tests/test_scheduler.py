@@ -0,0 +1,40 @@
+import itertools
+import logging
+import unittest
+
+from huey_multitenant.scheduler import MAX_JITTER, Scheduler, periodic_offset
+from tests.helpers import TASK_CLASS, Instance
+
+
+NAMES = ['app%d' % i for i in range(20)]
+KLASSES = [TASK_CLASS, 'queue_task_cleanup', 'queue_task_report']
+JITTERS = [.5, 1, 10, 30, MAX_JITTER]
+
+
+class PeriodicOffsetTest(unittest.TestCase):
+
+    def test_deterministic(self):
+        for name, klass, jitter in itertools.product(NAMES, KLASSES, JITTERS):
+            self.assertEqual(periodic_offset(name, klass, jitter), periodic_offset(name, klass, jitter))
+
+    def test_within_jitter(self):
+        for name, klass, jitter in itertools.product(NAMES, KLASSES, JITTERS):
+            offset = periodic_offset(name, klass, jitter)
+            self.assertTrue(0 <= offset < jitter, (name, klass, jitter, offset))
+
+    def test_spread(self):
+        offsets = set(periodic_offset(name, klass, MAX_JITTER) for name, klass in itertools.product(NAMES, KLASSES))
+        self.assertGreater(len(offsets), len(NAMES))
+
+    def test_no_jitter(self):
+        self.assertEqual(periodic_offset('app0', TASK_CLASS, 0), 0.)
+        self.assertEqual(periodic_offset('app0', TASK_CLASS, -5), 0.)
+
+    def test_max_jitter(self):
+        logging.disable(logging.CRITICAL)
+        try:
+            self.assertEqual(Scheduler([Instance('app0')], 10, False, jitter=120).jitter, MAX_JITTER)
+            self.assertEqual(Scheduler([Instance('app0')], 10, False, jitter=-1).jitter, 0)
+            self.assertEqual(Scheduler([Instance('app0')], 10, False, jitter=20).jitter, 20)
+        finally:
+            logging.disable(logging.NOTSET)
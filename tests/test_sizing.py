@@ -0,0 +1,68 @@
+import json
+import logging
+import unittest
+
+from huey_multitenant.sizing import DEFAULT_TASK_DURATION, DURATION_SMOOTHING, ConsumerSizing
+from tests.helpers import Instance
+
+
+def report(tasks, busy):
+    return json.dumps({'tasks': tasks, 'busy': busy, 'seconds': busy, 'workers': 1}).encode('utf-8')
+
+
+class ConsumerSizingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sizing = ConsumerSizing(drain_time=10.)
+        self.instance = Instance('a')
+
+    def test_default_duration(self):
+        self.assertEqual(self.sizing.duration(self.instance), DEFAULT_TASK_DURATION)
+
+    def test_report(self):
+        valid = self.sizing.report(self.instance, [report(4, 20.)])
+        self.assertEqual(valid[0]['tasks'], 4)
+        expected = DEFAULT_TASK_DURATION + DURATION_SMOOTHING * (5. - DEFAULT_TASK_DURATION)
+        self.assertAlmostEqual(self.sizing.duration(self.instance), expected)
+
+    def test_reports_converge(self):
+        for _ in range(50):
+            self.sizing.report(self.instance, [report(10, 2.)])
+        self.assertAlmostEqual(self.sizing.duration(self.instance), .2, places=3)
+
+    def test_report_without_tasks(self):
+        self.sizing.report(self.instance, [report(0, 0.)])
+        self.assertEqual(self.sizing.duration(self.instance), DEFAULT_TASK_DURATION)
+
+    def test_invalid_reports(self):
+        logging.disable(logging.ERROR)
+        try:
+            valid = self.sizing.report(self.instance, [b'not json', b'{"tasks": 1}', report(2, 2.)])
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(len(valid), 1)
+
+    def test_workers(self):
+        # 1 second per task, drained in 10 seconds.
+        self.assertEqual(self.sizing.workers(self.instance, 1, 0), 1)
+        self.assertEqual(self.sizing.workers(self.instance, 3, 0), 3)
+        self.assertEqual(self.sizing.workers(self.instance, 1000, 0), self.instance.workers)
+
+    def test_running_workers_count(self):
+        self.assertEqual(self.sizing.workers(self.instance, 60, 2), 4)
+        self.assertEqual(self.sizing.workers(self.instance, 60, 5), 1)
+        self.assertEqual(self.sizing.workers(self.instance, 60, 6), 0)
+        self.assertEqual(self.sizing.workers(self.instance, 25, 3), 1)
+        self.assertEqual(self.sizing.workers(self.instance, 25, 10), 0)
+
+    def test_short_tasks_get_a_whole_consumer(self):
+        for _ in range(50):
+            self.sizing.report(self.instance, [report(10, 1.)])
+        self.assertEqual(self.sizing.workers(self.instance, 50, 0), self.instance.workers)
+        self.assertEqual(self.sizing.workers(self.instance, 50, 1), self.instance.workers - 1)
+        self.assertEqual(self.sizing.workers(self.instance, 2, 0), 2)
+
+    def test_forget(self):
+        self.sizing.report(self.instance, [report(1, 9.)])
+        self.sizing.forget(self.instance)
+        self.assertEqual(self.sizing.duration(self.instance), DEFAULT_TASK_DURATION)
@@ -0,0 +1,113 @@
+import logging
+import os
+import signal
+import subprocess
+import time
+import unittest
+from unittest import mock
+
+from huey_multitenant import supervisor
+from huey_multitenant.metrics import CONSUMER_KILLS
+from huey_multitenant.supervisor import Supervisor
+from huey_multitenant.wakeup import Waker
+from tests.helpers import Instance
+
+
+MAX_SECONDS_RUNNING = 60
+
+
+class Consumer(object):
+    """
+    Stand-in for a HueyConsumer running `command`.
+    """
+    is_forked = False
+
+    def __init__(self, command, started=None):
+        self.app = Instance('supervised')
+        self.started = started or time.time()
+        self.process = subprocess.Popen(command)
+
+    def kill_consumer(self):
+        self.process.kill()
+
+
+def kills():
+    return CONSUMER_KILLS.labels('supervised').get()
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.waker = Waker()
+        self.consumers = []
+
+    def tearDown(self):
+        for consumer in self.consumers:
+            if consumer.process.poll() is None:
+                consumer.process.kill()
+                consumer.process.wait()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        logging.disable(logging.NOTSET)
+
+    def start(self, command, started=None):
+        consumer = Consumer(command, started)
+        self.consumers.append(consumer)
+        self.supervisor.add(consumer)
+        return consumer
+
+    def reap(self, timeout=5.):
+        """
+        Wait like the dispatcher for consumers to exit.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.waker.wait(self.supervisor.timeout(deadline - time.time()))
+            finished = self.supervisor.reap()
+            if finished:
+                return finished
+        return []
+
+    @unittest.skipUnless(hasattr(os, 'pidfd_open'), 'pidfds are not supported')
+    def test_exit(self):
+        self.supervisor = Supervisor(self.waker, MAX_SECONDS_RUNNING)
+        before = kills()
+        running = self.start(['sleep', '60'])
+        consumer = self.start(['true'])
+        self.assertTrue(self.supervisor.use_pidfd)
+        self.assertEqual(self.reap(), [consumer])
+        self.assertEqual(consumer.process.returncode, 0)
+        self.assertEqual(len(self.supervisor), 1)
+
+        # Neither is past its deadline.
+        self.supervisor.expire()
+        self.assertEqual(kills(), before)
+        self.assertIsNone(running.process.poll())
+
+    @unittest.skipUnless(hasattr(os, 'pidfd_open'), 'pidfds are not supported')
+    def test_overdue(self):
+        self.supervisor = Supervisor(self.waker, MAX_SECONDS_RUNNING)
+        before = kills()
+        consumer = self.start(['sleep', '60'], started=time.time() - MAX_SECONDS_RUNNING - 1)
+        self.assertEqual(self.supervisor.timeout(10), 0)
+        self.supervisor.expire()
+        self.assertEqual(kills(), before + 1)
+        self.assertEqual(self.reap(), [consumer])
+        self.assertEqual(consumer.process.returncode, -signal.SIGKILL)
+        self.assertEqual(len(self.supervisor), 0)
+
+    def test_without_pidfd(self):
+        with mock.patch.object(supervisor, 'open_pidfd', return_value=None):
+            self.supervisor = Supervisor(self.waker, MAX_SECONDS_RUNNING)
+            consumer = self.start(['true'])
+        # Falls back to polling after every SIGCHLD.
+        self.assertFalse(self.supervisor.use_pidfd)
+        self.assertEqual(self.reap(), [consumer])
+
+        before = kills()
+        consumer = self.start(['sleep', '60'], started=time.time() - MAX_SECONDS_RUNNING - 1)
+        self.supervisor.expire()
+        self.assertEqual(kills(), before + 1)
+        self.assertEqual(self.reap(), [consumer])
+        self.assertEqual(consumer.process.returncode, -signal.SIGKILL)
@@ -0,0 +1,68 @@
+import unittest
+
+from huey_multitenant.table import ConsumerTable
+from tests.helpers import Consumer, Instance
+
+
+class ConsumerTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = ConsumerTable()
+        self.a, self.b = Instance('a'), Instance('b')
+
+    def test_add(self):
+        first, second = Consumer(self.a, 't1', 100), Consumer(self.a, 't2', 101)
+        other = Consumer(self.b, 't3', 102)
+        for consumer in (first, second, other):
+            self.table.add(consumer)
+        self.assertEqual(len(self.table), 3)
+        self.assertEqual(set(self.table), set([first, second, other]))
+        self.assertTrue(self.table.has_task('t2'))
+        self.assertFalse(self.table.has_task('t4'))
+        self.assertEqual(self.table.count(self.a), 2)
+        self.assertEqual(self.table.count(self.b), 1)
+        self.assertEqual(set(self.table.for_instance(self.a)), set([first, second]))
+
+    def test_remove(self):
+        first, second = Consumer(self.a, 't1', 100), Consumer(self.a, 't2', 101)
+        self.table.add(first)
+        self.table.add(second)
+        self.table.remove(first)
+        self.assertEqual(list(self.table), [second])
+        self.assertFalse(self.table.has_task('t1'))
+        self.assertEqual(self.table.count(self.a), 1)
+
+        self.table.remove(second)
+        self.assertEqual(len(self.table), 0)
+        self.assertEqual(self.table.count(self.a), 0)
+        self.assertEqual(self.table.for_instance(self.a), [])
+        # Removing twice is harmless.
+        self.table.remove(second)
+
+    def test_same_task(self):
+        # A new consumer for the task of a consumer that is exiting.
+        old, new = Consumer(self.a, 't1', 100), Consumer(self.a, 't1', 101)
+        self.table.add(old)
+        self.table.add(new)
+        self.table.remove(old)
+        self.assertTrue(self.table.has_task('t1'))
+        self.assertEqual(list(self.table), [new])
+
+    def test_pending_forks(self):
+        # Consumers asked to a fork server have no PID yet.
+        first, second = Consumer(self.a, 't1'), Consumer(self.a, 't2')
+        self.table.add(first)
+        self.table.add(second)
+        self.assertEqual(len(self.table), 2)
+        first.process.pid = 100
+        self.table.remove(first)
+        self.table.remove(second)
+        self.assertEqual(len(self.table), 0)
+
+    def test_iterate_while_removing(self):
+        consumers = [Consumer(self.a, 't%d' % i, 100 + i) for i in range(5)]
+        for consumer in consumers:
+            self.table.add(consumer)
+        for consumer in self.table:
+            self.table.remove(consumer)
+        self.assertEqual(len(self.table), 0)
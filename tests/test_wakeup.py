@@ -0,0 +1,54 @@
+import logging
+import unittest
+
+from huey_multitenant.wakeup import NOTIFY_KEYSPACE_EVENTS, QueueWatcher, ScheduleWatcher, Waker, \
+    configure_notifications, missing_flags, read_notifications
+from tests.helpers import RedisTestCase
+
+
+class MissingFlagsTest(unittest.TestCase):
+
+    def test_missing(self):
+        self.assertEqual(missing_flags('', 'Klz'), 'Klz')
+        self.assertEqual(missing_flags('Kl', 'Klz'), 'z')
+        self.assertEqual(missing_flags('zKlE', 'Klz'), '')
+
+    def test_all_events(self):
+        self.assertEqual(missing_flags('A', 'Klz'), 'K')
+        self.assertEqual(missing_flags('KA', 'Klz'), '')
+
+
+class NotificationsTest(RedisTestCase):
+    """
+    Changes the configuration of the whole server, restored after every test.
+    """
+
+    def setUp(self):
+        super(NotificationsTest, self).setUp()
+        self.previous = read_notifications(self.conn)
+        self.conn.config_set(NOTIFY_KEYSPACE_EVENTS, '')
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        self.conn.config_set(NOTIFY_KEYSPACE_EVENTS, self.previous)
+        super(NotificationsTest, self).tearDown()
+
+    def test_every_watcher_is_enabled(self):
+        queues, schedules = QueueWatcher(self.conn, Waker()), ScheduleWatcher(self.conn, Waker())
+        self.assertFalse(queues.check_notifications())
+        self.assertFalse(schedules.check_notifications())
+
+        self.assertTrue(configure_notifications(self.conn, 'Klz'))
+        self.assertTrue(queues.check_notifications())
+        self.assertTrue(schedules.check_notifications())
+
+    def test_other_flags_are_kept(self):
+        self.conn.config_set(NOTIFY_KEYSPACE_EVENTS, 'Ex')
+        self.assertTrue(configure_notifications(self.conn, 'Kl'))
+        self.assertEqual(missing_flags(read_notifications(self.conn), 'ExKl'), '')
+
+    def test_already_enabled(self):
+        self.conn.config_set(NOTIFY_KEYSPACE_EVENTS, 'KA')
+        self.assertTrue(configure_notifications(self.conn, 'Klz'))
+        self.assertEqual(missing_flags(read_notifications(self.conn), 'KA'), '')
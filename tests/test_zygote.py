@@ -0,0 +1,133 @@
+import logging
+import os
+import sys
+import time
+import unittest
+
+from huey_multitenant import zygote
+from huey_multitenant.application import HueyApplication
+from huey_multitenant.metrics import SPAWN_SECONDS
+from huey_multitenant.zygote import FORK_FAILED, ForkedProcess, Zygote
+
+
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'forkserver_stub.py')
+
+
+def spawned():
+    return sum(SPAWN_SECONDS.labels(App.name).get()[0])
+
+
+def wait_for(condition, timeout=5.):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() >= deadline:
+            raise AssertionError('Timed out')
+        time.sleep(.01)
+
+
+class App(object):
+    """
+    Stand-in for a HueyApplication whose fork server is forkserver_stub.py,
+    recording the commands it runs instead.
+    """
+    name = 'stub'
+    worker_type = 'thread'
+    workers = 2
+
+    def __init__(self, mode):
+        self._logger = logging.getLogger()
+        self.mode = mode
+        self.zygote = Zygote(self)
+        self.commands = []
+
+    def build_command(self, command):
+        return [sys.executable, STUB, self.mode] + command.split()
+
+    def consumer_command(self, workers):
+        return HueyApplication.consumer_command(self, workers)
+
+    def execute_command(self, command):
+        self.commands.append(command)
+        return command
+
+    def run_consumer(self, workers=None):
+        return HueyApplication.run_consumer(self, workers)
+
+
+class ZygoteTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.timeout = zygote.FORK_TIMEOUT
+
+    def tearDown(self):
+        zygote.FORK_TIMEOUT = self.timeout
+        self.app.zygote.stop()
+        logging.disable(logging.NOTSET)
+
+    def start(self, mode):
+        """
+        Start the fork server of an App and wait until it is ready.
+        """
+        self.app = App(mode)
+        # Consumers run cold while the fork server starts.
+        self.assertEqual(self.app.run_consumer(), 'execute_task --no-periodic -k thread -w 2')
+        self.wait_ready()
+        return self.app.zygote
+
+    def wait_ready(self):
+        def ready():
+            self.app.zygote.read_messages()
+            return self.app.zygote.ready
+        wait_for(ready)
+
+    def test_forked(self):
+        server = self.start('fork')
+        before = spawned()
+        process = self.app.run_consumer(3)
+        self.assertIsInstance(process, ForkedProcess)
+        self.assertIsNone(process.pid)
+        wait_for(lambda: process.poll() is not None or process.pid is not None)
+        self.assertNotEqual(process.pid, server.process.pid)
+        # Spawning took until the fork server answered with the pid.
+        self.assertEqual(spawned(), before + 1)
+        # The stub consumer exits with the number of workers it was asked for.
+        wait_for(lambda: process.poll() is not None)
+        self.assertEqual(process.returncode, 3)
+
+    def test_fork_timeout(self):
+        zygote.FORK_TIMEOUT = .2
+        server = self.start('silent')
+        before = spawned()
+        process = self.app.run_consumer()
+        wait_for(lambda: process.poll() is not None)
+        self.assertEqual(process.returncode, FORK_FAILED)
+        self.assertIsNone(process.pid)
+        self.assertEqual(spawned(), before)
+        self.assertIsNone(server.process)
+
+        # The fork server is started again, meanwhile consumers run cold.
+        self.assertEqual(self.app.run_consumer(), 'execute_task --no-periodic -k thread -w 2')
+        self.assertEqual(len(self.app.commands), 2)
+        self.assertIsNotNone(server.process)
+        self.wait_ready()
+
+    def test_server_dies(self):
+        self.start('crash')
+        process = self.app.run_consumer()
+        wait_for(lambda: process.poll() is not None)
+        self.assertEqual(process.returncode, FORK_FAILED)
+
+    def test_stop_fails_pending(self):
+        server = self.start('silent')
+        first, second = self.app.run_consumer(), self.app.run_consumer()
+        server.stop()
+        self.assertEqual((first.returncode, second.returncode), (FORK_FAILED, FORK_FAILED))
+
+    def test_kill_pending(self):
+        server = self.start('silent')
+        process = self.app.run_consumer()
+        # Nothing to kill until the fork server answers.
+        HueyApplication.kill_process(self.app, process)
+        self.assertIsNone(process.poll())
+        self.assertTrue(server.is_alive())